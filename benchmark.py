@@ -0,0 +1,657 @@
+"""Offline load test for the bot, with stand-ins for Gemini and Discord.
+
+Drives on_message, /chat, /summary and /imagine at a given rate across
+simulated guilds and reports throughput, latency percentiles, peak RSS and
+the chat session store size. With --gateway it instead compares gateway
+event throughput and memory with the lean and the full intents. No Discord
+token or Gemini key is needed.
+
+Example:
+    python benchmark.py --guilds 50 --rate 40 --duration 30 --json bench.json
+    python benchmark.py --max-p95 chat=5 --max-p95 mention=8   # Fail on regressions
+    python benchmark.py --gateway --guilds 20 --gateway-members 5000   # Lean vs full gateway mode
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# Keep the bot's own limits out of the way unless they are set explicitly
+_state_dir = tempfile.mkdtemp(prefix='bot-bench-')
+for name, value in {
+    'GEMINI_REQUESTS_PER_MINUTE': '1000000',
+    'GEMINI_TOKENS_PER_MINUTE': '1000000000',
+    'GEMINI_MAX_CONCURRENCY': '64',
+    'GEMINI_MAX_QUEUE': '10000',
+    'METRICS_PORT': '0',
+    'LOG_LEVEL': 'WARNING',
+    'GUILD_CONFIG_DB': os.path.join(_state_dir, 'guild_configs.db'),
+    'IMAGE_CACHE_DIR': os.path.join(_state_dir, 'image_cache'),
+    'SESSION_SPILL_DB': os.path.join(_state_dir, 'chat_sessions.db'),
+}.items():
+    os.environ.setdefault(name, value)
+
+import discord
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import protos, generative_models
+from google.generativeai.types import content_types, generation_types
+from PIL import Image
+
+import main
+
+OPERATIONS = ('mention', 'chat', 'summary', 'imagine')
+
+# Gemini stand-in
+class FakeGemini:
+    """Latency and error profile shared by every fake model."""
+
+    def __init__(self, latency_ms: float, latency_sigma: float, error_rate: float, quota_error_rate: float):
+        self.latency = latency_ms / 1000
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.calls = 0
+        image = Image.effect_noise((768, 768), 40).convert('RGB')
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        self.image_bytes = output.getvalue()
+
+    def sample_latency(self) -> float:
+        # Log-normal around the median, like real API latencies
+        return self.latency * random.lognormvariate(0, self.latency_sigma)
+
+    def maybe_fail(self):
+        roll = random.random()
+        if roll < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("simulated outage")
+        if roll < self.error_rate + self.quota_error_rate:
+            raise google_exceptions.ResourceExhausted("simulated quota error")
+
+class FakeGenerativeModel:
+    """Stands in for genai.GenerativeModel; used through the real ChatSession."""
+    profile = None  # FakeGemini, set before the run
+
+    def __init__(self, model_name='fake', system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self._system_instruction = system_instruction
+
+    def _get_tools_lib(self, tools):
+        return None
+
+    def start_chat(self, history=None):
+        return generative_models.ChatSession(model=self, history=history)
+
+    @staticmethod
+    def _response(parts, prompt_tokens: int, output_tokens: int, finish_reason: int = 1):
+        return protos.GenerateContentResponse(
+            candidates=[protos.Candidate(content=protos.Content(role='model', parts=parts), finish_reason=finish_reason)],
+            usage_metadata=protos.GenerateContentResponse.UsageMetadata(
+                prompt_token_count=prompt_tokens, candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens
+            )
+        )
+
+    async def generate_content_async(self, contents=None, stream=False, **kwargs):
+        profile = self.profile
+        profile.calls += 1
+        contents = content_types.to_contents(contents)
+        prompt_text = ''.join(part.text for content in contents for part in content.parts)
+        prompt_tokens = main.estimate_tokens(prompt_text)
+        latency = profile.sample_latency()
+
+        if prompt_text.startswith('Tạo một hình ảnh'):
+            await asyncio.sleep(latency * 3)
+            profile.maybe_fail()
+            image = protos.Part(inline_data=protos.Blob(mime_type='image/png', data=profile.image_bytes))
+            return generation_types.AsyncGenerateContentResponse.from_response(self._response([image], prompt_tokens, 258))
+
+        words = (f"Dạ thưa, nô tỳ xin trả lời ạ. " * random.randint(5, 40)).split()
+        if not stream:
+            await asyncio.sleep(latency)
+            profile.maybe_fail()
+            text = ' '.join(words)
+            return generation_types.AsyncGenerateContentResponse.from_response(
+                self._response([protos.Part(text=text)], prompt_tokens, main.estimate_tokens(text))
+            )
+
+        # Stream the reply in a handful of chunks spread over the latency
+        chunk_count = 5
+        size = len(words) // chunk_count + 1
+
+        async def chunks():
+            for index in range(chunk_count):
+                await asyncio.sleep(latency / chunk_count)
+                if index == 0:
+                    profile.maybe_fail()
+                last = index == chunk_count - 1
+                text = ' '.join(words[index * size:(index + 1) * size]) + ' '
+                yield self._response(
+                    [protos.Part(text=text)], prompt_tokens if last else 0,
+                    main.estimate_tokens(text) if last else 0, 1 if last else 0
+                )
+        return await generation_types.AsyncGenerateContentResponse.from_aiterator(chunks())
+
+    async def count_tokens_async(self, contents=None, **kwargs):
+        await asyncio.sleep(self.profile.latency / 10)
+        contents = content_types.to_contents(contents)
+        return protos.CountTokensResponse(
+            total_tokens=sum(main.estimate_tokens(part.text) for content in contents for part in content.parts)
+        )
+
+# Discord stand-ins
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return self.id
+
+    def mentioned_in(self, message) -> bool:
+        return any(user.id == self.id for user in message.mentions)
+
+class FakeGuild:
+    filesize_limit = 10 * 1024 * 1024
+
+    def __init__(self, guild_id: int, api_latency: float = 0.0):
+        self.id = guild_id
+        self.api_latency = api_latency
+
+    def get_member(self, user_id: int):
+        return None  # Nothing is cached in lean gateway mode
+
+    async def fetch_member(self, user_id: int):
+        await asyncio.sleep(self.api_latency)
+        return FakeUser(user_id, f"nick{user_id % 1000}")
+
+class FakeMessage:
+    _next_id = 1
+
+    def __init__(self, channel, author, content: str, mentions=()):
+        FakeMessage._next_id += 1
+        self.id = FakeMessage._next_id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self.attachments = []
+        self.embeds = []
+        self.reactions = []
+        self.webhook_id = None
+        self.created_at = datetime.now(timezone.utc)
+        self._state = main.bot._connection  # Needed by commands.Context
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.api_latency)
+        self.content = content
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: FakeGuild, api_latency: float):
+        self.id = channel_id
+        self.guild = guild
+        self.api_latency = api_latency
+        self.messages = []  # Oldest first
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content=None, file=None, **kwargs):
+        await asyncio.sleep(self.api_latency)
+        if file is not None:
+            file.close()
+        message = FakeMessage(self, bench_bot_user, content or '')
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        if oldest_first is None:
+            oldest_first = after is not None
+        selected = [
+            message for message in self.messages
+            if (before is None or message.id < before.id) and (after is None or message.id > after.id)
+        ]
+        if not oldest_first:
+            selected.reverse()
+        for page_start in range(0, min(limit, len(selected)), 100):
+            await asyncio.sleep(self.api_latency)  # One REST request per page of 100
+            for message in selected[page_start:min(limit, page_start + 100)]:
+                yield message
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        await asyncio.sleep(0)
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+class FakeInteraction:
+    _next_id = 10 ** 15
+
+    def __init__(self, channel: FakeChannel, user: FakeUser):
+        FakeInteraction._next_id += 1
+        self.id = FakeInteraction._next_id
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.user = user
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(channel)
+
+bench_bot_user = FakeUser(1, 'Ô sin', bot=True)
+
+# Redis stand-in
+class InMemoryRedis:
+    """The subset of the redis.asyncio client used by RedisStateBackend, kept in a dict.
+
+    Values are stored as bytes and keys expire like in Redis, so the shared
+    state path can be exercised without a Redis server.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires_at = {}
+
+    def _live(self, key):
+        key = key.encode() if isinstance(key, str) else key
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._data.pop(key, None)
+            self._expires_at.pop(key, None)
+        return key
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def get(self, key):
+        return self._data.get(self._live(key))
+
+    async def set(self, key, value, ex=None):
+        key = self._live(key)
+        self._data[key] = self._bytes(value)
+        self._expires_at.pop(key, None)
+        if ex is not None:
+            self._expires_at[key] = time.monotonic() + ex
+        return True
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            key = self._live(key)
+            if self._data.pop(key, None) is not None:
+                deleted += 1
+            self._expires_at.pop(key, None)
+        return deleted
+
+    async def expire(self, key, seconds):
+        key = self._live(key)
+        if key not in self._data:
+            return False
+        self._expires_at[key] = time.monotonic() + seconds
+        return True
+
+    async def sadd(self, key, *members):
+        members_set = self._data.setdefault(self._live(key), set())
+        before = len(members_set)
+        members_set.update(self._bytes(member) for member in members)
+        return len(members_set) - before
+
+    async def smembers(self, key):
+        return set(self._data.get(self._live(key), set()))
+
+    async def hset(self, key, mapping):
+        fields = self._data.setdefault(self._live(key), {})
+        fields.update({self._bytes(field): self._bytes(value) for field, value in mapping.items()})
+        return len(mapping)
+
+    async def hgetall(self, key):
+        return dict(self._data.get(self._live(key), {}))
+
+    async def aclose(self):
+        pass
+
+# Load generation
+PROMPTS = ["bot làm được gì?", "hướng dẫn dùng", "kể chuyện cười đi", "hôm nay ăn gì", "giải thích async/await"]
+IMAGE_PROMPTS = ["một con mèo đang đọc sách", "phố cổ Hà Nội về đêm", "bát phở bò", "rồng bay trên vịnh Hạ Long"]
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run_operation(operation: str, channel: FakeChannel, user: FakeUser):
+    if operation == 'mention':
+        message = FakeMessage(channel, user, f"<@{bench_bot_user.id}> {random.choice(PROMPTS)}", [bench_bot_user])
+        channel.messages.append(message)
+        await main.on_message(message)
+    elif operation == 'chat':
+        await main.chat_command.callback(FakeInteraction(channel, user), random.choice(PROMPTS))
+    elif operation == 'summary':
+        await main.summary_command.callback(FakeInteraction(channel, user), random.choice((10, 50, 200)))
+    else:
+        await main.imagine_slash_command.callback(FakeInteraction(channel, user), random.choice(IMAGE_PROMPTS))
+
+async def run_benchmark(args) -> dict:
+    FakeGenerativeModel.profile = FakeGemini(args.latency_ms, args.latency_sigma, args.error_rate, args.quota_error_rate)
+    main.init_gemini()
+    main.genai.GenerativeModel = FakeGenerativeModel
+    main.ToneStrategyFactory._models.clear()
+    main.model = FakeGenerativeModel()
+    main.bot._connection.user = bench_bot_user
+    if args.state_backend == 'redis':
+        # Exercise the shared state path, against a real server or the stand-in
+        client = main.aioredis.from_url(args.redis_url) if args.redis_url else InMemoryRedis()
+        main.state_backend = main.RedisStateBackend(client, main.REDIS_KEY_PREFIX, main.SESSION_IDLE_TTL)
+        main.guild_configs.backend = main.state_backend
+    else:
+        await main.chat_sessions.open()
+
+    # Simulated guilds with some chat history for summaries
+    api_latency = args.discord_latency_ms / 1000
+    channels = []
+    for guild_index in range(args.guilds):
+        guild = FakeGuild(1000 + guild_index, api_latency)
+        for channel_index in range(args.channels_per_guild):
+            channel = FakeChannel(guild.id * 100 + channel_index, guild, api_latency)
+            for message_index in range(args.history):
+                message = FakeMessage(channel, FakeUser(10 ** 6 + message_index % 20, f"user{message_index % 20}"), f"tin nhắn {message_index}")
+                message.created_at -= timedelta(seconds=args.history - message_index)
+                channel.messages.append(message)
+            channels.append(channel)
+    users = [FakeUser(10 ** 7 + index, f"member{index}") for index in range(args.users)]
+
+    weights = [args.mix[operation] for operation in OPERATIONS]
+    latencies = {operation: [] for operation in OPERATIONS}
+    failures = {operation: 0 for operation in OPERATIONS}
+    peak_sessions = 0
+
+    async def timed(operation, channel, user):
+        nonlocal peak_sessions
+        started_at = time.perf_counter()
+        try:
+            await run_operation(operation, channel, user)
+        except Exception:
+            failures[operation] += 1
+        latencies[operation].append(time.perf_counter() - started_at)
+        peak_sessions = max(peak_sessions, len(main.chat_sessions))
+
+    # Open-loop arrivals (Poisson), so slow responses do not slow down the load
+    tasks = []
+    started_at = time.perf_counter()
+    while time.perf_counter() - started_at < args.duration:
+        operation = random.choices(OPERATIONS, weights)[0]
+        tasks.append(asyncio.ensure_future(timed(operation, random.choice(channels), random.choice(users))))
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.wait(tasks, timeout=args.drain_timeout)
+    elapsed = time.perf_counter() - started_at
+    if main.image_pool is not None:
+        main.image_pool.shutdown(wait=True)
+    session_stats = {**main.chat_sessions.stats(), 'peak_sessions': peak_sessions}
+    snapshot_started_at = time.perf_counter()
+    await main.chat_sessions.close()
+    session_stats['snapshot_seconds'] = round(time.perf_counter() - snapshot_started_at, 3)
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'max_p95')},
+        'elapsed_seconds': round(elapsed, 2),
+        'requests': len(tasks),
+        'completed': completed,
+        'throughput_per_second': round(completed / elapsed, 2),
+        'gemini_calls': FakeGenerativeModel.profile.calls,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'session_store': session_stats,
+        'state_backend': args.state_backend,
+        'lean_gateway': main.LEAN_GATEWAY,
+        'errors_by_type': {labels[0]: count for labels, count in main.errors_total._values.items()},
+        'gemini_tokens': {'/'.join(labels): count for labels, count in main.gemini_tokens._values.items()},
+        'budget_decisions': {'/'.join(labels): count for labels, count in main.budget_decisions._values.items()},
+        'operations': {
+            operation: {
+                'count': len(values),
+                'failed': failures[operation],
+                'p50': round(percentile(values, 0.50), 3),
+                'p95': round(percentile(values, 0.95), 3),
+                'p99': round(percentile(values, 0.99), 3),
+            }
+            for operation, values in latencies.items()
+        },
+    }
+
+# Gateway simulation: the same server activity, received with the lean or the full intents
+GATEWAY_TRAFFIC = {
+    # Event: (intent the gateway requires, share of the traffic on a busy server)
+    'PRESENCE_UPDATE': ('presences', 70),
+    'MESSAGE_CREATE': ('guild_messages', 15),
+    'TYPING_START': ('guild_typing', 8),
+    'MESSAGE_REACTION_ADD': ('guild_reactions', 5),
+    'GUILD_MEMBER_UPDATE': ('members', 2),
+}
+GATEWAY_TIMESTAMP = '2024-01-01T00:00:00+00:00'
+
+def fake_user_payload(user_id: int) -> dict:
+    return {'id': str(user_id), 'username': f"user{user_id}", 'discriminator': '0', 'avatar': None,
+            'global_name': f"User {user_id}"}
+
+def fake_member_payload(user_id: int, with_user: bool = True) -> dict:
+    member = {'roles': [], 'joined_at': GATEWAY_TIMESTAMP, 'deaf': False, 'mute': False, 'nick': None, 'flags': 0}
+    if with_user:
+        member['user'] = fake_user_payload(user_id)
+    return member
+
+def fake_presence_payload(guild_id: int, user_id: int) -> dict:
+    return {
+        'user': {'id': str(user_id)}, 'guild_id': str(guild_id), 'status': random.choice(('online', 'idle', 'dnd')),
+        'activities': [{'name': random.choice(('Minecraft', 'Spotify', 'VS Code')), 'type': 0, 'created_at': 0}],
+        'client_status': {'desktop': 'online'},
+    }
+
+def fake_guild_payload(guild_id: int, member_ids: list, intents: discord.Intents) -> dict:
+    """GUILD_CREATE as Discord sends it: member and presence lists depend on the intents."""
+    listed = member_ids if intents.members else member_ids[:1]  # Just the bot itself
+    return {
+        'id': str(guild_id), 'name': f"guild{guild_id}", 'owner_id': str(member_ids[0]), 'large': True,
+        'member_count': len(member_ids), 'verification_level': 0, 'default_message_notifications': 0,
+        'explicit_content_filter': 0, 'mfa_level': 0, 'premium_tier': 0, 'nsfw_level': 0,
+        'preferred_locale': 'vi', 'afk_timeout': 300, 'system_channel_flags': 0, 'features': [],
+        'emojis': [], 'stickers': [], 'threads': [], 'voice_states': [],
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0}],
+        'channels': [{'id': str(guild_id * 100), 'type': 0, 'name': 'general', 'position': 0, 'permission_overwrites': []}],
+        'members': [fake_member_payload(user_id) for user_id in listed],
+        'presences': [fake_presence_payload(guild_id, user_id) for user_id in member_ids] if intents.presences else [],
+    }
+
+def fake_event_payload(event: str, guild_id: int, user_id: int, message_id: int) -> dict:
+    channel_id = str(guild_id * 100)
+    if event == 'PRESENCE_UPDATE':
+        return fake_presence_payload(guild_id, user_id)
+    if event == 'MESSAGE_CREATE':
+        return {
+            'id': str(message_id), 'channel_id': channel_id, 'guild_id': str(guild_id), 'type': 0,
+            'author': fake_user_payload(user_id), 'member': fake_member_payload(user_id, with_user=False),
+            'content': random.choice(PROMPTS), 'timestamp': GATEWAY_TIMESTAMP, 'edited_timestamp': None,
+            'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [],
+            'attachments': [], 'embeds': [], 'pinned': False,
+        }
+    if event == 'TYPING_START':
+        return {'channel_id': channel_id, 'guild_id': str(guild_id), 'user_id': str(user_id),
+                'timestamp': int(time.time()), 'member': fake_member_payload(user_id)}
+    if event == 'MESSAGE_REACTION_ADD':
+        return {'user_id': str(user_id), 'channel_id': channel_id, 'message_id': str(max(1, message_id - 1)),
+                'guild_id': str(guild_id), 'emoji': {'id': None, 'name': '👍'},
+                'member': fake_member_payload(user_id), 'burst': False, 'type': 0}
+    return {**fake_member_payload(user_id), 'guild_id': str(guild_id), 'nick': f"nick{message_id}"}
+
+def run_gateway_simulation(lean: bool, guilds: int, members: int, events: int, seed: int) -> dict:
+    """Feed GUILD_CREATE and a stream of gateway events through discord.py's own parsers.
+
+    Runs in a fresh process per mode so the RSS figures are comparable.
+    """
+    random.seed(seed)
+    options = main.build_gateway_options(lean)
+    intents = options['intents']
+    dispatched = [0]
+
+    def dispatch(event, *args, **kwargs):
+        dispatched[0] += 1
+
+    state = discord.state.ConnectionState(dispatch=dispatch, handlers={}, hooks={}, http=None, **options)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    guild_ids = [10 ** 6 + index for index in range(guilds)]
+    for guild_id in guild_ids:
+        member_ids = list(range(guild_id * 10 ** 5, guild_id * 10 ** 5 + members))
+        state._add_guild_from_data(fake_guild_payload(guild_id, member_ids, intents))
+
+    # Every mode sees the same activity; the gateway only delivers what the intents ask for
+    names = list(GATEWAY_TRAFFIC)
+    weights = [share for _, share in GATEWAY_TRAFFIC.values()]
+    received = {name: 0 for name in names}
+    processing = 0.0
+    for message_id in range(1, events + 1):
+        event = random.choices(names, weights)[0]
+        guild_id = random.choice(guild_ids)
+        user_id = guild_id * 10 ** 5 + random.randrange(members)
+        if not getattr(intents, GATEWAY_TRAFFIC[event][0]):
+            continue
+        payload = fake_event_payload(event, guild_id, user_id, message_id)
+        started_at = time.perf_counter()
+        state.parsers[event](payload)
+        processing += time.perf_counter() - started_at
+        received[event] += 1
+
+    total_received = sum(received.values())
+    return {
+        'mode': 'lean' if lean else 'full',
+        'events_offered': events,
+        'events_received': total_received,
+        'received_by_type': received,
+        'processing_seconds': round(processing, 3),
+        'events_per_second': round(total_received / processing) if processing else 0,
+        'cached_members': sum(len(guild._members) for guild in state.guilds),
+        'cached_messages': len(state._messages or ()),
+        'rss_growth_mb': round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def compare_gateway_modes(args) -> dict:
+    results = {}
+    for lean in (False, True):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_gateway_simulation, lean, args.guilds, args.gateway_members,
+                                     args.gateway_events, args.seed).result()
+        results[result['mode']] = result
+    return results
+
+def print_gateway_report(results: dict):
+    print(f"{'mode':<6}{'received':>10}{'busy (s)':>10}{'events/s':>11}{'members':>10}{'messages':>10}{'RSS growth (MB)':>17}{'peak RSS (MB)':>15}")
+    for mode, row in results.items():
+        print(f"{mode:<6}{row['events_received']:>10}{row['processing_seconds']:>10}{row['events_per_second']:>11}{row['cached_members']:>10}"
+              f"{row['cached_messages']:>10}{row['rss_growth_mb']:>17}{row['peak_rss_mb']:>15}")
+
+def print_report(report: dict):
+    print(f"Ran {report['requests']} requests in {report['elapsed_seconds']}s "
+          f"({report['throughput_per_second']}/s), {report['gemini_calls']} Gemini calls")
+    print(f"{'operation':<10}{'count':>8}{'failed':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}")
+    for operation, row in report['operations'].items():
+        print(f"{operation:<10}{row['count']:>8}{row['failed']:>8}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}")
+    store = report['session_store']
+    print(f"Peak RSS: {report['peak_rss_mb']} MB, sessions: {store['sessions']} (peak {store['peak_sessions']}), "
+          f"session bytes: {store['bytes']}")
+    if store['spilled'] or store['restored']:
+        print(f"Spilled sessions: {store['spilled']} (avg {store['avg_spill_ms']} ms per batch), "
+              f"restored: {store['restored']} (avg {store['avg_restore_ms']} ms), snapshot: {store['snapshot_seconds']}s")
+    if report['errors_by_type']:
+        print(f"Errors: {report['errors_by_type']}")
+    if report['budget_decisions']:
+        print(f"Budget decisions: {report['budget_decisions']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=20, help='simulated servers')
+    parser.add_argument('--channels-per-guild', type=int, default=3)
+    parser.add_argument('--users', type=int, default=200, help='simulated members sending messages')
+    parser.add_argument('--history', type=int, default=300, help='existing messages per channel')
+    parser.add_argument('--rate', type=float, default=20, help='requests per second across all guilds')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for in-flight requests')
+    parser.add_argument('--mix', default='mention=70,chat=15,summary=10,imagine=5', help='relative weight of each operation')
+    parser.add_argument('--latency-ms', type=float, default=400, help='median fake Gemini latency')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='log-normal spread of Gemini latency')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of Gemini calls failing with 503')
+    parser.add_argument('--quota-error-rate', type=float, default=0.01, help='fraction of Gemini calls failing with 429')
+    parser.add_argument('--discord-latency-ms', type=float, default=50, help='latency of each fake Discord API call')
+    parser.add_argument('--state-backend', choices=('local', 'redis'), default='local',
+                        help='where sessions and tones are kept; redis uses an in-memory stand-in unless --redis-url is given')
+    parser.add_argument('--redis-url', help='Redis server to use with --state-backend redis')
+    parser.add_argument('--gateway', action='store_true',
+                        help='compare lean and full gateway modes instead of running the load test')
+    parser.add_argument('--gateway-members', type=int, default=5000, help='members per server in the gateway comparison')
+    parser.add_argument('--gateway-events', type=int, default=200000, help='server events in the gateway comparison')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--max-p95', action='append', default=[], metavar='OPERATION=SECONDS',
+                        help='exit with an error if the p95 latency of an operation exceeds this')
+    args = parser.parse_args(argv)
+    weights = {operation: 0.0 for operation in OPERATIONS}
+    weights.update({key.strip(): float(value) for key, _, value in (item.partition('=') for item in args.mix.split(','))})
+    args.mix = weights
+    return args
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    if args.gateway:
+        report = compare_gateway_modes(args)
+        print_gateway_report(report)
+    else:
+        report = asyncio.run(run_benchmark(args))
+        print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+
+    # Regression gates
+    exit_code = 0
+    for limit in [] if args.gateway else args.max_p95:
+        operation, _, seconds = limit.partition('=')
+        p95 = report['operations'][operation]['p95']
+        if p95 > float(seconds):
+            print(f"FAIL: {operation} p95 {p95}s exceeds {seconds}s")
+            exit_code = 1
+    return exit_code
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,123 @@
+"""Image re-encoding helpers for generated images and attached images.
+
+These functions run in worker processes, so this module only depends on
+Pillow and never imports the bot itself.
+"""
+import io
+
+from PIL import Image
+
+# Content types by detected format
+MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+# Formats images can be re-encoded to
+OUTPUT_FORMATS = ('webp', 'jpeg')
+
+def sniff_image_format(data: bytes):
+    """Detect the real image format from its magic bytes, or return None."""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def _normalize_mode(image: Image.Image) -> Image.Image:
+    if image.mode in ('RGB', 'RGBA'):
+        return image
+    has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+def _check_output_format(image_format: str):
+    if image_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {image_format!r} (expected one of {', '.join(OUTPUT_FORMATS)})")
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if image_format == 'webp':
+        image.save(output, format='WEBP', quality=quality, method=4)
+    else:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+def process_image(data: bytes, image_format: str, target_bytes: int, max_dimension: int):
+    """Re-encode an image to WebP or JPEG, aiming to stay under target_bytes.
+
+    Quality is lowered step by step first, then the image is scaled down.
+    Returns (image_bytes, mime_type); the original is returned unchanged when
+    it is animated, already small enough in the target format, or cannot be
+    decoded. Raises ValueError if image_format is not in OUTPUT_FORMATS.
+    """
+    _check_output_format(image_format)
+    source_format = sniff_image_format(data)
+    if source_format is None:
+        return data, 'application/octet-stream'
+    if source_format == image_format and len(data) <= target_bytes:
+        return data, MIME_TYPES[source_format]
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            return data, MIME_TYPES[source_format]
+        image.load()
+    except (OSError, SyntaxError):
+        return data, MIME_TYPES[source_format]
+
+    image = _normalize_mode(image)
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    encoded = data
+    while True:
+        for quality in (85, 75, 65, 55):
+            encoded = _encode(image, image_format, quality)
+            if len(encoded) <= target_bytes:
+                return encoded, MIME_TYPES[image_format]
+        if max(image.size) <= 256:
+            return encoded, MIME_TYPES[image_format]  # Best effort
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+
+def make_thumbnail(data: bytes, size: int, image_format: str):
+    """Return (image_bytes, mime_type) of a thumbnail at most size pixels on its longest side."""
+    _check_output_format(image_format)
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size), Image.LANCZOS)
+    image = _normalize_mode(image)
+    return _encode(image, image_format, 75), MIME_TYPES[image_format]
+
+def prepare_input_image(data: bytes, max_dimension: int, max_pixels: int):
+    """Downscale an attached image before it is sent to the model.
+
+    Returns (image_bytes, mime_type), or None when the data is not an image
+    that can be decoded or it has more than max_pixels pixels. Still PNG, JPEG
+    and WebP images that already fit are passed through; anything else becomes
+    a JPEG whose longest side is at most max_dimension. Animated images keep
+    their first frame.
+    """
+    source_format = sniff_image_format(data)
+    if source_format is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > max_pixels:
+            return None
+        animated = getattr(image, 'is_animated', False)
+        if source_format != 'gif' and not animated and max(image.size) <= max_dimension:
+            return data, MIME_TYPES[source_format]
+        image.draft('RGB', (max_dimension, max_dimension))  # JPEG only: decode at a reduced scale
+        image.load()
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        return None
+
+    image = _normalize_mode(image)
+    if image.mode == 'RGBA':
+        # Flatten transparency onto white rather than letting JPEG turn it black
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    return _encode(image, 'jpeg', 85), MIME_TYPES['jpeg']
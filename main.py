@@ -1,37 +1,1409 @@
+import time
+STARTUP_STARTED_AT = time.perf_counter()  # Startup phases are timed from here
+
 import discord
 from discord.ext import commands
 from discord import app_commands
-import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import os
 import io
+import re
+import hashlib
+import base64
+import zlib
+import unicodedata
+import asyncio
+import signal
+import sys
+import json
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 import random
 from abc import ABC, abstractmethod
 from enum import Enum
+from datetime import datetime, timezone
+from pathlib import Path
+import aiohttp
+from aiohttp import web
+from image_processing import MIME_TYPES, OUTPUT_FORMATS, sniff_image_format, process_image, make_thumbnail, prepare_input_image
+
+# Redis is only needed for the shared state backend
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 # Load environment variables
 load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
-# Check required tokens
-if not DISCORD_TOKEN or not GEMINI_API_KEY:
-    print("ERROR: Please set DISCORD_TOKEN and GEMINI_API_KEY in .env file")
-    exit()
+# Logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_CONTENT = os.getenv('LOG_CONTENT', 'redact').lower()  # How user messages are logged: redact, truncate or full
+LOG_CONTENT_MAX_CHARS = int(os.getenv('LOG_CONTENT_MAX_CHARS', '80'))  # Length kept in truncate mode
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')  # e.g. "message_received=0.1,session_created=0.5"
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, including structured event fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class StructuredQueueHandler(QueueHandler):
+    """Queue handler that keeps event fields intact for the JSON formatter."""
+
+    def prepare(self, record):
+        # Render what cannot be formatted later (arguments, traceback) before the record leaves this thread
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    """Send all logging through a queue to a background thread that writes JSON lines to stdout."""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    root = logging.getLogger()
+    root.handlers[:] = [StructuredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)  # Flush what is still queued on exit
+
+setup_logging()
+log = logging.getLogger('discord_chatbot')
+log_sample_rates = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition('=') for item in LOG_SAMPLE_RATES.split(',') if '=' in item)
+}
+
+def log_event(level: int, event: str, message: str, exc_info=None, **fields):
+    """Log a structured event, keeping only a sample of it if a rate is configured."""
+    if not log.isEnabledFor(level):
+        return
+    rate = log_sample_rates.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    log.log(level, message, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+def redact_content(text: str) -> str:
+    """Return user-written text in the form allowed by LOG_CONTENT."""
+    if LOG_CONTENT == 'full':
+        return text
+    if LOG_CONTENT == 'truncate':
+        return text if len(text) <= LOG_CONTENT_MAX_CHARS else text[:LOG_CONTENT_MAX_CHARS] + '…'
+    return f"<{len(text)} chars>"
 
 # Bot configuration
 BOT_PREFIX = '!'
 MODEL_NAME = 'gemini-2.0-flash'  # Using a powerful model that supports both text and images
 
-# Initialize Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel(MODEL_NAME)
+# Chat session store limits
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '5000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(64 * 1024 * 1024)))  # Estimated history bytes across all sessions
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '3600'))  # Seconds before an unused session expires
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', '60'))  # Seconds between background sweeps
+SESSION_SPILL_DB = os.getenv('SESSION_SPILL_DB', 'data/chat_sessions.db')  # Idle sessions are moved here; empty keeps them in memory only
+SESSION_SPILL_AFTER = float(os.getenv('SESSION_SPILL_AFTER', '300'))  # Seconds idle before a session is moved to disk
+
+# Chat history compaction
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '8000'))  # Compact once a session's history passes this
+HISTORY_KEEP_TURNS = int(os.getenv('HISTORY_KEEP_TURNS', '6'))  # Most recent exchanges kept word for word
+
+# Guild configuration storage
+GUILD_CONFIG_DB = os.getenv('GUILD_CONFIG_DB', 'data/guild_configs.db')
+GUILD_CONFIG_FLUSH_INTERVAL = float(os.getenv('GUILD_CONFIG_FLUSH_INTERVAL', '5'))  # Seconds between write-behind flushes
+
+# Hash of the last synced slash commands; commands are only synced again when it changes
+COMMAND_HASH_FILE = os.getenv('COMMAND_HASH_FILE', 'data/command_tree.sha256')
+
+# Sharding and shared state, for running the bot as several processes
+SHARD_COUNT = os.getenv('SHARD_COUNT', '')  # Empty: one gateway connection, 'auto': Discord's recommendation, or a number
+SHARD_IDS = os.getenv('SHARD_IDS', '')  # Shards run by this process, e.g. "0-3" or "0,2"; empty for all
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'local').lower()  # 'local' (in-process and SQLite) or 'redis' (shared)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = os.getenv('REDIS_KEY_PREFIX', 'discord_chatbot:')
+
+# Mentions to an idle session wait this long for follow-ups before being sent (0 sends at once)
+CHAT_DEBOUNCE_SECONDS = float(os.getenv('CHAT_DEBOUNCE_SECONDS', '0'))
+
+# Cached replies to the first message of a session, opt-in per server
+FIRST_TURN_CACHE_GUILDS = os.getenv('FIRST_TURN_CACHE_GUILDS', '')  # Comma-separated server IDs, or * for all
+FIRST_TURN_CACHE_TTL = float(os.getenv('FIRST_TURN_CACHE_TTL', '3600'))  # Seconds a cached reply stays valid
+FIRST_TURN_CACHE_MAX_ENTRIES = int(os.getenv('FIRST_TURN_CACHE_MAX_ENTRIES', '2000'))
+
+# Metrics and health endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))  # 0 disables the HTTP server
+HEALTH_MAX_LOOP_LAG = float(os.getenv('HEALTH_MAX_LOOP_LAG', '5'))  # Seconds of event-loop lag before /healthz fails
+
+# Gateway connection: lean mode subscribes only to the events the commands use
+LEAN_GATEWAY = os.getenv('LEAN_GATEWAY', 'false').lower() in ('1', 'true', 'yes')  # Drops member and presence intents
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '100'))  # Messages discord.py keeps in lean mode
+MEMBER_NAME_CACHE_SIZE = int(os.getenv('MEMBER_NAME_CACHE_SIZE', '5000'))  # Display names fetched on demand
+
+# Per-channel buffers of recent messages, fed from gateway events
+CHANNEL_BUFFER_SIZE = int(os.getenv('CHANNEL_BUFFER_SIZE', '200'))  # Messages kept per channel
+CHANNEL_BUFFER_MAX_CHANNELS = int(os.getenv('CHANNEL_BUFFER_MAX_CHANNELS', '1000'))
+
+# Generated image cache
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'data/image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))  # Total size of cached images
+IMAGE_CACHE_MAX_AGE = float(os.getenv('IMAGE_CACHE_MAX_AGE', str(7 * 24 * 3600)))  # Seconds before a cached image is regenerated
+
+# Generated image post-processing
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'webp').lower()  # 'webp' or 'jpeg'
+if IMAGE_FORMAT not in OUTPUT_FORMATS:
+    log_event(logging.WARNING, 'invalid_image_format', "Unsupported IMAGE_FORMAT, falling back to webp", image_format=IMAGE_FORMAT)
+    IMAGE_FORMAT = 'webp'
+IMAGE_TARGET_BYTES = int(os.getenv('IMAGE_TARGET_BYTES', str(1024 * 1024)))  # Size re-encoded images aim to stay under
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', '1536'))  # Longest side in pixels
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', '512'))  # Sent when the full image exceeds the upload limit, 0 to disable
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))  # Processes used for re-encoding
+DISCORD_UPLOAD_LIMIT = 10 * 1024 * 1024  # Default upload limit, used outside servers
+
+# Images attached to mentions, passed to Gemini with the message
+ATTACHMENT_MAX_IMAGES = int(os.getenv('ATTACHMENT_MAX_IMAGES', '4'))  # Images read per message, 0 to ignore attachments
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(8 * 1024 * 1024)))  # Largest attachment downloaded
+ATTACHMENT_MAX_MESSAGE_BYTES = int(os.getenv('ATTACHMENT_MAX_MESSAGE_BYTES', str(16 * 1024 * 1024)))  # Total downloaded per message
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.getenv('ATTACHMENT_DOWNLOAD_CONCURRENCY', '4'))  # Downloads in flight across all messages
+ATTACHMENT_DOWNLOAD_TIMEOUT = float(os.getenv('ATTACHMENT_DOWNLOAD_TIMEOUT', '20'))  # Seconds per download
+ATTACHMENT_MAX_DIMENSION = int(os.getenv('ATTACHMENT_MAX_DIMENSION', '768'))  # Longest side sent to Gemini, one 258-token tile
+ATTACHMENT_MAX_PIXELS = 50_000_000  # Larger images are not decoded at all
+ATTACHMENT_IMAGE_TOKENS = 258  # Gemini's cost of one image tile, used for estimates
+ATTACHMENT_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/webp', 'image/gif')
+
+# Streaming replies
+STREAMING_REPLIES = os.getenv('STREAMING_REPLIES', 'true').lower() in ('1', 'true', 'yes')
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))  # Discord allows about 5 edits per 5 seconds per channel
+STREAM_TIMEOUT = float(os.getenv('STREAM_TIMEOUT', '120'))  # Seconds allowed to receive a whole streamed reply
+
+# Gemini quota and request scheduling
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', '60'))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', '1000000'))
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))  # Requests in flight at once
+GEMINI_MAX_QUEUE = int(os.getenv('GEMINI_MAX_QUEUE', '100'))  # Waiting requests before new ones are refused
+CHARS_PER_TOKEN = 3  # Rough average for Vietnamese text, used for estimates only
+
+# Output budgets, derived from how much text each Discord surface can show
+DISCORD_MESSAGE_LIMIT = 2000
+CHAT_MAX_MESSAGES = int(os.getenv('CHAT_MAX_MESSAGES', '3'))  # Discord messages one chat reply may span
+SUMMARY_MAX_MESSAGES = int(os.getenv('SUMMARY_MAX_MESSAGES', '2'))
+SUMMARY_FORMAT_OVERHEAD = 120  # Header and footer around a summary
+CHAT_MAX_OUTPUT_TOKENS = DISCORD_MESSAGE_LIMIT * CHAT_MAX_MESSAGES // CHARS_PER_TOKEN
+SUMMARY_MAX_OUTPUT_TOKENS = (DISCORD_MESSAGE_LIMIT * SUMMARY_MAX_MESSAGES - SUMMARY_FORMAT_OVERHEAD) // CHARS_PER_TOKEN
+
+# Map-reduce summaries of large message windows
+SUMMARY_MESSAGE_LIMIT = int(os.getenv('SUMMARY_MESSAGE_LIMIT', '2000'))  # Most messages one summary may cover
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', '6000'))  # Transcript tokens per map request
+SUMMARY_CHUNK_OUTPUT_TOKENS = int(os.getenv('SUMMARY_CHUNK_OUTPUT_TOKENS', '400'))  # Output budget of each partial summary
+SUMMARY_MAP_CONCURRENCY = int(os.getenv('SUMMARY_MAP_CONCURRENCY', '4'))  # Chunks of one summary summarized at once
+
+# Daily Gemini token budgets over a rolling 24 hours, 0 for no limit
+GUILD_DAILY_TOKEN_BUDGET = int(os.getenv('GUILD_DAILY_TOKEN_BUDGET', '0'))
+USER_DAILY_TOKEN_BUDGET = int(os.getenv('USER_DAILY_TOKEN_BUDGET', '0'))
+TOKEN_BUDGET_DOWNGRADE_AT = float(os.getenv('TOKEN_BUDGET_DOWNGRADE_AT', '0.8'))  # Share of a budget after which requests are downgraded
+DOWNGRADED_CHAT_MAX_OUTPUT_TOKENS = int(os.getenv('DOWNGRADED_CHAT_MAX_OUTPUT_TOKENS', str(CHAT_MAX_OUTPUT_TOKENS // 4)))
+DOWNGRADED_SUMMARY_MESSAGE_LIMIT = int(os.getenv('DOWNGRADED_SUMMARY_MESSAGE_LIMIT', '50'))
+
+# Gemini retries and circuit breaker
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3'))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '1'))  # Seconds, doubled on every retry
+GEMINI_RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '16'))
+GEMINI_ATTEMPT_TIMEOUT = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT', '45'))  # Seconds for a single attempt
+GEMINI_CALL_DEADLINE = float(os.getenv('GEMINI_CALL_DEADLINE', '90'))  # Seconds for all attempts, queueing included
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # Consecutive failures before failing fast
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))  # Seconds before probing a failing upstream again
+
+# Gemini client, imported and configured in the background after login
+genai = None
+model = None
+gemini_init_task = None
+
+def init_gemini():
+    """Import and configure the Gemini client; does nothing once it is ready."""
+    global genai, model, BLOCKED_ERRORS
+    if model is not None:
+        return
+    import google.generativeai as gemini_module
+    gemini_module.configure(api_key=GEMINI_API_KEY)
+    BLOCKED_ERRORS = (gemini_module.types.BlockedPromptException, gemini_module.types.StopCandidateException)
+    genai = gemini_module
+    model = genai.GenerativeModel(MODEL_NAME)
+
+def start_gemini_init():
+    """Start initializing the Gemini client in a worker thread, once."""
+    global gemini_init_task
+    if gemini_init_task is None:
+        gemini_init_task = asyncio.create_task(asyncio.to_thread(init_gemini))
+    return gemini_init_task
+
+async def ensure_gemini():
+    """Wait until the Gemini client is ready, starting its initialization if needed."""
+    global gemini_init_task
+    if model is not None:
+        return
+    try:
+        await asyncio.shield(start_gemini_init())
+    except Exception:
+        gemini_init_task = None  # Let the next call try again
+        raise
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in a piece of text."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def normalize_text(text: str) -> str:
+    """Normalize text for use in cache keys (Unicode form, case and whitespace)."""
+    return ' '.join(unicodedata.normalize('NFC', text).casefold().split())
+
+# Prometheus-style metrics, served as text on /metrics
+class Metric:
+    """A named metric with optional labels, rendered in the Prometheus text format."""
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}  # label values tuple -> value
+        metrics_registry.append(self)
+
+    def _label_text(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield f"{self.name}{self._label_text(values)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), function=None):
+        super().__init__(name, help_text, labels)
+        self.function = function  # Called at scrape time for unlabelled gauges
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def value(self, *label_values) -> float:
+        """Return the current value for the given label values, 0 if it was never set."""
+        if self.function is not None and not label_values:
+            return self.function()
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        if self.function is not None:
+            self._values[()] = self.function()
+        return super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        series = self._values.get(label_values)
+        if series is None:
+            series = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for values, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                bound_label = self._label_text(values, 'le="%s"' % bound)
+                yield f"{self.name}_bucket{bound_label} {bucket_count}"
+            inf_label = self._label_text(values, 'le="+Inf"')
+            yield f"{self.name}_bucket{inf_label} {count}"
+            yield f"{self.name}_sum{self._label_text(values)} {total}"
+            yield f"{self.name}_count{self._label_text(values)} {count}"
+
+metrics_registry = []
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 45, 90)
+DISK_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+gemini_latency = Histogram('gemini_request_seconds', 'Duration of Gemini API calls', ('operation',), LATENCY_BUCKETS)
+gemini_queue_wait = Histogram('gemini_queue_wait_seconds', 'Time Gemini calls waited in the scheduler queue', ('operation',), LATENCY_BUCKETS)
+discord_send_latency = Histogram('discord_send_seconds', 'Duration of Discord message sends and edits', ('kind',), LATENCY_BUCKETS)
+first_reply_latency = Histogram('chat_first_reply_seconds', 'Time from a chat message to the first visible reply', (), LATENCY_BUCKETS)
+blocked_prompts = Counter('gemini_blocked_prompts_total', 'Prompts or responses blocked by Gemini safety filters', ('operation',))
+errors_total = Counter('bot_errors_total', 'Errors by type', ('type',))
+member_fetches = Counter('discord_member_fetches_total', 'Members fetched over REST for a display name')
+event_loop_lag = Gauge('event_loop_lag_seconds', 'How late the event loop ran a periodic timer')
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in metrics_registry) + '\n'
+
+# Priority classes for Gemini requests, most urgent first
+class RequestPriority(Enum):
+    CHAT = 0
+    SUMMARY = 1
+    IMAGE = 2
+
+class GeminiUnavailableError(Exception):
+    """Raised when a Gemini call is refused before reaching the API."""
+
+class SchedulerBusyError(GeminiUnavailableError):
+    """Raised when the Gemini request queue is full, or a call waited in it past its deadline."""
+
+class BudgetExceededError(GeminiUnavailableError):
+    """Raised when a server or user has used up its daily token budget."""
+
+    def __init__(self, scope: str, used: int, budget: int):
+        super().__init__(f"{scope} used {used} of {budget} tokens in the last 24 hours")
+        self.scope = scope
+
+class CircuitOpenError(GeminiUnavailableError):
+    """Raised while the circuit breaker considers Gemini to be down."""
+
+# Token bucket refilled continuously at a per-minute rate
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until the bucket holds the given amount (capped at its capacity)."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate else 0.0
+
+    def consume(self, amount: float):
+        """Take tokens out of the bucket; the balance may go negative to record overspending."""
+        self._refill()
+        self.tokens -= amount
+
+# A Gemini call waiting for its turn
+class ScheduledRequest:
+    __slots__ = ('call', 'priority', 'estimated_tokens', 'enqueued_at', 'future')
+
+    def __init__(self, call, priority, estimated_tokens):
+        self.call = call
+        self.priority = priority
+        self.estimated_tokens = estimated_tokens
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+# Central scheduler that every Gemini call goes through
+class GeminiScheduler:
+    """Admits Gemini calls within the request and token quotas.
+
+    Requests are served by priority class, and round-robin across guilds
+    within a class so one busy server cannot starve the others. When the
+    queue is full, new requests are refused with SchedulerBusyError instead
+    of piling up until everything times out.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int, max_queue: int):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._queues = {priority: OrderedDict() for priority in RequestPriority}  # priority -> guild_id -> deque
+        self._depth = 0
+        self._wakeup = None  # Created with the dispatcher, inside the running event loop
+        self._slots = None
+        self._dispatcher = None
+        self.completed = 0
+        self.rejected = 0
+        self.abandoned = 0
+        self.wait_seconds = {priority: 0.0 for priority in RequestPriority}
+        self.dispatched = {priority: 0 for priority in RequestPriority}
+        self.max_wait_seconds = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    async def submit(self, priority: RequestPriority, guild_id, call, estimated_tokens: int = 0):
+        """Queue a Gemini call and return its result once it has run.
+
+        call is a zero-argument function returning the awaitable to run.
+        """
+        if self._depth >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerBusyError(f"Gemini queue is full ({self._depth} waiting)")
+
+        request = ScheduledRequest(call, priority, estimated_tokens)
+        self._queues[priority].setdefault(guild_id, deque()).append(request)
+        self._depth += 1
+        self._ensure_dispatcher()
+        self._wakeup.set()
+        return await request.future
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._dispatcher = asyncio.create_task(self._dispatch_forever())
+
+    def _next_request(self):
+        """Pop the next request to run, dropping those whose caller has given up."""
+        for priority in RequestPriority:
+            guilds = self._queues[priority]
+            while guilds:
+                guild_id, queue = next(iter(guilds.items()))
+                request = queue.popleft()
+                # Rotate the guild to the back so the next request comes from another server
+                if queue:
+                    guilds.move_to_end(guild_id)
+                else:
+                    del guilds[guild_id]
+                self._depth -= 1
+                if not request.future.done():
+                    return request
+                self.abandoned += 1
+        return None
 
-# Store chat history by (channel_id, user_id)
-chat_sessions = {}
+    async def _dispatch_forever(self):
+        while True:
+            await self._slots.acquire()
+            # Wait for request quota before choosing, so a late urgent request can still go first
+            while self._depth == 0 or self.requests.wait_time(1) > 0:
+                if self._depth == 0:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.sleep(self.requests.wait_time(1))
+            request = self._next_request()
+            if request is None:
+                self._slots.release()  # Only abandoned requests were left
+                continue
+            delay = self.tokens.wait_time(request.estimated_tokens)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if request.future.done():
+                    self.abandoned += 1
+                    self._slots.release()
+                    continue
+            self.requests.consume(1)
+            self.tokens.consume(request.estimated_tokens)
+
+            waited = time.monotonic() - request.enqueued_at
+            gemini_queue_wait.observe(waited, request.priority.name.lower())
+            self.wait_seconds[request.priority] += waited
+            self.dispatched[request.priority] += 1
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            asyncio.create_task(self._run(request))
+
+    async def _run(self, request: ScheduledRequest):
+        started_at = time.monotonic()
+        try:
+            if request.future.done():
+                return  # The caller gave up while waiting
+            call = asyncio.ensure_future(request.call())
+            # Stop the call if its caller gives up, so it no longer holds a slot
+            request.future.add_done_callback(lambda future: call.cancel())
+            result = await call
+            gemini_latency.observe(time.monotonic() - started_at, request.priority.name.lower())
+            # Settle the token bucket with what the call really used
+            usage = getattr(result, 'usage_metadata', None)
+            if usage is not None and usage.total_token_count:
+                self.tokens.consume(usage.total_token_count - request.estimated_tokens)
+            if not request.future.done():
+                request.future.set_result(result)
+        except Exception as e:
+            gemini_latency.observe(time.monotonic() - started_at, request.priority.name.lower())
+            if not request.future.done():
+                request.future.set_exception(e)
+        finally:
+            self.completed += 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        """Return queue depth and wait time metrics."""
+        return {
+            'depth': self._depth,
+            'depth_by_priority': {
+                priority.name: sum(len(queue) for queue in self._queues[priority].values())
+                for priority in RequestPriority
+            },
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'abandoned': self.abandoned,
+            'avg_wait_seconds': {
+                priority.name: self.wait_seconds[priority] / self.dispatched[priority] if self.dispatched[priority] else 0.0
+                for priority in RequestPriority
+            },
+            'max_wait_seconds': self.max_wait_seconds,
+        }
 
-# Store server tone configurations (server_id -> tone_level)
-server_tone_configs = {}
+gemini_scheduler = GeminiScheduler(
+    GEMINI_REQUESTS_PER_MINUTE, GEMINI_TOKENS_PER_MINUTE, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_QUEUE
+)
+
+# Circuit breaker that stops sending traffic to a failing upstream
+class CircuitBreaker:
+    """Fails fast after repeated upstream failures, then probes for recovery.
+
+    closed: calls go through. open: calls fail immediately until the reset
+    timeout has passed. half_open: a single probe call is let through; its
+    outcome closes the circuit again or re-opens it for another interval.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+
+    def allow_request(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'  # This caller becomes the probe
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != 'closed':
+            log_event(logging.INFO, 'circuit_closed', "Gemini circuit closed, upstream has recovered")
+        self.state = 'closed'
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            log_event(logging.WARNING, 'circuit_opened', "Gemini circuit opened", failures=self.failures)
+
+    def release_probe(self):
+        """Let another caller probe when this one never reached the upstream."""
+        if self.state == 'half_open':
+            self.state = 'open'
+
+gemini_circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+# Errors worth retrying: rate limiting, server errors and timeouts
+RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServerError,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+# Errors caused by the content itself, which a retry can never fix (filled in by init_gemini)
+BLOCKED_ERRORS = ()
+
+async def call_gemini(priority: RequestPriority, guild_id, call, estimated_tokens: int = 0, deadline: float = GEMINI_CALL_DEADLINE):
+    """Run a Gemini call through the scheduler, with retries and the circuit breaker.
+
+    Retryable errors are retried up to GEMINI_MAX_RETRIES times with
+    exponential backoff and full jitter, as long as the overall deadline
+    allows it. call is a zero-argument function returning the awaitable.
+    Only the API call itself counts towards the circuit breaker: running out
+    of time while waiting in the scheduler queue is local overload.
+    """
+    give_up_at = time.monotonic() + deadline
+    await ensure_gemini()
+    attempt = 0
+    while True:
+        if not gemini_circuit.allow_request():
+            raise CircuitOpenError("Gemini circuit is open")
+        admitted = False
+
+        def admit():
+            nonlocal admitted
+            admitted = True
+            return asyncio.wait_for(call(), GEMINI_ATTEMPT_TIMEOUT)
+
+        try:
+            try:
+                result = await asyncio.wait_for(
+                    gemini_scheduler.submit(priority, guild_id, admit, estimated_tokens),
+                    timeout=max(0.0, give_up_at - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                if admitted:
+                    raise
+                raise SchedulerBusyError("Gemini call waited in the queue past its deadline") from None
+        except BLOCKED_ERRORS:
+            gemini_circuit.record_success()  # The upstream answered, it just refused the content
+            blocked_prompts.inc(priority.name.lower())
+            raise
+        except GeminiUnavailableError as e:
+            gemini_circuit.release_probe()
+            errors_total.inc(type(e).__name__)
+            raise
+        except RETRYABLE_ERRORS as e:
+            gemini_circuit.record_failure()
+            attempt += 1
+            delay = random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if attempt > GEMINI_MAX_RETRIES or time.monotonic() + delay >= give_up_at:
+                errors_total.inc(type(e).__name__)
+                raise
+            log_event(
+                logging.WARNING, 'gemini_retry', "Gemini call failed, retrying",
+                error=type(e).__name__, attempt=attempt, max_retries=GEMINI_MAX_RETRIES, delay=round(delay, 1)
+            )
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            gemini_circuit.record_success()  # Not an upstream outage, e.g. an invalid request
+            errors_total.inc(type(e).__name__)
+            raise
+        except BaseException:
+            gemini_circuit.release_probe()  # Cancelled, so the upstream's health is still unknown
+            raise
+        gemini_circuit.record_success()
+        return result
+
+# Reply used when a Gemini call was refused before reaching the API
+def unavailable_message(error: GeminiUnavailableError, user_name=None) -> str:
+    user_title = user_name if user_name else "quý ngài/quý cô"
+    if isinstance(error, SchedulerBusyError):
+        return f"Ố dồi ôi, nô tỳ đang phải phục vụ quá nhiều người cùng lúc. {user_title} vui lòng thử lại sau ít phút nhé! 🙏"
+    if isinstance(error, BudgetExceededError):
+        spender = "Server này" if error.scope == 'guild' else user_title
+        return f"Ố dồi ôi, {spender} đã dùng hết hạn mức Gemini của hôm nay rồi. Mong {user_title} quay lại sau nhé! 🙏"
+    return f"Úi giời ơi, Gemini đang gặp sự cố nên nô tỳ tạm thời chưa trả lời được. {user_title} vui lòng thử lại sau ít phút nhé! 🙏"
+
+# Token usage per server and per user, in hourly buckets
+class TokenUsageLedger:
+    """Prompt and completion tokens per guild, per user and per (guild, user).
+
+    Every key holds a small map of hour -> [prompt_tokens, completion_tokens],
+    and buckets older than retention_hours are dropped, so memory stays
+    proportional to the number of active servers and users. Daily budgets are
+    checked against the last 24 buckets.
+    """
+
+    def __init__(self, retention_hours: int = 48):
+        self.retention_hours = retention_hours
+        self._buckets = {}  # (scope, key) -> OrderedDict of hour -> [prompt_tokens, completion_tokens]
+        self._guild_users = {}  # guild_id -> user IDs with usage in that server
+        self._swept_hour = self.current_hour()
+
+    @staticmethod
+    def current_hour() -> int:
+        return int(time.time() // 3600)
+
+    def record(self, guild_id, user_id, prompt_tokens: int, completion_tokens: int):
+        hour = self.current_hour()
+        if hour != self._swept_hour:
+            self._sweep(hour)
+        keys = [('user', user_id)] if user_id is not None else []
+        if guild_id is not None:
+            keys.append(('guild', guild_id))
+            if user_id is not None:
+                keys.append(('member', (guild_id, user_id)))
+                self._guild_users.setdefault(guild_id, set()).add(user_id)
+        for key in keys:
+            buckets = self._buckets.setdefault(key, OrderedDict())
+            counts = buckets.get(hour)
+            if counts is None:
+                counts = buckets[hour] = [0, 0]
+            counts[0] += prompt_tokens
+            counts[1] += completion_tokens
+
+    def usage(self, scope: str, key, hours: int = 24):
+        """Return (prompt_tokens, completion_tokens) over the last hours buckets."""
+        buckets = self._buckets.get((scope, key))
+        if not buckets:
+            return 0, 0
+        oldest = self.current_hour() - hours + 1
+        prompt_tokens = completion_tokens = 0
+        for hour, (prompt, completion) in buckets.items():
+            if hour >= oldest:
+                prompt_tokens += prompt
+                completion_tokens += completion
+        return prompt_tokens, completion_tokens
+
+    def total(self, scope: str, key, hours: int = 24) -> int:
+        return sum(self.usage(scope, key, hours))
+
+    def top_users(self, guild_id, limit: int = 10, hours: int = 24) -> list:
+        """Return the heaviest users of a server as (user_id, prompt_tokens, completion_tokens)."""
+        rows = []
+        for user_id in self._guild_users.get(guild_id, ()):
+            prompt_tokens, completion_tokens = self.usage('member', (guild_id, user_id), hours)
+            if prompt_tokens or completion_tokens:
+                rows.append((user_id, prompt_tokens, completion_tokens))
+        rows.sort(key=lambda row: row[1] + row[2], reverse=True)
+        return rows[:limit]
+
+    def _sweep(self, hour: int):
+        """Drop expired buckets, and keys left without any; runs once an hour."""
+        self._swept_hour = hour
+        oldest = hour - self.retention_hours + 1
+        for key in list(self._buckets):
+            buckets = self._buckets[key]
+            while buckets and next(iter(buckets)) < oldest:
+                buckets.popitem(last=False)
+            if not buckets:
+                del self._buckets[key]
+                if key[0] == 'member':
+                    guild_id, user_id = key[1]
+                    users = self._guild_users.get(guild_id)
+                    if users is not None:
+                        users.discard(user_id)
+                        if not users:
+                            del self._guild_users[guild_id]
+
+    def stats(self) -> dict:
+        return {'keys': len(self._buckets), 'buckets': sum(len(buckets) for buckets in self._buckets.values())}
+
+token_usage = TokenUsageLedger()
+gemini_tokens = Counter('gemini_tokens_total', 'Gemini tokens used, from response usage metadata', ('operation', 'kind'))
+budget_decisions = Counter('token_budget_decisions_total', 'Requests downgraded or rejected by daily token budgets', ('scope', 'action'))
+
+def record_token_usage(operation: str, guild_id, user_id, response):
+    """Account the tokens of a finished Gemini response to its server and user."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_token_count or 0
+    completion_tokens = usage.candidates_token_count or 0
+    token_usage.record(guild_id, user_id, prompt_tokens, completion_tokens)
+    gemini_tokens.inc(operation, 'prompt', amount=prompt_tokens)
+    gemini_tokens.inc(operation, 'completion', amount=completion_tokens)
+
+def check_token_budget(guild_id, user_id) -> bool:
+    """Admit a request against the daily budgets, before it reaches Gemini.
+
+    Raises BudgetExceededError once the server or the user has used its whole
+    budget, and returns True when the request should be downgraded because
+    TOKEN_BUDGET_DOWNGRADE_AT of a budget is used.
+    """
+    downgrade = False
+    for scope, key, budget in (('guild', guild_id, GUILD_DAILY_TOKEN_BUDGET), ('user', user_id, USER_DAILY_TOKEN_BUDGET)):
+        if budget <= 0 or key is None:
+            continue
+        used = token_usage.total(scope, key)
+        if used >= budget:
+            budget_decisions.inc(scope, 'reject')
+            raise BudgetExceededError(scope, used, budget)
+        if used >= budget * TOKEN_BUDGET_DOWNGRADE_AT:
+            budget_decisions.inc(scope, 'downgrade')
+            downgrade = True
+    return downgrade
+
+def estimate_history_bytes(chat) -> int:
+    """Roughly estimate the memory held by a chat session's history."""
+    total = 0
+    try:
+        history = chat.history
+    except Exception:
+        return 0
+    for content in history:
+        for part in content.parts:
+            if part.text:
+                total += len(part.text.encode('utf-8'))
+            elif part.inline_data:
+                total += len(part.inline_data.data)
+    return total
+
+def serialize_session(session: dict) -> bytes:
+    """Encode a session's tone, token estimate and history as compressed JSON."""
+    history = []
+    for content in session['chat'].history:
+        parts = []
+        for part in content.parts:
+            if part.inline_data:
+                parts.append({'inline_data': {
+                    'mime_type': part.inline_data.mime_type,
+                    'data': base64.b64encode(part.inline_data.data).decode('ascii'),
+                }})
+            else:
+                parts.append({'text': part.text})
+        history.append({'role': content.role, 'parts': parts})
+    payload = {
+        'tone_level': session['tone_level'].value,
+        'history_tokens': session.get('history_tokens', 0),
+        'history': history,
+    }
+    return zlib.compress(json.dumps(payload, ensure_ascii=False).encode('utf-8'))
+
+def deserialize_session(data: bytes) -> dict:
+    """Decode serialize_session output into tone_level, history_tokens and a history list for start_chat."""
+    payload = json.loads(zlib.decompress(data).decode('utf-8'))
+    for content in payload['history']:
+        for part in content['parts']:
+            if 'inline_data' in part:
+                part['inline_data']['data'] = base64.b64decode(part['inline_data']['data'])
+    return payload
+
+# On-disk tier for idle chat sessions
+class SessionSpillStore:
+    """Serialized chat sessions kept in SQLite, for idle sessions and across restarts.
+
+    Every call runs on one dedicated worker thread, so writes and deletes are
+    applied in the order they were issued and never block the event loop.
+    Rows hold serialize_session output and the wall-clock time the session
+    was last used, so the idle TTL still applies after a restart.
+    """
+
+    def __init__(self, path: str, idle_ttl: float):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-spill')
+
+    async def run(self, function, *args):
+        """Run one of the blocking methods below on the spill thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def submit(self, function, *args):
+        """Queue a blocking method without waiting for it, logging failures."""
+        def report(future):
+            if not future.cancelled() and future.exception() is not None:
+                log_event(logging.ERROR, 'session_spill_failed', "Error updating spilled chat sessions", exc_info=future.exception())
+        self._executor.submit(function, *args).add_done_callback(report)
+
+    @staticmethod
+    def _row_key(session_key):
+        guild_id, channel_id, user_id = session_key
+        return guild_id or 0, channel_id, user_id  # DMs have no guild
+
+    def open(self) -> int:
+        """Open the database, drop expired sessions and return how many are stored."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions ("
+            "guild_id INTEGER NOT NULL, channel_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "data BLOB NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (guild_id, channel_id, user_id))"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chat_sessions_channel ON chat_sessions (channel_id)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS chat_sessions_last_used ON chat_sessions (last_used)")
+        self._connection.commit()
+        return self.expire()[1]
+
+    def write(self, entries: list) -> int:
+        """Serialize and store (session_key, session, last_used) entries; returns the bytes written."""
+        rows = [self._row_key(session_key) + (serialize_session(session), last_used) for session_key, session, last_used in entries]
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO chat_sessions (guild_id, channel_id, user_id, data, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        return sum(len(row[3]) for row in rows)
+
+    def take(self, session_key):
+        """Remove a stored session and return (data, last_used), or None."""
+        row_key = self._row_key(session_key)
+        with self._connection:
+            row = self._connection.execute(
+                "SELECT data, last_used FROM chat_sessions WHERE guild_id = ? AND channel_id = ? AND user_id = ?", row_key
+            ).fetchone()
+            if row is not None:
+                self._connection.execute(
+                    "DELETE FROM chat_sessions WHERE guild_id = ? AND channel_id = ? AND user_id = ?", row_key
+                )
+        return row
+
+    def delete(self, session_key) -> bool:
+        with self._connection:
+            cursor = self._connection.execute(
+                "DELETE FROM chat_sessions WHERE guild_id = ? AND channel_id = ? AND user_id = ?", self._row_key(session_key)
+            )
+        return cursor.rowcount > 0
+
+    def delete_guild(self, guild_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM chat_sessions WHERE guild_id = ?", (guild_id or 0,))
+
+    def delete_channel(self, channel_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM chat_sessions WHERE channel_id = ?", (channel_id,))
+
+    def expire(self):
+        """Drop sessions idle longer than the TTL; returns (expired, remaining)."""
+        with self._connection:
+            expired = self._connection.execute(
+                "DELETE FROM chat_sessions WHERE last_used < ?", (time.time() - self.idle_ttl,)
+            ).rowcount
+        remaining = self._connection.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0]
+        return expired, remaining
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def shutdown(self):
+        """Let the worker thread exit once queued calls have run."""
+        self._executor.shutdown(wait=False)
+
+session_spill_latency = Histogram('chat_session_spill_seconds', 'Time to serialize and write a batch of chat sessions to disk', (), DISK_LATENCY_BUCKETS)
+session_restore_latency = Histogram('chat_session_restore_seconds', 'Time to load a spilled chat session back into memory', (), DISK_LATENCY_BUCKETS)
+
+# Bounded store for chat sessions
+class SessionStore:
+    """Chat session store with LRU eviction, idle-TTL expiry and a background sweeper.
+
+    Sessions are kept in least-recently-used order, so the oldest entries are
+    always at the front: both eviction and expiry only ever look at the head.
+    Keys are (guild_id, channel_id, user_id) tuples, indexed by guild and by
+    channel so that invalidation only touches the affected sessions.
+
+    With a spill store, sessions that go idle or are evicted move to disk
+    instead of being dropped, and every live session is written there on
+    close. Until a spilled session is written it stays in _spilling, where
+    get() can still find it. Sessions for which in_use(session_key) is true
+    have a request in flight and are never evicted, expired or spilled.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, idle_ttl: float, sweep_interval: float,
+                 spill: SessionSpillStore = None, spill_after: float = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.spill = spill
+        self.spill_after = min(spill_after or idle_ttl, idle_ttl)
+        self._spill_open = False
+        self._spilling = {}  # session_key -> session waiting to be written to disk
+        self.in_use = lambda session_key: False
+        self._spill_task = None
+        self._sessions = OrderedDict()  # session_key -> session dict, least recently used first
+        self._by_guild = {}  # guild_id -> set of session keys
+        self._by_channel = {}  # channel_id -> set of session keys
+        self._total_bytes = 0
+        self._sweeper_task = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.spilled = 0
+        self.restored = 0
+        self.restore_misses = 0
+        self.disk_sessions = 0
+        self._spill_seconds = 0.0
+        self._spill_batches = 0
+        self._restore_seconds = 0.0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_key):
+        return session_key in self._sessions
+
+    def keys(self):
+        """Return a snapshot of the stored session keys."""
+        return list(self._sessions.keys())
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(self, session_key):
+        """Return the session for a key, or None if it is missing or has expired."""
+        session = self._sessions.get(session_key)
+        if session is None and session_key in self._spilling:
+            # Spilled but not yet written: take it back before the write lands
+            session = self._spilling.pop(session_key)
+            self.spill.submit(self.spill.delete, session_key)
+            if time.monotonic() - session['last_used'] <= self.idle_ttl:
+                self.put(session_key, session)
+                self.hits += 1
+                return session
+            self.expirations += 1
+            session = None
+        if session is None:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        if now - session['last_used'] > self.idle_ttl:
+            self._remove(session_key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        session['last_used'] = now
+        self._sessions.move_to_end(session_key)
+        self.hits += 1
+        return session
+
+    def put(self, session_key, session):
+        """Store a session, replacing any existing one for the same key."""
+        self._remove(session_key)
+        session['last_used'] = time.monotonic()
+        session['size'] = estimate_history_bytes(session['chat'])
+        self._sessions[session_key] = session
+        self._total_bytes += session['size']
+        guild_id, channel_id, _ = session_key
+        self._by_guild.setdefault(guild_id, set()).add(session_key)
+        self._by_channel.setdefault(channel_id, set()).add(session_key)
+        self._enforce_limits()
+
+    def touch(self, session_key):
+        """Re-measure a session after its history grew and enforce the store limits."""
+        session = self._sessions.get(session_key)
+        if session is None:
+            return
+        size = estimate_history_bytes(session['chat'])
+        self._total_bytes += size - session['size']
+        session['size'] = size
+        session['last_used'] = time.monotonic()
+        self._sessions.move_to_end(session_key)
+        self._enforce_limits()
+
+    def pop(self, session_key):
+        """Remove and return a session, or None if there was none."""
+        session = self._remove(session_key) or self._spilling.pop(session_key, None)
+        if self._spill_open:
+            self.spill.submit(self.spill.delete, session_key)
+        return session
+
+    async def discard(self, session_key) -> bool:
+        """Remove a session from memory and disk, returning whether one existed."""
+        cleared = (self._remove(session_key) or self._spilling.pop(session_key, None)) is not None
+        if self._spill_open:
+            cleared = await self.spill.run(self.spill.delete, session_key) or cleared
+        return cleared
+
+    def pop_guild(self, guild_id) -> int:
+        """Remove every session in a guild and return how many were removed from memory."""
+        if self._spill_open:
+            self.spill.submit(self.spill.delete_guild, guild_id)
+        pending = [session_key for session_key in self._spilling if session_key[0] == guild_id]
+        return self._remove_all(self._by_guild.get(guild_id)) + self._drop_pending(pending)
+
+    def pop_channel(self, channel_id) -> int:
+        """Remove every session in a channel and return how many were removed from memory."""
+        if self._spill_open:
+            self.spill.submit(self.spill.delete_channel, channel_id)
+        pending = [session_key for session_key in self._spilling if session_key[1] == channel_id]
+        return self._remove_all(self._by_channel.get(channel_id)) + self._drop_pending(pending)
+
+    def _drop_pending(self, session_keys) -> int:
+        for session_key in session_keys:
+            del self._spilling[session_key]
+        return len(session_keys)
+
+    def _remove_all(self, session_keys) -> int:
+        if not session_keys:
+            return 0
+        session_keys = list(session_keys)
+        for session_key in session_keys:
+            self._remove(session_key)
+        return len(session_keys)
+
+    def _remove(self, session_key):
+        session = self._sessions.pop(session_key, None)
+        if session is None:
+            return None
+        self._total_bytes -= session['size']
+        guild_id, channel_id, _ = session_key
+        self._discard_index(self._by_guild, guild_id, session_key)
+        self._discard_index(self._by_channel, channel_id, session_key)
+        return session
+
+    @staticmethod
+    def _discard_index(index, index_key, session_key):
+        session_keys = index.get(index_key)
+        if session_keys is not None:
+            session_keys.discard(session_key)
+            if not session_keys:
+                del index[index_key]
+
+    def _enforce_limits(self):
+        count, total_bytes = len(self._sessions), self._total_bytes
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+        # Never evict the most recently used session, even if it alone exceeds the byte budget,
+        # nor one in use, whose reply would be recorded in a session no longer stored
+        newest = next(reversed(self._sessions))
+        victims = []
+        for session_key, session in self._sessions.items():
+            if session_key == newest or (count <= self.max_entries and total_bytes <= self.max_bytes):
+                break
+            if self.in_use(session_key):
+                continue
+            victims.append(session_key)
+            count -= 1
+            total_bytes -= session['size']
+        for session_key in victims:
+            if self._spill_open:
+                self._spilling[session_key] = self._remove(session_key)
+                self._schedule_spill()
+            else:
+                self._remove(session_key)
+            self.evictions += 1
+
+    def sweep(self) -> int:
+        """Drop every session idle longer than the TTL and queue idle ones for disk."""
+        now = time.monotonic()
+        cutoff = now - self.idle_ttl
+        spill_cutoff = now - self.spill_after
+        stale = []
+        for session_key, session in self._sessions.items():
+            if session['last_used'] > (spill_cutoff if self._spill_open else cutoff):
+                break
+            if not self.in_use(session_key):
+                stale.append((session_key, session['last_used'] <= cutoff))
+        expired = 0
+        for session_key, is_expired in stale:
+            if is_expired:
+                self._remove(session_key)
+                expired += 1
+            else:
+                self._spilling[session_key] = self._remove(session_key)
+        self.expirations += expired
+        if self._spilling:
+            self._schedule_spill()
+        return expired
+
+    def _schedule_spill(self):
+        if self._spill_task is None or self._spill_task.done():
+            self._spill_task = asyncio.create_task(self.flush_spills())
+
+    async def flush_spills(self):
+        """Write the sessions queued in _spilling to disk, in batches.
+
+        Sessions still streaming a reply stay queued until a later sweep.
+        """
+        while self._spill_open:
+            batch = [(session_key, session) for session_key, session in self._spilling.items() if self._settled(session)]
+            if not batch:
+                return
+            # Store wall-clock times, since monotonic ones do not survive a restart
+            offset = time.time() - time.monotonic()
+            entries = [(session_key, session, session['last_used'] + offset) for session_key, session in batch]
+            started_at = time.perf_counter()
+            try:
+                await self.spill.run(self.spill.write, entries)
+            except Exception as e:
+                log_event(logging.ERROR, 'session_spill_failed', "Error writing chat sessions to disk", sessions=len(batch), exc_info=e)
+            else:
+                elapsed = time.perf_counter() - started_at
+                session_spill_latency.observe(elapsed)
+                self._spill_seconds += elapsed
+                self._spill_batches += 1
+                self.spilled += len(batch)
+            for session_key, session in batch:
+                # A session taken back by get() or replaced while the write ran stays as it is
+                if self._spilling.get(session_key) is session:
+                    del self._spilling[session_key]
+
+    @staticmethod
+    def _settled(session) -> bool:
+        try:
+            session['chat'].history
+        except Exception:  # The history cannot be read until a streamed reply completes
+            return False
+        return True
+
+    async def take_spilled(self, session_key):
+        """Remove a spilled session from disk and return its deserialized payload, or None."""
+        if not self._spill_open:
+            return None
+        started_at = time.perf_counter()
+        row = await self.spill.run(self.spill.take, session_key)
+        if row is None:
+            self.restore_misses += 1
+            return None
+        data, last_used = row
+        if time.time() - last_used > self.idle_ttl:
+            self.expirations += 1
+            return None
+        payload = deserialize_session(data)
+        elapsed = time.perf_counter() - started_at
+        session_restore_latency.observe(elapsed)
+        self._restore_seconds += elapsed
+        self.restored += 1
+        return payload
+
+    async def open(self) -> int:
+        """Open the spill store, if there is one, and return how many sessions it holds."""
+        if self.spill is None:
+            return 0
+        self.disk_sessions = await self.spill.run(self.spill.open)
+        self._spill_open = True
+        return self.disk_sessions
+
+    async def close(self):
+        """Stop the sweeper and write every live session to disk."""
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+        if not self._spill_open:
+            return
+        if self._spill_task is not None:
+            await asyncio.gather(self._spill_task, return_exceptions=True)
+        started_at = time.perf_counter()
+        spilled = self.spilled
+        for session_key in list(self._sessions):
+            self._spilling[session_key] = self._remove(session_key)
+        await self.flush_spills()
+        self._spill_open = False
+        await self.spill.run(self.spill.close)
+        self.spill.shutdown()
+        log_event(
+            logging.INFO, 'sessions_snapshotted', "Wrote live chat sessions to disk",
+            sessions=self.spilled - spilled, skipped=len(self._spilling), seconds=round(time.perf_counter() - started_at, 3)
+        )
+
+    def stats(self) -> dict:
+        """Return counters for tuning the store limits."""
+        return {
+            'sessions': len(self._sessions),
+            'bytes': self._total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'pending_spill': len(self._spilling),
+            'spilled': self.spilled,
+            'restored': self.restored,
+            'restore_misses': self.restore_misses,
+            'disk_sessions': self.disk_sessions,
+            'avg_spill_ms': round(self._spill_seconds / self._spill_batches * 1000, 2) if self._spill_batches else 0,
+            'avg_restore_ms': round(self._restore_seconds / self.restored * 1000, 2) if self.restored else 0,
+        }
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.sweep()
+            if self._spill_open:
+                try:
+                    disk_expired, self.disk_sessions = await self.spill.run(self.spill.expire)
+                    expired += disk_expired
+                    self.expirations += disk_expired
+                except Exception as e:
+                    log_event(logging.ERROR, 'session_spill_failed', "Error expiring spilled chat sessions", exc_info=e)
+            if expired:
+                log_event(logging.INFO, 'sessions_expired', "Session sweeper expired idle sessions", expired=expired, **self.stats())
+
+    def start_sweeper(self):
+        """Start the background sweeper if it is not already running."""
+        if self._sweeper_task is None or self._sweeper_task.done():
+            self._sweeper_task = asyncio.create_task(self._sweep_forever())
+
+# Store chat history by (guild_id, channel_id, user_id)
+# Idle sessions spill to disk only for local state; the Redis backend already keeps them
+chat_sessions = SessionStore(
+    SESSION_MAX_ENTRIES, SESSION_MAX_BYTES, SESSION_IDLE_TTL, SESSION_SWEEP_INTERVAL,
+    SessionSpillStore(SESSION_SPILL_DB, SESSION_IDLE_TTL) if SESSION_SPILL_DB and STATE_BACKEND == 'local' else None,
+    SESSION_SPILL_AFTER
+)
+
+# Marker for the rolling summary turn produced by history compaction
+SUMMARY_TURN_PREFIX = "[Tóm tắt cuộc trò chuyện trước đó]"
+
+# Metrics for history compaction
+history_compactions = Counter('chat_history_compactions_total', 'Chat histories folded into a rolling summary')
+compaction_tokens_saved = Counter('chat_history_compaction_tokens_saved_total', 'Prompt tokens removed from chat histories by compaction')
+
+def content_text(content) -> str:
+    """Join the text parts of a chat history entry."""
+    return "".join(part.text for part in content.parts if part.text)
+
+async def compact_session_history(session, guild_id=None, user_id=None):
+    """Fold the oldest turns of a long session into a single rolling summary turn.
+
+    The tone prompt lives in the model's system instruction, so it is never
+    folded, and the last HISTORY_KEEP_TURNS exchanges are always kept word for
+    word. A previous summary turn is simply folded again together with the
+    turns that followed it.
+    """
+    # Cheap gate from the last response's usage metadata before asking for an exact count
+    if session.get('history_tokens', 0) <= HISTORY_TOKEN_BUDGET:
+        return
+
+    chat = session['chat']
+    history = list(chat.history)
+    recent_start = max(0, len(history) - HISTORY_KEEP_TURNS * 2)
+    foldable = history[:recent_start]
+    if len(foldable) < 2:
+        return
+
+    tokens_before = (await call_gemini(
+        RequestPriority.CHAT, guild_id, lambda: chat.model.count_tokens_async(history)
+    )).total_tokens
+    session['history_tokens'] = tokens_before
+    if tokens_before <= HISTORY_TOKEN_BUDGET:
+        return
+
+    transcript = []
+    for content in foldable:
+        speaker = "Trợ lý" if content.role == 'model' else "Người dùng"
+        transcript.append(f"{speaker}: {content_text(content)}")
+
+    summary_prompt = f"""Hãy tóm tắt ngắn gọn đoạn hội thoại sau bằng tiếng Việt để dùng làm ngữ cảnh cho các lượt trò chuyện tiếp theo.
+Giữ lại tên người dùng, các sự kiện, yêu cầu và quyết định quan trọng. Nếu có bản tóm tắt cũ, hãy gộp nó vào bản mới.
+
+{chr(10).join(transcript)}"""
+
+    response = await call_gemini(
+        RequestPriority.CHAT, guild_id, lambda: model.generate_content_async(summary_prompt),
+        estimated_tokens=estimate_tokens(summary_prompt)
+    )
+    record_token_usage('compaction', guild_id, user_id, response)
+    compacted = [
+        {'role': 'user', 'parts': [f"{SUMMARY_TURN_PREFIX}: {response.text}"]},
+        {'role': 'model', 'parts': ["Đã ghi nhớ."]},
+    ] + history[recent_start:]
+    chat.history = compacted
+
+    tokens_after = (await call_gemini(
+        RequestPriority.CHAT, guild_id, lambda: chat.model.count_tokens_async(chat.history)
+    )).total_tokens
+    session['history_tokens'] = tokens_after
+    tokens_saved = tokens_before - tokens_after
+    history_compactions.inc()
+    compaction_tokens_saved.inc(amount=tokens_saved)
+    log_event(
+        logging.INFO, 'history_compacted', "Compacted chat history",
+        entries=len(foldable), tokens_before=tokens_before, tokens_after=tokens_after, tokens_saved=tokens_saved
+    )
 
 # Tone Level Enum
 class ToneLevel(Enum):
@@ -243,137 +1615,1546 @@ class ToneStrategyFactory:
         ToneLevel.NOBLE: NoblePrompt(),
         ToneLevel.FRIENDLY: FriendlyPrompt()
     }
+    # One model per tone, with the tone prompt as its system instruction
+    _models = {}
     
     @classmethod
     def get_strategy(cls, tone_level: ToneLevel) -> PromptBase:
         return cls._strategies.get(tone_level, cls._strategies[ToneLevel.NEUTER])
     
+    @classmethod
+    def get_model(cls, tone_level: ToneLevel) -> 'genai.GenerativeModel':
+        """Get the cached chat model for a tone, building it on first use."""
+        if tone_level not in cls._strategies:
+            tone_level = ToneLevel.NEUTER
+        if tone_level not in cls._models:
+            cls._models[tone_level] = genai.GenerativeModel(
+                MODEL_NAME,
+                system_instruction=cls._strategies[tone_level].get_system_prompt()
+            )
+        return cls._models[tone_level]
+    
     @classmethod
     def get_all_strategies(cls) -> dict:
         return cls._strategies
 
+# Shared state for running several shard processes
+class RedisStateBackend:
+    """Chat sessions and server tones kept in Redis, so any shard process can serve any guild.
+
+    Sessions are stored serialized, with the idle TTL as expiry, and indexed
+    by guild and by channel for invalidation. Tones live in a single hash.
+    Works with any client exposing the redis.asyncio command methods used here.
+    """
+
+    def __init__(self, client, prefix: str, session_ttl: float):
+        self.client = client
+        self.prefix = prefix
+        self.session_ttl = int(session_ttl)
+
+    def _session_key(self, session_key) -> str:
+        guild_id, channel_id, user_id = session_key
+        return f"{self.prefix}session:{guild_id}:{channel_id}:{user_id}"
+
+    async def load_tone_levels(self) -> dict:
+        stored = await self.client.hgetall(f"{self.prefix}tone_levels")
+        return {int(guild_id): int(tone_value) for guild_id, tone_value in stored.items()}
+
+    async def save_tone_levels(self, batch: dict):
+        await self.client.hset(
+            f"{self.prefix}tone_levels", mapping={str(guild_id): tone_level.value for guild_id, tone_level in batch.items()}
+        )
+
+    async def load_session(self, session_key):
+        return await self.client.get(self._session_key(session_key))
+
+    async def save_session(self, session_key, data: bytes):
+        key = self._session_key(session_key)
+        guild_index = f"{self.prefix}sessions:guild:{session_key[0]}"
+        channel_index = f"{self.prefix}sessions:channel:{session_key[1]}"
+        await self.client.set(key, data, ex=self.session_ttl)
+        for index in (guild_index, channel_index):
+            await self.client.sadd(index, key)
+            await self.client.expire(index, self.session_ttl)
+
+    async def delete_session(self, session_key) -> bool:
+        return bool(await self.client.delete(self._session_key(session_key)))
+
+    async def _delete_indexed(self, index: str) -> int:
+        keys = await self.client.smembers(index)
+        return await self.client.delete(index, *keys) - 1 if keys else 0
+
+    async def delete_guild_sessions(self, guild_id) -> int:
+        return await self._delete_indexed(f"{self.prefix}sessions:guild:{guild_id}")
+
+    async def delete_channel_sessions(self, channel_id) -> int:
+        return await self._delete_indexed(f"{self.prefix}sessions:channel:{channel_id}")
+
+    async def close(self):
+        close = getattr(self.client, 'aclose', None) or self.client.close
+        await close()
+
+def create_state_backend():
+    """Return the shared backend selected by STATE_BACKEND, or None for local state."""
+    if STATE_BACKEND == 'local':
+        return None
+    if STATE_BACKEND != 'redis':
+        raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+    if aioredis is None:
+        raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+    return RedisStateBackend(aioredis.from_url(REDIS_URL), REDIS_KEY_PREFIX, SESSION_IDLE_TTL)
+
+state_backend = create_state_backend()
+
+# Durable store for server tone configurations
+class GuildConfigStore:
+    """Server tone configurations cached in memory and persisted to SQLite.
+
+    Reads never touch the disk: the whole table is loaded once at startup.
+    Writes update the cache right away and are flushed to the database in
+    batches from a worker thread, on a timer and at shutdown. With a shared
+    backend, it replaces SQLite and the cache is also refreshed from it on
+    every flush, to pick up changes made by other shard processes.
+    """
+
+    def __init__(self, path: str, flush_interval: float, backend=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.backend = backend
+        self._tone_levels = {}  # guild_id -> ToneLevel
+        self._pending = {}  # guild_id -> ToneLevel not yet written to disk
+        self._connection = None
+        self._flush_lock = None  # Created on first flush, inside the running event loop
+        self._flush_task = None
+
+    def load(self):
+        """Open the database and load every stored configuration into memory."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS guild_configs ("
+            "guild_id INTEGER PRIMARY KEY, tone_level INTEGER NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+        for guild_id, tone_value in self._connection.execute("SELECT guild_id, tone_level FROM guild_configs"):
+            try:
+                self._tone_levels[guild_id] = ToneLevel(tone_value)
+            except ValueError:
+                log_event(logging.WARNING, 'invalid_tone_level', "Ignoring invalid stored tone level", guild_id=guild_id, tone_level=tone_value)
+        log_event(logging.INFO, 'guild_configs_loaded', "Loaded server configurations", count=len(self._tone_levels), path=self.path)
+
+    async def open(self):
+        """Load every stored configuration, from the shared backend or from SQLite."""
+        if self.backend is None:
+            await asyncio.to_thread(self.load)
+        else:
+            await self.refresh()
+            log_event(logging.INFO, 'guild_configs_loaded', "Loaded server configurations", count=len(self._tone_levels), path='shared')
+
+    async def refresh(self):
+        """Reload the configurations from the shared backend, keeping unsaved local changes."""
+        for guild_id, tone_value in (await self.backend.load_tone_levels()).items():
+            if guild_id in self._pending:
+                continue
+            try:
+                self._tone_levels[guild_id] = ToneLevel(tone_value)
+            except ValueError:
+                log_event(logging.WARNING, 'invalid_tone_level', "Ignoring invalid stored tone level", guild_id=guild_id, tone_level=tone_value)
+
+    def get_tone_level(self, guild_id: int, default: ToneLevel) -> ToneLevel:
+        return self._tone_levels.get(guild_id, default)
+
+    def set_tone_level(self, guild_id: int, tone_level: ToneLevel):
+        self._tone_levels[guild_id] = tone_level
+        self._pending[guild_id] = tone_level
+
+    def _write(self, batch: dict):
+        now = time.time()
+        with self._connection:
+            self._connection.executemany(
+                "INSERT INTO guild_configs (guild_id, tone_level, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(guild_id) DO UPDATE SET tone_level = excluded.tone_level, updated_at = excluded.updated_at",
+                [(guild_id, tone_level.value, now) for guild_id, tone_level in batch.items()]
+            )
+
+    async def flush(self):
+        """Write all pending changes to disk without blocking the event loop."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if self.backend is not None:
+                await self._flush_shared()
+                return
+            if not self._pending or self._connection is None:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                log_event(logging.ERROR, 'guild_configs_save_failed', "Error saving server configurations", exc_info=e)
+                # Keep the failed batch for the next flush, unless a newer value was set meanwhile
+                for guild_id, tone_level in batch.items():
+                    self._pending.setdefault(guild_id, tone_level)
+
+    async def _flush_shared(self):
+        batch, self._pending = self._pending, {}
+        try:
+            if batch:
+                await self.backend.save_tone_levels(batch)
+            await self.refresh()
+        except Exception as e:
+            log_event(logging.ERROR, 'guild_configs_save_failed', "Error saving server configurations", exc_info=e)
+            for guild_id, tone_level in batch.items():
+                self._pending.setdefault(guild_id, tone_level)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start_flusher(self):
+        """Start the periodic write-behind flush if it is not already running."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        """Stop the periodic flush, write what is left and close the database."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+# Store server tone configurations (server_id -> tone_level)
+guild_configs = GuildConfigStore(GUILD_CONFIG_DB, GUILD_CONFIG_FLUSH_INTERVAL, state_backend)
+
 # Helper function to get server tone level
 def get_server_tone_level(guild_id: int) -> ToneLevel:
     """Get the tone level for a server, default to NEUTER if not set."""
-    return server_tone_configs.get(guild_id, ToneLevel.NEUTER)
+    return guild_configs.get_tone_level(guild_id, ToneLevel.NEUTER)
 
 # Helper function to set server tone level
 def set_server_tone_level(guild_id: int, tone_level: ToneLevel):
     """Set the tone level for a server."""
-    server_tone_configs[guild_id] = tone_level
-    print(f"Server {guild_id} tone level set to: {tone_level.name}")
+    guild_configs.set_tone_level(guild_id, tone_level)
+    log_event(logging.INFO, 'tone_level_set', "Server tone level set", guild_id=guild_id, tone=tone_level.name)
+
+# Helper function to run a shared-state update in the background
+def run_shared_state_task(coroutine):
+    """Run a state backend call without waiting for it, logging failures."""
+    def report(task):
+        if not task.cancelled() and task.exception() is not None:
+            log_event(logging.ERROR, 'shared_state_failed', "Error updating shared state", exc_info=task.exception())
+    asyncio.create_task(coroutine).add_done_callback(report)
+
+# Helper function to drop every chat session in a server
+def invalidate_guild_sessions(guild_id: int) -> int:
+    """Clear all chat sessions of a server and return how many were cleared locally."""
+    if state_backend is not None:
+        run_shared_state_task(state_backend.delete_guild_sessions(guild_id))
+    return chat_sessions.pop_guild(guild_id)
+
+# Helper function to drop every chat session in a channel
+def invalidate_channel_sessions(channel_id: int) -> int:
+    """Clear all chat sessions of a channel or thread and return how many were cleared locally."""
+    if state_backend is not None:
+        run_shared_state_task(state_backend.delete_channel_sessions(channel_id))
+    return chat_sessions.pop_channel(channel_id)
+
+# Helper function to clear one user's conversation
+async def clear_chat_session(session_key) -> bool:
+    """Clear a chat session, here and in the shared backend. Returns whether one existed."""
+    cleared = await chat_sessions.discard(session_key)
+    if state_backend is not None:
+        cleared = await state_backend.delete_session(session_key) or cleared
+    return cleared
+
+# Helper functions to share chat sessions between shard processes
+async def save_shared_session(session_key, session: dict):
+    """Write a session through to the shared backend, if there is one."""
+    if state_backend is None:
+        return
+    try:
+        await state_backend.save_session(session_key, serialize_session(session))
+    except Exception as e:
+        log_event(logging.ERROR, 'shared_session_save_failed', "Error saving shared chat session", exc_info=e)
+
+async def load_shared_session(session_key):
+    """Rebuild a session stored by any shard process, or return None."""
+    if state_backend is None:
+        return None
+    try:
+        data = await state_backend.load_session(session_key)
+        if data is None:
+            return None
+        session = session_from_payload(deserialize_session(data))
+    except Exception as e:
+        log_event(logging.ERROR, 'shared_session_load_failed', "Error loading shared chat session", exc_info=e)
+        return None
+    chat_sessions.put(session_key, session)
+    return session
+
+# Helper function to bring back a session that was spilled to disk
+async def restore_spilled_session(session_key):
+    """Reload a session from the on-disk tier, or return None."""
+    try:
+        payload = await chat_sessions.take_spilled(session_key)
+        if payload is None:
+            return None
+        session = session_from_payload(payload)
+    except Exception as e:
+        log_event(logging.ERROR, 'session_restore_failed', "Error restoring spilled chat session", exc_info=e)
+        return None
+    chat_sessions.put(session_key, session)
+    return session
+
+def session_from_payload(payload: dict) -> dict:
+    """Build a live chat session from deserialize_session output."""
+    tone_level = ToneLevel(payload['tone_level'])
+    return {
+        'chat': ToneStrategyFactory.get_model(tone_level).start_chat(history=payload['history']),
+        'tone_level': tone_level,
+        'history_tokens': payload['history_tokens'],
+    }
+
+# Embedded HTTP server for /metrics and /healthz
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+async def health_handler(request):
+    if bot.is_closed() or not bot.is_ready():
+        return web.Response(status=503, text="not connected to Discord")
+    if event_loop_lag.value() > HEALTH_MAX_LOOP_LAG:
+        return web.Response(status=503, text="event loop is lagging")
+    return web.Response(text="ok")
+
+async def start_metrics_server():
+    """Serve /metrics and /healthz on METRICS_HOST:METRICS_PORT, and return the runner."""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/healthz', health_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log_event(logging.INFO, 'metrics_server_started', "Serving metrics", host=METRICS_HOST, port=METRICS_PORT)
+    return runner
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Measure how late a periodic sleep wakes up, which is how long the loop was blocked."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.set(max(0.0, loop.time() - started_at - interval))
+
+Gauge('chat_sessions_active', 'Chat sessions held in memory', function=lambda: len(chat_sessions))
+Gauge('discord_guilds', 'Servers the bot is in', function=lambda: len(bot.guilds))
+Gauge('gemini_queue_depth', 'Gemini calls waiting in the scheduler', function=lambda: gemini_scheduler.depth)
+
+# Startup phase timings
+startup_phase_seconds = Gauge('bot_startup_phase_seconds', 'Duration of each startup phase', ('phase',))
+
+class StartupTimer:
+    """Times consecutive startup phases, plus the ones running in the background."""
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.phases = {}
+        self.reported = False
+        self._last = started_at
+
+    def mark(self, phase: str):
+        """Record the time since the previous mark as the duration of phase."""
+        now = time.perf_counter()
+        self.record(phase, now - self._last)
+        self._last = now
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = round(seconds, 3)
+        startup_phase_seconds.set(seconds, phase)
+        if self.reported:
+            log_event(logging.INFO, 'startup_phase', "Background startup phase finished", phase=phase, seconds=round(seconds, 3))
+
+    def report(self):
+        """Log all phases so far, once."""
+        if not self.reported:
+            self.reported = True
+            total = round(time.perf_counter() - self.started_at, 3)
+            log_event(logging.INFO, 'startup_complete', "Startup finished", total_seconds=total, phases=self.phases)
+
+startup_timer = StartupTimer(STARTUP_STARTED_AT)
+
+def command_tree_hash(tree: app_commands.CommandTree, application_id) -> str:
+    """Hash the definitions of all application commands, as they are sent to Discord."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda c: (c.get('type', 1), c['name']))
+    data = json.dumps({'application_id': application_id, 'commands': payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
 
 # Set up Discord bot
-intents = discord.Intents.default()
-intents.message_content = True
-intents.members = True
-intents.presences = True  # Add presence intent
-bot = commands.Bot(command_prefix=BOT_PREFIX, intents=intents)
+def build_gateway_options(lean: bool) -> dict:
+    """Intents and cache settings for the gateway connection.
+
+    Lean mode leaves out presences, member lists and typing events, which are
+    most of the traffic on large servers and are never read by the bot. The
+    members a message or interaction carries are still available.
+    """
+    if not lean:
+        intents = discord.Intents.default()
+        intents.message_content = True
+        intents.members = True
+        intents.presences = True
+        return {'intents': intents}
+    intents = discord.Intents.none()
+    intents.guilds = True  # Servers, channels and roles, needed for permission checks
+    intents.guild_messages = True  # Mentions, prefix commands and channel buffers
+    intents.dm_messages = True  # Prefix commands in DMs
+    intents.message_content = True  # Message text for chat and summaries
+    intents.guild_reactions = True  # Reaction counts in channel buffers
+    intents.dm_reactions = True
+    return {
+        'intents': intents,
+        'member_cache_flags': discord.MemberCacheFlags.none(),
+        'chunk_guilds_at_startup': False,
+        'max_messages': MESSAGE_CACHE_SIZE,
+    }
+
+def parse_shard_ids(value: str):
+    """Parse "0-3" or "0,2,5" into a list of shard IDs, or None when empty."""
+    if not value.strip():
+        return None
+    shard_ids = []
+    for item in value.split(','):
+        first, _, last = item.strip().partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+# Several gateway connections (shards) per process when SHARD_COUNT is set
+SHARDED = bool(SHARD_COUNT)
+shard_options = {}
+if SHARDED:
+    shard_options['shard_ids'] = parse_shard_ids(SHARD_IDS)
+    if SHARD_COUNT != 'auto':
+        shard_options['shard_count'] = int(SHARD_COUNT)
+    elif shard_options['shard_ids'] is not None:
+        raise ValueError("SHARD_IDS needs an explicit SHARD_COUNT, shared by every shard process")
+
+class GeminiBot(commands.AutoShardedBot if SHARDED else commands.Bot):
+    @property
+    def syncs_commands(self) -> bool:
+        """Only one process, the one running shard 0, syncs the global slash commands."""
+        shard_ids = getattr(self, 'shard_ids', None)
+        return not shard_ids or 0 in shard_ids
+
+    async def setup_hook(self):
+        """One-time setup after login, before connecting to the gateway."""
+        startup_timer.mark('login')
+        
+        # The Gemini client and the command sync are not needed to connect
+        self.gemini_init = asyncio.create_task(self.init_gemini_in_background())
+        self.command_sync = asyncio.create_task(self.sync_commands_if_changed()) if self.syncs_commands else None
+        
+        await guild_configs.open()
+        guild_configs.start_flusher()
+        await asyncio.to_thread(image_cache.load)
+        spilled_sessions = await chat_sessions.open()
+        if spilled_sessions:
+            log_event(logging.INFO, 'sessions_on_disk', "Spilled chat sessions will be restored on their next message", sessions=spilled_sessions)
+        startup_timer.mark('state_load')
+        
+        # Start expiring idle chat sessions in the background
+        chat_sessions.start_sweeper()
+        
+        # Expose metrics and health checks
+        self.metrics_runner = await start_metrics_server() if METRICS_PORT else None
+        self.loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+        
+        # Shut down cleanly when the container is stopped
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass  # Signal handlers are not available on Windows
+        
+        # Generate invite link with proper permissions
+        invite_link = discord.utils.oauth_url(
+            self.user.id,
+            permissions=discord.Permissions(
+                administrator=False,  # Don't use admin if not needed
+                send_messages=True,
+                read_messages=True,
+                read_message_history=True,
+                manage_messages=False,
+                embed_links=True,
+                attach_files=True,
+                add_reactions=True
+            ),
+            scopes=["bot", "applications.commands"]  # Include both scopes
+        )
+        log_event(logging.INFO, 'invite_link', "Invite link", url=invite_link)
+        startup_timer.mark('services')
+    
+    async def init_gemini_in_background(self):
+        started_at = time.perf_counter()
+        try:
+            await ensure_gemini()
+        except Exception as e:
+            log_event(logging.ERROR, 'gemini_init_failed', "Failed to initialize the Gemini client", exc_info=e)
+            return
+        startup_timer.record('gemini_init', time.perf_counter() - started_at)
+    
+    async def sync_commands_if_changed(self):
+        """Sync slash commands with Discord, only when their definitions changed since the last sync."""
+        started_at = time.perf_counter()
+        digest = command_tree_hash(self.tree, self.application_id)
+        hash_path = Path(COMMAND_HASH_FILE)
+        try:
+            synced_digest = hash_path.read_text(encoding='utf-8').strip()
+        except OSError:
+            synced_digest = None
+        if digest == synced_digest:
+            log_event(logging.INFO, 'commands_unchanged', "Application commands unchanged, skipping sync")
+        else:
+            try:
+                synced = await self.tree.sync()
+            except Exception as e:
+                log_event(logging.ERROR, 'commands_sync_failed', "Failed to sync commands", exc_info=e)
+                return
+            hash_path.parent.mkdir(parents=True, exist_ok=True)
+            hash_path.write_text(digest + '\n', encoding='utf-8')
+            log_event(logging.INFO, 'commands_synced', "Synced application commands", count=len(synced))
+        startup_timer.record('command_sync', time.perf_counter() - started_at)
+    
+    async def close(self):
+        """Persist pending state before disconnecting."""
+        await guild_configs.close()
+        await chat_sessions.close()
+        if image_pool is not None:
+            image_pool.shutdown(wait=False, cancel_futures=True)
+        if getattr(self, 'metrics_runner', None) is not None:
+            await self.metrics_runner.cleanup()
+        if state_backend is not None:
+            await state_backend.close()
+        if attachment_session is not None:
+            await attachment_session.close()
+        await super().close()
+
+bot = GeminiBot(
+    command_prefix=BOT_PREFIX,
+    activity=discord.Game(name=f"Ô sin phục vụ quý ông/bà chủ"),  # Sent when identifying, on every connection
+    **build_gateway_options(LEAN_GATEWAY),
+    **shard_options
+)
+
+# Replies to common opening questions, shared by new sessions
+class FirstTurnCache:
+    """Cache of first-turn replies, keyed by server, tone and normalized message.
+
+    Only the first message of a session is looked up, since later replies
+    depend on the conversation so far. Entries expire after a TTL and the
+    least recently used are evicted past max_entries. Replies that address
+    the asker by name are not cached, so a reply is always reused verbatim.
+    """
+
+    def __init__(self, enabled_guilds: str, ttl: float, max_entries: int):
+        self.all_guilds = enabled_guilds.strip() == '*'
+        self.guild_ids = {int(guild_id) for guild_id in enabled_guilds.split(',') if guild_id.strip().isdigit()}
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (guild_id, tone_level, text) -> (reply, history_tokens, stored_at)
+        self._guild_stats = {}  # guild_id -> [hits, misses]
+
+    def enabled_for(self, guild_id) -> bool:
+        return guild_id is not None and (self.all_guilds or guild_id in self.guild_ids)
+
+    @staticmethod
+    def cache_key(guild_id, tone_level, message_content: str):
+        return guild_id, tone_level, normalize_text(message_content).rstrip(' ?!.…')
+
+    @staticmethod
+    def mentions_name(reply: str, user_name: str) -> bool:
+        """Whether the reply contains user_name as a whole word, ignoring case."""
+        pattern = r'(?<!\w)' + re.escape(user_name) + r'(?!\w)'
+        return re.search(pattern, reply, re.IGNORECASE) is not None
+
+    def get(self, guild_id, tone_level, message_content: str):
+        """Return (reply, history_tokens), or None."""
+        key = self.cache_key(guild_id, tone_level, message_content)
+        counts = self._guild_stats.setdefault(guild_id, [0, 0])
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[2] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            counts[1] += 1
+            return None
+        self._entries.move_to_end(key)
+        counts[0] += 1
+        return entry[0], entry[1]
+
+    def put(self, guild_id, tone_level, message_content: str, user_name: str, reply: str, history_tokens: int):
+        """Cache a first-turn reply, unless it is personalized for user_name."""
+        if user_name and self.mentions_name(reply, user_name):
+            return
+        key = self.cache_key(guild_id, tone_level, message_content)
+        self._entries[key] = (reply, history_tokens, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop_guild(self, guild_id):
+        for key in [key for key in self._entries if key[0] == guild_id]:
+            del self._entries[key]
+        self._guild_stats.pop(guild_id, None)
+
+    def stats(self) -> dict:
+        """Entry count and hit rate per server."""
+        return {
+            'entries': len(self._entries),
+            'guilds': {
+                guild_id: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+                for guild_id, (hits, misses) in self._guild_stats.items()
+            },
+        }
+
+first_turn_cache = FirstTurnCache(FIRST_TURN_CACHE_GUILDS, FIRST_TURN_CACHE_TTL, FIRST_TURN_CACHE_MAX_ENTRIES)
 
 # Helper function for chat responses
-async def generate_chat_response(message_content, channel_id, author_id, user_name=None, guild_id=None):
-    """Generate a response from Gemini API with context memory and tone configuration."""
-    session_key = (channel_id, author_id)
+async def generate_chat_response(message_content, channel_id, author_id, user_name=None, guild_id=None, on_chunk=None, images=()):
+    """Generate a response from Gemini API with context memory and tone configuration.
+
+    When on_chunk is given the reply is streamed, and on_chunk is awaited with
+    the text received so far after every chunk. images is a list of
+    (image_bytes, mime_type) sent along with the message.
+    """
+    session_key = (guild_id, channel_id, author_id)
     
-    # Get the appropriate tone strategy
+    # Get the appropriate tone level
     tone_level = get_server_tone_level(guild_id) if guild_id else ToneLevel.NEUTER
-    tone_strategy = ToneStrategyFactory.get_strategy(tone_level)
+    
+    # Always include user's name in the message for personalization
+    user_display_name = user_name if user_name else "Unknown"
+    personalized_message = f"[Tin nhắn từ {user_display_name}]: {message_content}"
+    message_parts = [personalized_message] + [{'mime_type': mime_type, 'data': data} for data, mime_type in images]
+    
+    # Daily budgets are checked before anything is sent to Gemini
+    try:
+        downgraded = check_token_budget(guild_id, author_id)
+    except BudgetExceededError as e:
+        return unavailable_message(e, user_name)
+    max_output_tokens = DOWNGRADED_CHAT_MAX_OUTPUT_TOKENS if downgraded else CHAT_MAX_OUTPUT_TOKENS
+    
+    # Chat models are built from the Gemini client, which may still be loading
+    await ensure_gemini()
     
     # Create new chat session if none exists or if tone has changed
-    if session_key not in chat_sessions:
-        # Initialize chat session with the tone-specific system prompt
-        initial_chat = model.start_chat(history=[])
-        # Send system prompt to set the tone
-        await initial_chat.send_message_async(tone_strategy.get_system_prompt())
+    session = chat_sessions.get(session_key)
+    if session is None:
+        session = await restore_spilled_session(session_key)
+    if session is None:
+        session = await load_shared_session(session_key)
+    first_turn = session is None or session['tone_level'] != tone_level
+    if first_turn:
+        # Start from the tone's model, which already carries the system prompt
+        initial_chat = ToneStrategyFactory.get_model(tone_level).start_chat(history=[])
         # Store the chat session
-        chat_sessions[session_key] = {
+        new_session = {
             'chat': initial_chat,
             'tone_level': tone_level
         }
-        print(f"Created new chat session for {session_key} with tone: {tone_level.name}")
+        chat_sessions.put(session_key, new_session)
+        if session is None:
+            log_event(
+                logging.INFO, 'session_created', "Created new chat session",
+                guild_id=guild_id, channel_id=channel_id, user_id=author_id, tone=tone_level.name
+            )
+        else:
+            log_event(
+                logging.INFO, 'session_tone_changed', "Restarted chat session with new tone",
+                guild_id=guild_id, channel_id=channel_id, user_id=author_id, tone=tone_level.name
+            )
+        session = new_session
+        chat = initial_chat
+        
+        # Answer common opening questions from the cache, recording the exchange in the new session
+        if not images and first_turn_cache.enabled_for(guild_id):
+            cached = first_turn_cache.get(guild_id, tone_level, message_content)
+            if cached is not None:
+                reply_text, history_tokens = cached
+                chat.history = [
+                    {'role': 'user', 'parts': [personalized_message]},
+                    {'role': 'model', 'parts': [reply_text]},
+                ]
+                session['history_tokens'] = history_tokens
+                chat_sessions.touch(session_key)
+                await save_shared_session(session_key, session)
+                return reply_text
     else:
-        # Check if tone has changed, if so, recreate the session
-        if chat_sessions[session_key]['tone_level'] != tone_level:
-            # Create new session with updated tone
-            initial_chat = model.start_chat(history=[])
-            await initial_chat.send_message_async(tone_strategy.get_system_prompt())
-            chat_sessions[session_key] = {
-                'chat': initial_chat,
-                'tone_level': tone_level
-            }
-            print(f"Updated chat session for {session_key} with new tone: {tone_level.name}")
-    
-    chat = chat_sessions[session_key]['chat']
+        chat = session['chat']
+        # Keep the resent history within the token budget
+        try:
+            await compact_session_history(session, guild_id, author_id)
+            chat_sessions.touch(session_key)
+        except Exception as e:
+            log_event(
+                logging.ERROR, 'compaction_failed', "Error compacting chat history",
+                exc_info=e, guild_id=guild_id, channel_id=channel_id, user_id=author_id
+            )
+
     try:
-        # Always include user's name in the message for personalization
-        user_display_name = user_name if user_name else "Unknown"
-        personalized_message = f"[Tin nhắn từ {user_display_name}]: {message_content}"
-        
-        response = await chat.send_message_async(personalized_message)
+        stream = on_chunk is not None
+        # The history before this exchange, to fall back to if the stream breaks
+        settled_history = list(chat.history) if stream else None
+        response = await call_gemini(
+            RequestPriority.CHAT, guild_id, lambda: chat.send_message_async(
+                message_parts, stream=stream, generation_config={'max_output_tokens': max_output_tokens}
+            ),
+            estimated_tokens=(
+                session.get('history_tokens', 0) + estimate_tokens(personalized_message) + ATTACHMENT_IMAGE_TOKENS * len(images)
+            )
+        )
+        if stream:
+            async def drain():
+                text = ""
+                async for chunk in response:
+                    if chunk.candidates:
+                        text += content_text(chunk.candidates[0].content)
+                        await on_chunk(text)
+                # Commit the streamed exchange to history; raises if the stream was cut short
+                _ = chat.history
+
+            try:
+                await asyncio.wait_for(drain(), STREAM_TIMEOUT)
+            except BaseException:
+                # Drop the unfinished exchange so the session stays usable. rewind() cannot,
+                # as it needs the response that never finished.
+                chat.history = settled_history
+                raise
+        record_token_usage('chat', guild_id, author_id, response)
+        # Remember roughly how large the history is now, for the compaction gate
+        usage = response.usage_metadata
+        session['history_tokens'] = usage.prompt_token_count + usage.candidates_token_count
+        chat_sessions.touch(session_key)
+        await save_shared_session(session_key, session)
+        if first_turn and not images and first_turn_cache.enabled_for(guild_id):
+            first_turn_cache.put(guild_id, tone_level, message_content, user_display_name, response.text, session['history_tokens'])
         return response.text
+    except GeminiUnavailableError as e:
+        return unavailable_message(e, user_name)
     except Exception as e:
-        print(f"Error calling Gemini API (chat): {e}")
+        log_event(logging.ERROR, 'gemini_chat_failed', "Error calling Gemini API (chat)", exc_info=e, guild_id=guild_id)
         if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback') and e.response.prompt_feedback.block_reason:
             user_title = user_name if user_name else "quý ngài/quý cô"
             return f"Úi giời ơi, em không thể trả lời được vì: {e.response.prompt_feedback.block_reason.name}. {user_title} hãy thử hỏi câu khác ạ! 🙏"
         return "Ố dồi ôi, nô tỳ gặp lỗi khi xử lý yêu cầu. Mong quý ngài thông cảm giúp em nhé! 😔"
 
+# Pending chat messages for one session that will be sent as a single prompt
+class MessageBatch:
+    __slots__ = ('contents', 'runner', 'coalesce', 'closed', 'future')
+
+    def __init__(self, coalesce: bool):
+        self.contents = []
+        self.runner = None
+        self.coalesce = coalesce
+        self.closed = False
+        self.future = asyncio.get_running_loop().create_future()
+
+# Per-session request queue
+class SessionMessageQueue:
+    """Serializes chat requests per session and merges bursts of messages.
+
+    Each session has a FIFO of batches drained by a single worker task, so two
+    requests never run against the same ChatSession at once. A message for an
+    idle session is sent after the debounce window, right away by default;
+    messages that arrive within that window or while a request is in flight
+    join the open batch and are sent as one prompt, and only the latest of
+    them gets the reply.
+    """
+
+    def __init__(self, debounce_seconds: float = 0):
+        self.debounce_seconds = debounce_seconds
+        self._batches = {}  # session_key -> deque of MessageBatch, oldest first
+        self._workers = {}  # session_key -> task draining that deque
+        self.merged_messages = 0
+
+    def is_busy(self, session_key) -> bool:
+        """Whether a request for the session is queued or running."""
+        return session_key in self._workers
+
+    async def submit(self, session_key, content: str, runner, coalesce: bool = True):
+        """Queue a message and wait for the reply.
+
+        runner is called with the merged prompt text. Returns None when the
+        message was merged into a later one, which receives the reply instead.
+        """
+        batches = self._batches.setdefault(session_key, deque())
+        batch = batches[-1] if batches else None
+        if batch is None or batch.closed or not (coalesce and batch.coalesce):
+            batch = MessageBatch(coalesce)
+            batches.append(batch)
+        else:
+            self.merged_messages += 1
+        batch.contents.append(content)
+        batch.runner = runner  # The latest message decides who gets addressed
+        position = len(batch.contents)
+
+        if session_key not in self._workers:
+            self._workers[session_key] = asyncio.create_task(self._drain(session_key))
+
+        await asyncio.wait([batch.future])
+        if position != len(batch.contents):
+            return None
+        return batch.future.result()
+
+    async def _drain(self, session_key):
+        batches = self._batches[session_key]
+        batch = None
+        try:
+            if batches[0].coalesce and self.debounce_seconds > 0:
+                await asyncio.sleep(self.debounce_seconds)  # Let a burst to an idle session gather
+            while batches:
+                batch = batches.popleft()
+                batch.closed = True
+                try:
+                    batch.future.set_result(await batch.runner("\n".join(batch.contents)))
+                except Exception as e:
+                    batch.future.set_exception(e)
+        finally:
+            # If the worker is cancelled, e.g. at shutdown, nobody may be left waiting
+            for pending in [batch, *batches]:
+                if pending is not None and not pending.future.done():
+                    pending.future.cancel()
+            batches.clear()
+            del self._workers[session_key]
+            self._batches.pop(session_key, None)
+
+# Chat requests queued by (guild_id, channel_id, user_id)
+chat_queue = SessionMessageQueue(CHAT_DEBOUNCE_SECONDS)
+chat_sessions.in_use = chat_queue.is_busy  # Keep sessions with a request in flight in memory
+
 # Helper function for image generation
-async def generate_image_from_prompt(prompt, user_name=None):
-    """Generate an image from a text description using Gemini."""
+# Image file extensions by MIME type, for cached images
+IMAGE_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp', 'image/gif': '.gif'}
+
+# Worker processes for image re-encoding, so it never blocks the event loop
+image_pool = None
+
+async def run_in_image_pool(function, *args):
+    """Run a CPU-bound image function in the worker process pool."""
+    global image_pool
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(image_pool, function, *args)
+
+class ImageCache:
+    """Generated images stored on disk, keyed by a hash of the model and normalized prompt.
+
+    The cache is an LRU bounded by total size and by age. Concurrent requests
+    for the same prompt share one upstream call, and hits are returned as file
+    paths so the image is streamed from disk instead of being read into memory.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()  # key -> (path, size, created_at), least recently used first
+        self._total_bytes = 0
+        self._inflight = {}  # key -> task generating that image
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def cache_key(self, prompt: str) -> str:
+        return hashlib.sha256(f"{MODEL_NAME}\n{normalize_text(prompt)}".encode('utf-8')).hexdigest()
+
+    def load(self):
+        """Index the images already on disk, oldest first, and drop leftovers."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.iterdir():
+            if path.suffix == '.tmp':
+                path.unlink(missing_ok=True)  # Interrupted write
+                continue
+            stat = path.stat()
+            files.append((stat.st_mtime, path, stat.st_size))
+        for created_at, path, size in sorted(files):
+            self._entries[path.stem] = (path, size, created_at)
+            self._total_bytes += size
+        log_event(logging.INFO, 'image_cache_loaded', "Loaded cached images", count=len(self._entries), directory=str(self.directory))
+        self._evict()
+
+    async def get_or_generate(self, prompt: str, generate):
+        """Return the cached image path for prompt, or run generate() to create it.
+
+        generate must return (image_bytes, mime_type) to be cached; any other
+        result (e.g. a block reason) is passed through as is and not cached.
+        """
+        key = self.cache_key(prompt)
+        path = self._fresh_path(key)
+        if path is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return path
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fill(key, generate))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so one caller giving up does not cancel the request for the others
+        return await asyncio.shield(task)
+
+    def is_cached(self, prompt: str) -> bool:
+        """Whether an image for prompt can be served without calling Gemini."""
+        return self._fresh_path(self.cache_key(prompt)) is not None
+
+    def _fresh_path(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        path, size, created_at = entry
+        if time.time() - created_at <= self.max_age and path.exists():
+            return path
+        self._remove(key)
+        return None
+
+    async def _fill(self, key: str, generate):
+        result = await generate()
+        if not isinstance(result, tuple):
+            return result
+        data, mime_type = result
+        path = self.directory / f"{key}{IMAGE_EXTENSIONS.get(mime_type, '.img')}"
+        if len(data) > self.max_bytes:
+            return data  # Too large to cache, send it from memory
+        await asyncio.to_thread(self._write, path, data)
+        self._entries[key] = (path, len(data), time.time())
+        self._total_bytes += len(data)
+        self._evict()
+        return path
+
+    def _write(self, path: Path, data: bytes):
+        # Write to a temporary file first so a crash never leaves a truncated image behind
+        self.directory.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix('.tmp')
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+
+    def _remove(self, key: str):
+        path, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        # An image being uploaded stays readable: its file is already open
+        path.unlink(missing_ok=True)
+
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            key, (_, _, created_at) = next(iter(self._entries.items()))
+            if self._total_bytes <= self.max_bytes and now - created_at <= self.max_age:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self._total_bytes,
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+        }
+
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_MAX_AGE)
+
+async def request_image(image_prompt: str, guild_id=None, user_id=None):
+    """Ask Gemini for one image. Returns (image_bytes, mime_type), the block reason name, or None."""
+    response = await call_gemini(
+        RequestPriority.IMAGE, guild_id, lambda: model.generate_content_async(image_prompt),
+        estimated_tokens=estimate_tokens(image_prompt)
+    )
+    record_token_usage('image', guild_id, user_id, response)
+    
+    # Extract image data from response
+    for part in response.parts:
+        if part.inline_data and part.inline_data.mime_type.startswith('image/'):
+            return part.inline_data.data, part.inline_data.mime_type
+    
+    if response.prompt_feedback and response.prompt_feedback.block_reason:
+        blocked_prompts.inc('image')
+        return response.prompt_feedback.block_reason.name
+    return None
+
+async def render_image(image_prompt: str, guild_id=None, user_id=None):
+    """Request an image and re-encode it to the configured format and size."""
+    result = await request_image(image_prompt, guild_id, user_id)
+    if isinstance(result, tuple):
+        data, _ = result
+        try:
+            result = await run_in_image_pool(process_image, data, IMAGE_FORMAT, IMAGE_TARGET_BYTES, IMAGE_MAX_DIMENSION)
+        except Exception as e:
+            # Still send the original image if re-encoding fails
+            log_event(logging.ERROR, 'image_reencode_failed', "Error re-encoding image", exc_info=e)
+            image_format = sniff_image_format(data)
+            result = data, MIME_TYPES.get(image_format, 'application/octet-stream')
+    return result
+
+async def generate_image_from_prompt(prompt, user_name=None, guild_id=None, user_id=None):
+    """Generate an image from a text description using Gemini.
+
+    Returns the path of the (cached) image file, the image bytes when it is
+    too large to cache, an error message string, or None.
+    """
     try:
         # Clear instruction for image generation with Vietnamese flavor
         image_prompt = f"Tạo một hình ảnh chi tiết dựa trên mô tả sau: \"{prompt}\". Chỉ trả về dữ liệu hình ảnh."
-        response = await model.generate_content_async(image_prompt)
+        # Cached images cost nothing; anyone else, including callers joining an in-flight request, needs budget left
+        if not image_cache.is_cached(prompt):
+            check_token_budget(guild_id, user_id)
+        result = await image_cache.get_or_generate(prompt, lambda: render_image(image_prompt, guild_id, user_id))
         
-        # Extract image data from response
-        for part in response.parts:
-            if part.inline_data and part.inline_data.mime_type.startswith('image/'):
-                return part.inline_data.data
-                
         # Handle cases where no image was generated
-        if response.prompt_feedback and response.prompt_feedback.block_reason:
+        if isinstance(result, str):
             user_address = f"{user_name}" if user_name else "quý ngài/quý cô"
-            return f"Ối dồi ôi, nô tỳ không thể tạo ảnh được. Yêu cầu bị chặn vì: {response.prompt_feedback.block_reason.name}. {user_address} thông cảm giúp em nhé! 😔"
-        return None
+            return f"Ối dồi ôi, nô tỳ không thể tạo ảnh được. Yêu cầu bị chặn vì: {result}. {user_address} thông cảm giúp em nhé! 😔"
+        return result
+    except GeminiUnavailableError as e:
+        return unavailable_message(e, user_name)
     except Exception as e:
-        print(f"Error calling Gemini API (image): {e}")
+        log_event(logging.ERROR, 'gemini_image_failed', "Error calling Gemini API (image)", exc_info=e, guild_id=guild_id)
         user_address = f"{user_name}" if user_name else "quý ngài/quý cô"
         return f"Ố dồi ôi, em không thể tạo ảnh ngay lúc này. {user_address} thông cảm giúp nô tỳ nhé! 😔"
 
+async def image_file_from_result(image_data, upload_limit: int) -> discord.File:
+    """Wrap a generated image (cached file path or raw bytes) for upload.
+
+    When the image is larger than upload_limit, a thumbnail is sent instead.
+    """
+    size = image_data.stat().st_size if isinstance(image_data, Path) else len(image_data)
+    if size > upload_limit and IMAGE_THUMBNAIL_SIZE > 0:
+        data = await asyncio.to_thread(image_data.read_bytes) if isinstance(image_data, Path) else image_data
+        thumbnail, mime_type = await run_in_image_pool(make_thumbnail, data, IMAGE_THUMBNAIL_SIZE, IMAGE_FORMAT)
+        return discord.File(io.BytesIO(thumbnail), filename=f"generated_image{IMAGE_EXTENSIONS[mime_type]}")
+    if isinstance(image_data, Path):
+        return discord.File(image_data, filename=f"generated_image{image_data.suffix}")
+    extension = IMAGE_EXTENSIONS.get(MIME_TYPES.get(sniff_image_format(image_data)), '.png')
+    return discord.File(io.BytesIO(image_data), filename=f"generated_image{extension}")
+
+# Images attached to mentions, downloaded with size caps and downscaled for Gemini
+attachment_session = None  # aiohttp session, created on first use
+attachment_slots = None  # Limits downloads in flight, created inside the running event loop
+attachment_results = Counter('chat_attachments_total', 'Image attachments on mentions by outcome', ('result',))
+attachment_bytes = Counter('chat_attachment_bytes_total', 'Bytes of image attachments downloaded and sent to Gemini', ('stage',))
+
+class AttachmentTooLargeError(Exception):
+    """Raised when a download grows past its byte cap."""
+
+def is_image_attachment(attachment) -> bool:
+    content_type = (attachment.content_type or '').split(';')[0].strip().lower()
+    return content_type in ATTACHMENT_CONTENT_TYPES
+
+async def download_attachment(attachment, max_bytes: int) -> bytes:
+    """Stream an attachment from Discord's CDN, giving up as soon as it passes max_bytes."""
+    global attachment_session, attachment_slots
+    if attachment_session is None or attachment_session.closed:
+        attachment_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=ATTACHMENT_DOWNLOAD_TIMEOUT))
+    if attachment_slots is None:
+        attachment_slots = asyncio.Semaphore(ATTACHMENT_DOWNLOAD_CONCURRENCY)
+    async with attachment_slots:
+        async with attachment_session.get(attachment.url) as response:
+            response.raise_for_status()
+            if response.content_length is not None and response.content_length > max_bytes:
+                raise AttachmentTooLargeError(f"{response.content_length} bytes, limit {max_bytes}")
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > max_bytes:
+                    raise AttachmentTooLargeError(f"more than {max_bytes} bytes")
+    return bytes(data)
+
+async def load_message_images(message) -> list:
+    """Download and downscale the image attachments of a message.
+
+    Declared type and size are checked before anything is downloaded, and
+    the total downloaded per message is capped by ATTACHMENT_MAX_MESSAGE_BYTES.
+    Returns a list of (image_bytes, mime_type); skipped attachments are logged.
+    """
+    selected = []
+    remaining = ATTACHMENT_MAX_MESSAGE_BYTES
+    for attachment in message.attachments:
+        if not is_image_attachment(attachment):
+            continue
+        if len(selected) >= ATTACHMENT_MAX_IMAGES:
+            reason = 'too_many'
+        elif attachment.size > min(ATTACHMENT_MAX_BYTES, remaining):
+            reason = 'too_large'
+        else:
+            remaining -= attachment.size
+            selected.append(attachment)
+            continue
+        attachment_results.inc(reason)
+        log_event(
+            logging.INFO, 'attachment_skipped', "Skipped image attachment",
+            reason=reason, size=attachment.size, message_id=message.id
+        )
+
+    async def load(attachment):
+        try:
+            # Discord reports the exact size, so the download may never be larger
+            data = await download_attachment(attachment, attachment.size)
+        except (aiohttp.ClientError, asyncio.TimeoutError, AttachmentTooLargeError) as e:
+            attachment_results.inc('failed')
+            log_event(logging.WARNING, 'attachment_failed', "Error downloading image attachment", exc_info=e, message_id=message.id)
+            return None
+        attachment_bytes.inc('downloaded', amount=len(data))
+        try:
+            prepared = await run_in_image_pool(prepare_input_image, data, ATTACHMENT_MAX_DIMENSION, ATTACHMENT_MAX_PIXELS)
+        except Exception as e:
+            attachment_results.inc('failed')
+            log_event(logging.ERROR, 'attachment_processing_failed', "Error downscaling image attachment", exc_info=e, message_id=message.id)
+            return None
+        if prepared is None:
+            attachment_results.inc('undecodable')
+            return None
+        attachment_results.inc('used')
+        attachment_bytes.inc('sent', amount=len(prepared[0]))
+        return prepared
+
+    results = await asyncio.gather(*(load(attachment) for attachment in selected))
+    return [result for result in results if result is not None]
+
+# Compact copy of a channel message, with just what a summary needs
+class BufferedMessage:
+    __slots__ = ('id', 'author_id', 'author_name', 'created_at', 'content', 'attachments', 'has_embeds', 'reactions')
+
+    def __init__(self, message_id, author_id, author_name, created_at, content, attachments, has_embeds, reactions):
+        self.id = message_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.created_at = created_at  # POSIX timestamp
+        self.content = content
+        self.attachments = attachments  # Tuple of file names
+        self.has_embeds = has_embeds
+        self.reactions = reactions  # Tuple of (emoji, count) pairs
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            message.id,
+            message.author.id,
+            message.author.display_name,
+            message.created_at.timestamp(),
+            message.content,
+            tuple(att.filename for att in message.attachments),
+            bool(message.embeds),
+            tuple((str(reaction.emoji), reaction.count) for reaction in message.reactions)
+        )
+
+    def add_reaction(self, emoji: str, delta: int):
+        counts = dict(self.reactions)
+        counts[emoji] = counts.get(emoji, 0) + delta
+        self.reactions = tuple((name, count) for name, count in counts.items() if count > 0)
+
+# Display names of message authors, fetched on demand since members are not cached
+class MemberNameCache:
+    """Small LRU of (guild ID, user ID) -> display name."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._names = OrderedDict()
+
+    def remember(self, guild_id, user_id, name: str):
+        key = (guild_id, user_id)
+        self._names[key] = name
+        self._names.move_to_end(key)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
+
+    async def display_name(self, message) -> str:
+        """Return the author's server display name, fetching the member if it is not known."""
+        author, guild = message.author, message.guild
+        if guild is None or message.webhook_id is not None:
+            return author.display_name
+        if isinstance(author, discord.Member):
+            self.remember(guild.id, author.id, author.display_name)
+            return author.display_name
+        key = (guild.id, author.id)
+        if key in self._names:
+            self._names.move_to_end(key)
+            return self._names[key]
+        member = guild.get_member(author.id)
+        if member is None:
+            member_fetches.inc()
+            try:
+                member = await guild.fetch_member(author.id)
+            except discord.HTTPException:
+                member = None  # Left the server
+        name = member.display_name if member is not None else author.display_name
+        self.remember(guild.id, author.id, name)
+        return name
+
+    def pop_guild(self, guild_id):
+        for key in [key for key in self._names if key[0] == guild_id]:
+            del self._names[key]
+
+member_names = MemberNameCache(MEMBER_NAME_CACHE_SIZE)
+
+# Ring buffer of one channel's recent messages, oldest first
+class ChannelMessageBuffer:
+    __slots__ = ('guild_id', 'records', 'by_id')
+
+    def __init__(self, guild_id, size: int):
+        self.guild_id = guild_id
+        self.records = deque(maxlen=size)
+        self.by_id = {}
+
+    def append(self, record: BufferedMessage):
+        if record.id in self.by_id:
+            return
+        if len(self.records) == self.records.maxlen:
+            del self.by_id[self.records[0].id]
+        self.records.append(record)
+        self.by_id[record.id] = record
+
+    def backfill(self, older_records: list):
+        """Prepend messages fetched over REST (newest first) that are older than the buffer."""
+        for record in older_records:
+            if len(self.records) == self.records.maxlen:
+                break
+            if record.id in self.by_id or (self.records and record.id > self.records[0].id):
+                continue
+            self.records.appendleft(record)
+            self.by_id[record.id] = record
+
+    def get(self, message_id):
+        return self.by_id.get(message_id)
+
+    def remove(self, message_id):
+        record = self.by_id.pop(message_id, None)
+        if record is not None:
+            self.records.remove(record)
+
+# Message buffers for the most recently active channels
+class ChannelBufferStore:
+    """Per-channel message buffers, bounded in both messages and channels.
+
+    A buffer only ever holds a contiguous run of a channel's latest messages,
+    so anything older than its first record has to come from channel.history.
+    """
+
+    def __init__(self, buffer_size: int, max_channels: int):
+        self.buffer_size = buffer_size
+        self.max_channels = max_channels
+        self._buffers = OrderedDict()  # channel_id -> ChannelMessageBuffer, least recently used first
+
+    def get(self, channel_id):
+        return self._buffers.get(channel_id)
+
+    def get_or_create(self, channel_id, guild_id) -> ChannelMessageBuffer:
+        buffer = self._buffers.get(channel_id)
+        if buffer is None:
+            buffer = self._buffers[channel_id] = ChannelMessageBuffer(guild_id, self.buffer_size)
+            if len(self._buffers) > self.max_channels:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(channel_id)
+        return buffer
+
+    def record(self, message):
+        """Append a newly received message to its channel's buffer."""
+        guild_id = message.guild.id if message.guild else None
+        self.get_or_create(message.channel.id, guild_id).append(BufferedMessage.from_message(message))
+
+    def drop_channel(self, channel_id):
+        self._buffers.pop(channel_id, None)
+
+    def drop_guild(self, guild_id):
+        for channel_id in [channel_id for channel_id, buffer in self._buffers.items() if buffer.guild_id == guild_id]:
+            del self._buffers[channel_id]
+
+    def clear(self):
+        self._buffers.clear()
+
+    def stats(self) -> dict:
+        return {
+            'channels': len(self._buffers),
+            'messages': sum(len(buffer.records) for buffer in self._buffers.values()),
+        }
+
+channel_buffers = ChannelBufferStore(CHANNEL_BUFFER_SIZE, CHANNEL_BUFFER_MAX_CHANNELS)
+
+# Reply that is posted on the first streamed chunk and edited as more text arrives
+class StreamingReply:
+    CURSOR = " ▌"
+
+    def __init__(self, send):
+        self._send = send  # Coroutine function that posts a message and returns it
+        self.message = None
+        self._last_edit = 0.0
+        self._started_at = time.monotonic()
+
+    async def _post(self, content: str):
+        started_at = time.monotonic()
+        self.message = await self._send(content)
+        discord_send_latency.observe(time.monotonic() - started_at, 'send')
+        first_reply_latency.observe(time.monotonic() - self._started_at)
+
+    async def _edit(self, content: str):
+        started_at = time.monotonic()
+        await self.message.edit(content=content)
+        discord_send_latency.observe(time.monotonic() - started_at, 'edit')
+
+    async def update(self, text: str):
+        """Show partial text, editing at most once per STREAM_EDIT_INTERVAL."""
+        now = time.monotonic()
+        if self.message is not None and now - self._last_edit < STREAM_EDIT_INTERVAL:
+            return
+        preview = text + self.CURSOR
+        if len(preview) > 2000:
+            preview = preview[:1990] + "..."
+        try:
+            if self.message is None:
+                await self._post(preview)
+            else:
+                await self._edit(preview)
+            self._last_edit = now
+        except discord.HTTPException as e:
+            log_event(logging.WARNING, 'stream_update_failed', "Error updating streamed reply", error=str(e))
+
+    async def finish(self, parts: list):
+        """Show the final reply, in place of the streamed message if one was posted.
+
+        parts are Discord-sized messages, as returned by split_reply; the
+        ones after the first are sent as new messages in order.
+        """
+        first, rest = parts[0], parts[1:]
+        if self.message is None:
+            await self._post(first)
+        else:
+            await self._edit(first)
+        for part in rest:
+            started_at = time.monotonic()
+            await self._send(part)
+            discord_send_latency.observe(time.monotonic() - started_at, 'send')
+
+# Output that did not fit on Discord, per surface
+output_waste_stats = {}
+
+FENCE_MARKER = "```"
+LIST_ITEM_PATTERN = re.compile(r'\s*([-*+•]|\d+[.)])\s')
+
+def _wrap_long_line(line: str, width: int) -> list:
+    """Cut a line longer than width, preferring to cut at a space."""
+    pieces = []
+    while len(line) > width:
+        cut = line.rfind(' ', width // 2, width)
+        if cut == -1:
+            cut = width
+        pieces.append(line[:cut])
+        line = line[cut:].lstrip(' ')
+    pieces.append(line)
+    return pieces
+
+def split_discord_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    """Split a long text into Discord-sized messages without breaking its markdown.
+
+    Breaks go between paragraphs if possible, then before list items or
+    headings, then between lines, and outside code blocks rather than inside.
+    A code block that has to be cut is closed at the end of one message and
+    reopened, with its language, at the start of the next.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    budget = limit - len(FENCE_MARKER) - 1  # Always leave room to close a code block
+    lines = []  # (line, opening fence line if the line is inside a code block)
+    fence = None
+    for raw_line in text.split('\n'):
+        for line in _wrap_long_line(raw_line, budget - 100):
+            is_fence = line.lstrip().startswith(FENCE_MARKER)
+            lines.append((line, fence))
+            if is_fence:
+                fence = None if fence else line.strip()
+
+    def break_score(index: int) -> int:
+        line, line_fence = lines[index]
+        if line_fence:
+            return 1
+        previous = lines[index - 1][0]
+        if not line.strip() or not previous.strip():
+            return 4
+        if LIST_ITEM_PATTERN.match(line) or line.startswith('#'):
+            return 3
+        return 2
+
+    parts = []
+    start = 0
+    while start < len(lines):
+        reopen = lines[start][1]
+        size = len(reopen) + 1 if reopen else 0
+        end = start
+        while end < len(lines):
+            added = len(lines[end][0]) + (1 if end > start or reopen else 0)
+            if size + added > budget:
+                break
+            size += added
+            end += 1
+
+        if end == len(lines):
+            split_at = end
+        else:
+            # Best break in the second half of the message, latest one on ties
+            candidates = range(max(start + 1, (start + end) // 2), end + 1)
+            split_at = max(candidates, key=lambda index: (break_score(index), index))
+
+        part_lines = ([reopen] if reopen else []) + [line for line, _ in lines[start:split_at]]
+        if split_at < len(lines) and lines[split_at][1]:
+            part_lines.append(FENCE_MARKER)
+        part = '\n'.join(part_lines).strip('\n')
+        if part.strip():
+            parts.append(part)
+
+        start = split_at
+        while start < len(lines) and not lines[start][0].strip() and not lines[start][1]:
+            start += 1
+    return parts
+
+def _fence_is_open(text: str) -> bool:
+    return sum(1 for line in text.split('\n') if line.lstrip().startswith(FENCE_MARKER)) % 2 == 1
+
+def mark_truncated(part: str, limit: int = DISCORD_MESSAGE_LIMIT) -> str:
+    """End a message with an ellipsis within limit, closing a code block the cut leaves open."""
+    cut = part[:limit - 3]
+    if _fence_is_open(cut):
+        cut = part[:limit - len(FENCE_MARKER) - 5]
+        if _fence_is_open(cut):
+            return f"{cut}\n{FENCE_MARKER}\n..."
+    return cut + "..."
+
+def split_reply(text: str, surface: str, max_messages: int, old_limit: int) -> list:
+    """Split a reply into at most max_messages Discord messages and record wasted output.
+
+    old_limit is where the reply used to be cut off, so the stats show how
+    much generated text was thrown away before and after splitting.
+    """
+    parts = split_discord_message(text)
+    kept = parts[:max_messages]
+    if len(parts) > max_messages:
+        kept[-1] = mark_truncated(kept[-1])
+
+    stats = output_waste_stats.setdefault(surface, {
+        'replies': 0, 'generated_chars': 0, 'wasted_chars_before': 0, 'wasted_chars_after': 0
+    })
+    stats['replies'] += 1
+    stats['generated_chars'] += len(text)
+    stats['wasted_chars_before'] += max(0, len(text) - old_limit)
+    stats['wasted_chars_after'] += max(0, len(text) - sum(len(part) for part in kept))
+    return kept
+
 @bot.event
 async def on_ready():
-    """Called when the bot has successfully connected to Discord."""
-    print(f'Logged in as: {bot.user.name}')
-    print(f'Bot ID: {bot.user.id}')
-    print('Bot is ready!')
-    
-    # Generate invite link with proper permissions
-    invite_link = discord.utils.oauth_url(
-        bot.user.id,
-        permissions=discord.Permissions(
-            administrator=False,  # Don't use admin if not needed
-            send_messages=True,
-            read_messages=True,
-            read_message_history=True,
-            manage_messages=False,
-            embed_links=True,
-            attach_files=True,
-            add_reactions=True
-        ),
-        scopes=["bot", "applications.commands"]  # Include both scopes
+    """Called when the bot has connected to Discord, again after every reconnect.
+
+    One-time setup lives in GeminiBot.setup_hook.
+    """
+    log_event(
+        logging.INFO, 'ready', "Bot is ready",
+        user=bot.user.name, user_id=bot.user.id, shard_ids=getattr(bot, 'shard_ids', None), shard_count=bot.shard_count
     )
     
-    print(f"Invite link: {invite_link}")
+    # Messages may have been missed while disconnected, so buffers can no longer be trusted
+    channel_buffers.clear()
     
-    # Sync slash commands with Discord
-    try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
-    except Exception as e:
-        print(f"Failed to sync commands: {e}")
-    
-    await bot.change_presence(activity=discord.Game(name=f"Ô sin phục vụ quý ông/bà chủ"))
+    if not startup_timer.reported:
+        startup_timer.mark('gateway_connect')
+        startup_timer.report()
+
+@bot.event
+async def on_guild_remove(guild):
+    """Drop the chat sessions of a server the bot was removed from."""
+    channel_buffers.drop_guild(guild.id)
+    first_turn_cache.pop_guild(guild.id)
+    member_names.pop_guild(guild.id)
+    cleared = invalidate_guild_sessions(guild.id)
+    log_event(logging.INFO, 'guild_removed', "Removed from server", guild_id=guild.id, sessions_cleared=cleared)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Drop the chat sessions of a deleted channel."""
+    channel_buffers.drop_channel(channel.id)
+    cleared = invalidate_channel_sessions(channel.id)
+    log_event(logging.INFO, 'channel_deleted', "Channel deleted", channel_id=channel.id, sessions_cleared=cleared)
+
+@bot.event
+async def on_raw_thread_delete(payload):
+    """Drop the chat sessions of a deleted thread, even if it was not cached."""
+    channel_buffers.drop_channel(payload.thread_id)
+    invalidate_channel_sessions(payload.thread_id)
+
+# Keep the channel message buffers in step with edits, deletions and reactions.
+# Raw events are used so that messages missing from discord.py's cache are updated too.
+@bot.event
+async def on_raw_message_edit(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    record = buffer.get(payload.message_id) if buffer else None
+    if record is None:
+        return
+    data = payload.data
+    if 'content' in data:
+        record.content = data['content']
+    if 'attachments' in data:
+        record.attachments = tuple(att['filename'] for att in data['attachments'])
+    if 'embeds' in data:
+        record.has_embeds = bool(data['embeds'])
+
+@bot.event
+async def on_raw_message_delete(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    if buffer:
+        buffer.remove(payload.message_id)
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    if buffer:
+        for message_id in payload.message_ids:
+            buffer.remove(message_id)
+
+@bot.event
+async def on_raw_reaction_add(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    record = buffer.get(payload.message_id) if buffer else None
+    if record is not None:
+        record.add_reaction(str(payload.emoji), 1)
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    record = buffer.get(payload.message_id) if buffer else None
+    if record is not None:
+        record.add_reaction(str(payload.emoji), -1)
+
+@bot.event
+async def on_raw_reaction_clear(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    record = buffer.get(payload.message_id) if buffer else None
+    if record is not None:
+        record.reactions = ()
+
+@bot.event
+async def on_raw_reaction_clear_emoji(payload):
+    buffer = channel_buffers.get(payload.channel_id)
+    record = buffer.get(payload.message_id) if buffer else None
+    if record is not None:
+        record.reactions = tuple(pair for pair in record.reactions if pair[0] != str(payload.emoji))
 
 @bot.event
 async def on_message(message):
@@ -381,6 +3162,9 @@ async def on_message(message):
     # Ignore messages from the bot itself
     if message.author == bot.user:
         return
+    
+    # Remember the message for channel summaries
+    channel_buffers.record(message)
         
     # Check if bot was mentioned
     if bot.user.mentioned_in(message):
@@ -391,7 +3175,8 @@ async def on_message(message):
                 cleaned_content = cleaned_content.replace(f'<@{bot.user.id}>', '', 1).replace(f'<@!{bot.user.id}>', '', 1).strip()
         
         # If only mentioned with no content
-        if not cleaned_content:
+        has_images = ATTACHMENT_MAX_IMAGES > 0 and any(is_image_attachment(attachment) for attachment in message.attachments)
+        if not cleaned_content and not has_images:
             user_name = message.author.display_name
             await message.reply(f"Kính chào {user_name}! Nô tỳ có thể giúp gì được cho ngài ạ? 🫡")
             return
@@ -399,25 +3184,42 @@ async def on_message(message):
         # Process the message
         try:
             async with message.channel.typing():
-                print(f"Message from {message.author.name} ({message.author.id}) in channel {message.channel.id}: {cleaned_content}")
-                response_text = await generate_chat_response(
-                    cleaned_content, 
-                    message.channel.id, 
-                    message.author.id,
-                    message.author.display_name,
-                    message.guild.id
+                log_event(
+                    logging.INFO, 'message_received', "Mention received",
+                    user_id=message.author.id, channel_id=message.channel.id, content=redact_content(cleaned_content),
+                    attachments=len(message.attachments)
+                )
+                images = await load_message_images(message) if has_images else []
+                if has_images and not images and not cleaned_content:
+                    user_name = message.author.display_name
+                    await message.reply(f"Ố dồi ôi, nô tỳ không đọc được ảnh {user_name} gửi (ảnh quá lớn hoặc không hỗ trợ). {user_name} thử gửi ảnh khác nhỏ hơn nhé! 🙏")
+                    return
+                reply = StreamingReply(message.reply)
+                response_text = await chat_queue.submit(
+                    (message.guild.id, message.channel.id, message.author.id),
+                    cleaned_content,
+                    lambda content: generate_chat_response(
+                        content, 
+                        message.channel.id, 
+                        message.author.id,
+                        message.author.display_name,
+                        message.guild.id,
+                        on_chunk=reply.update if STREAMING_REPLIES else None,
+                        images=images
+                    ),
+                    coalesce=not images  # Images belong to their own message, so it is not merged
                 )
                 
-                # Limit response length for Discord
-                if response_text:
-                    if len(response_text) > 2000:
-                        response_text = response_text[:1990] + "..."
-                    await message.reply(response_text)
+                # Split long responses into several Discord messages
+                if response_text is None:
+                    pass  # Merged into a later message, which gets the reply
+                elif response_text:
+                    await reply.finish(split_reply(response_text, 'chat', CHAT_MAX_MESSAGES, 1990))
                 else:
                     user_name = message.author.display_name
                     await message.reply(f"Ố dồi ôi, em không thể tạo phản hồi ngay lúc này. {user_name} thông cảm giúp nô tỳ nhé! 😔")
         except Exception as e:
-            print(f"Error responding to mention: {e}")
+            log_event(logging.ERROR, 'mention_failed', "Error responding to mention", exc_info=e, channel_id=message.channel.id)
             user_name = message.author.display_name
             await message.reply(f"Úi giời ơi, em gặp lỗi khi xử lý tin nhắn. Ngài {user_name} thông cảm giúp ô sin nhé! 😔")
     
@@ -430,24 +3232,29 @@ async def chat_command(interaction: discord.Interaction, message: str):
     """Slash command for chatting with the AI"""
     await interaction.response.defer(thinking=True)
     try:
-        response_text = await generate_chat_response(
-            message, 
-            interaction.channel_id, 
-            interaction.user.id,
-            interaction.user.display_name,
-            interaction.guild.id
+        reply = StreamingReply(interaction.followup.send)
+        response_text = await chat_queue.submit(
+            (interaction.guild.id, interaction.channel_id, interaction.user.id),
+            message,
+            lambda content: generate_chat_response(
+                content, 
+                interaction.channel_id, 
+                interaction.user.id,
+                interaction.user.display_name,
+                interaction.guild.id,
+                on_chunk=reply.update if STREAMING_REPLIES else None
+            ),
+            coalesce=False  # Every interaction needs its own followup
         )
         
-        # Limit response length for Discord
+        # Split long responses into several Discord messages
         if response_text:
-            if len(response_text) > 2000:
-                response_text = response_text[:1990] + "..."
-            await interaction.followup.send(response_text)
+            await reply.finish(split_reply(response_text, 'chat', CHAT_MAX_MESSAGES, 1990))
         else:
             user_name = interaction.user.display_name
             await interaction.followup.send(f"Ố dồi ôi, em không thể tạo phản hồi ngay lúc này. {user_name} thông cảm giúp nô tỳ nhé! 😔")
     except Exception as e:
-        print(f"Error in chat command: {e}")
+        log_event(logging.ERROR, 'chat_command_failed', "Error in chat command", exc_info=e)
         user_name = interaction.user.display_name
         await interaction.followup.send(f"Úi giời ơi, em gặp lỗi khi xử lý yêu cầu. Ngài {user_name} thông cảm giúp ô sin nhé! 😔")
 
@@ -460,11 +3267,12 @@ async def imagine_slash_command(interaction: discord.Interaction, prompt: str):
         user_name = interaction.user.display_name
         await interaction.followup.send(f"Ô sin đang tạo ảnh cho {user_name} theo yêu cầu: \"{prompt}\"... 🎨")
         
-        image_data = await generate_image_from_prompt(prompt, user_name)
+        image_data = await generate_image_from_prompt(prompt, user_name, interaction.guild_id, interaction.user.id)
         
-        if isinstance(image_data, bytes):
+        if isinstance(image_data, (Path, bytes)):
             # Send image as a file
-            image_file = discord.File(io.BytesIO(image_data), filename="generated_image.png")
+            upload_limit = interaction.guild.filesize_limit if interaction.guild else DISCORD_UPLOAD_LIMIT
+            image_file = await image_file_from_result(image_data, upload_limit)
             await interaction.followup.send(f"Thưa ngài {user_name}, đây là ảnh theo yêu cầu \"{prompt}\" ạ:", file=image_file)
         elif isinstance(image_data, str):
             # Error message
@@ -472,7 +3280,7 @@ async def imagine_slash_command(interaction: discord.Interaction, prompt: str):
         else:
             await interaction.followup.send(f"Ố dồi ôi, nô tỳ không thể tạo ảnh cho yêu cầu này. {user_name} thử mô tả khác được không ạ? 🙏")
     except Exception as e:
-        print(f"Error in imagine command: {e}")
+        log_event(logging.ERROR, 'imagine_command_failed', "Error in imagine command", exc_info=e)
         user_name = interaction.user.display_name
         await interaction.followup.send(f"Úi giời ơi, em gặp lỗi khi tạo ảnh. {user_name} thông cảm giúp nô tỳ nhé! 😔")
 
@@ -483,15 +3291,14 @@ async def clear_context_slash(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
     try:
         user_name = interaction.user.display_name
-        session_key = (interaction.channel_id, interaction.user.id)
-        if session_key in chat_sessions:
-            del chat_sessions[session_key]
+        session_key = (interaction.guild_id, interaction.channel_id, interaction.user.id)
+        if await clear_chat_session(session_key):
             await interaction.followup.send(f"Ô sin đã xóa lịch sử trò chuyện của {user_name} rồi ạ! 🫡", ephemeral=True)
-            print(f"Context cleared for {session_key}")
+            log_event(logging.INFO, 'context_cleared', "Chat context cleared", guild_id=session_key[0], channel_id=session_key[1], user_id=session_key[2])
         else:
             await interaction.followup.send(f"Thưa {user_name}, không có lịch sử trò chuyện nào để xóa ạ! 🙏", ephemeral=True)
     except Exception as e:
-        print(f"Error in clear_context command: {e}")
+        log_event(logging.ERROR, 'clear_context_failed', "Error in clear_context command", exc_info=e)
         user_name = interaction.user.display_name
         await interaction.followup.send(f"Úi giời ơi, em gặp lỗi khi xóa lịch sử trò chuyện. {user_name} thông cảm giúp nô tỳ nhé! 😔", ephemeral=True)
 
@@ -572,20 +3379,12 @@ class ToneSelectView(discord.ui.View):
         await interaction.response.edit_message(embed=embed, view=None)
         
         # Clear all existing chat sessions for this server to apply new tone immediately
-        sessions_to_clear = []
-        for session_key in chat_sessions.keys():
-            channel_id, user_id = session_key
-            try:
-                channel = bot.get_channel(channel_id)
-                if channel and channel.guild.id == interaction.guild.id:
-                    sessions_to_clear.append(session_key)
-            except:
-                pass
-        
-        for session_key in sessions_to_clear:
-            del chat_sessions[session_key]
+        cleared = invalidate_guild_sessions(interaction.guild.id)
         
-        print(f"Tone updated for server {interaction.guild.id} to {selected_tone_level.name}, cleared {len(sessions_to_clear)} sessions")
+        log_event(
+            logging.INFO, 'tone_updated', "Tone updated",
+            guild_id=interaction.guild.id, tone=selected_tone_level.name, sessions_cleared=cleared, source='slash'
+        )
 
 # Add slash command for tone configuration
 @bot.tree.command(name="tone", description="Configure the bot's response tone for this server")
@@ -710,23 +3509,15 @@ async def tone_prefix_command(ctx, level: int = None):
         await ctx.reply(embed=embed)
         
         # Clear all existing chat sessions for this server to apply new tone immediately
-        sessions_to_clear = []
-        for session_key in chat_sessions.keys():
-            channel_id, user_id = session_key
-            try:
-                channel = bot.get_channel(channel_id)
-                if channel and channel.guild.id == ctx.guild.id:
-                    sessions_to_clear.append(session_key)
-            except:
-                pass
-        
-        for session_key in sessions_to_clear:
-            del chat_sessions[session_key]
+        cleared = invalidate_guild_sessions(ctx.guild.id)
         
-        print(f"Tone updated for server {ctx.guild.id} to {selected_tone_level.name} via prefix command, cleared {len(sessions_to_clear)} sessions")
+        log_event(
+            logging.INFO, 'tone_updated', "Tone updated",
+            guild_id=ctx.guild.id, tone=selected_tone_level.name, sessions_cleared=cleared, source='prefix'
+        )
         
     except Exception as e:
-        print(f"Error in tone prefix command: {e}")
+        log_event(logging.ERROR, 'tone_command_failed', "Error in tone prefix command", exc_info=e)
         await ctx.reply(f"❌ Có lỗi xảy ra khi cập nhật tone: {str(e)}")
 
 # Add a demo command to showcase tone differences
@@ -775,15 +3566,14 @@ async def clear_context(ctx):
     """Clear the chat context for a user in a specific channel."""
     try:
         user_name = ctx.author.display_name
-        session_key = (ctx.channel.id, ctx.author.id)
-        if session_key in chat_sessions:
-            del chat_sessions[session_key]
+        session_key = (ctx.guild.id if ctx.guild else None, ctx.channel.id, ctx.author.id)
+        if await clear_chat_session(session_key):
             await ctx.reply(f"Ô sin đã xóa lịch sử trò chuyện của {user_name} rồi ạ! 🫡")
-            print(f"Context cleared for {session_key}")
+            log_event(logging.INFO, 'context_cleared', "Chat context cleared", guild_id=session_key[0], channel_id=session_key[1], user_id=session_key[2])
         else:
             await ctx.reply(f"Thưa {user_name}, không có lịch sử trò chuyện nào để xóa ạ! 🙏")
     except Exception as e:
-        print(f"Error in clear_context command: {e}")
+        log_event(logging.ERROR, 'clear_context_failed', "Error in clear_context command", exc_info=e)
         user_name = ctx.author.display_name
         await ctx.reply(f"Úi giời ơi, em gặp lỗi khi xóa lịch sử trò chuyện. {user_name} thông cảm giúp nô tỳ nhé! 😔")
 
@@ -799,11 +3589,12 @@ async def imagine_command(ctx, *, prompt: str):
         user_name = ctx.author.display_name
         await ctx.reply(f"Ô sin đang tạo ảnh cho {user_name} theo yêu cầu: \"{prompt}\"... 🎨")
         async with ctx.typing():
-            image_data = await generate_image_from_prompt(prompt, user_name)
+            image_data = await generate_image_from_prompt(prompt, user_name, ctx.guild.id if ctx.guild else None, ctx.author.id)
             
-            if isinstance(image_data, bytes):
+            if isinstance(image_data, (Path, bytes)):
                 # Send image as a file
-                image_file = discord.File(io.BytesIO(image_data), filename="generated_image.png")
+                upload_limit = ctx.guild.filesize_limit if ctx.guild else DISCORD_UPLOAD_LIMIT
+                image_file = await image_file_from_result(image_data, upload_limit)
                 await ctx.reply(f"Thưa ngài {user_name}, đây là ảnh theo yêu cầu \"{prompt}\" ạ:", file=image_file)
             elif isinstance(image_data, str):
                 # Error message
@@ -811,10 +3602,267 @@ async def imagine_command(ctx, *, prompt: str):
             else:
                 await ctx.reply(f"Ố dồi ôi, nô tỳ không thể tạo ảnh cho yêu cầu này. {user_name} thử mô tả khác được không ạ? 🙏")
     except Exception as e:
-        print(f"Error in imagine command: {e}")
+        log_event(logging.ERROR, 'imagine_command_failed', "Error in imagine command", exc_info=e)
         user_name = ctx.author.display_name
         await ctx.reply(f"Úi giời ơi, em gặp lỗi khi tạo ảnh. {user_name} thông cảm giúp nô tỳ nhé! 😔")
 
+# Cached channel summaries, so a repeat request only sends the messages since the last one
+SUMMARY_CACHE_MAX_CHANNELS = 1000
+channel_summaries = OrderedDict()  # channel_id -> {'newest_id', 'count', 'summary'}, least recently used first
+summary_cache_stats = {'full': 0, 'incremental': 0, 'reused': 0, 'chunks': 0}
+
+SUMMARY_REQUIREMENTS = """Yêu cầu tóm tắt:
+- Nội dung chính của cuộc trò chuyện
+- Ai nói về vấn đề gì (chỉ tóm tắt chứ không cần chi tiết nội dung)
+- Không khí trao đổi như nào, tâm trạng có ai không vui ko, có gì hay ho đặc biệt không
+Tổng quan về không khí cuộc trò chuyện
+
+Hãy viết một cách hài hước, dễ hiểu và đừng quá dài dòng văn tự quá nhé."""
+
+def format_message_for_summary(msg: BufferedMessage) -> str:
+    """Render one buffered message as a transcript line for the summary prompt."""
+    timestamp = datetime.fromtimestamp(msg.created_at, timezone.utc).strftime("%H:%M")
+    content = msg.content
+    
+    # Handle attachments
+    if msg.attachments:
+        content += f" [Đính kèm: {', '.join(msg.attachments)}]"
+    
+    # Handle embeds
+    if msg.has_embeds:
+        content += " [Có embed/link]"
+    
+    # Handle reactions
+    if msg.reactions:
+        reactions = ", ".join([f"{emoji}({count})" for emoji, count in msg.reactions])
+        content += f" [Reactions: {reactions}]"
+    
+    return f"[{timestamp}] {msg.author_name}: {content}"
+
+async def collect_recent_messages(channel, count: int, skip_message_id=None, after_id=None) -> list:
+    """Return up to count of the channel's latest messages (newest first), as BufferedMessage.
+
+    Messages come from the channel buffer; channel.history is only used for
+    the part the buffer does not cover, e.g. right after a restart. With
+    after_id, only messages newer than that ID are returned.
+    """
+    records = []
+    buffer = channel_buffers.get(channel.id)
+    before = None
+    if buffer and buffer.records:
+        for record in reversed(buffer.records):
+            if after_id is not None and record.id <= after_id:
+                return records  # The buffer reaches back past after_id, nothing is missing
+            if record.id != skip_message_id:
+                records.append(record)
+                if len(records) >= count:
+                    return records
+        if after_id is not None and buffer.records[0].id <= after_id:
+            return records
+        before = discord.Object(id=buffer.records[0].id)
+
+    # Fill the gap before the oldest buffered message over REST
+    history_kwargs = {'limit': count - len(records) + 2, 'before': before}  # +2 to make room for the summary command and bot's response
+    if after_id is not None:
+        history_kwargs.update(after=discord.Object(id=after_id), oldest_first=False)
+    fetched = []
+    async for message in channel.history(**history_kwargs):
+        # Skip the bot's own messages and the summary command
+        if message.author != bot.user and message.id != skip_message_id:
+            record = BufferedMessage.from_message(message)
+            # REST messages carry a plain user, without the server nickname
+            record.author_name = await member_names.display_name(message)
+            fetched.append(record)
+            if len(records) + len(fetched) >= count:
+                break
+    if fetched:
+        guild_id = channel.guild.id if getattr(channel, 'guild', None) else None
+        channel_buffers.get_or_create(channel.id, guild_id).backfill(fetched)
+    return records + fetched
+
+async def generate_summary_text(summary_prompt: str, guild_id, max_output_tokens: int = SUMMARY_MAX_OUTPUT_TOKENS, user_id=None) -> str:
+    """Ask Gemini for a summary within the given output budget."""
+    response = await call_gemini(
+        RequestPriority.SUMMARY, guild_id,
+        lambda: model.generate_content_async(
+            summary_prompt, generation_config={'max_output_tokens': max_output_tokens}
+        ),
+        estimated_tokens=estimate_tokens(summary_prompt)
+    )
+    record_token_usage('summary', guild_id, user_id, response)
+    return response.text
+
+def chunk_transcript(lines: list, token_budget: int) -> list:
+    """Split transcript lines, in order, into chunks of at most token_budget estimated tokens."""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in lines:
+        line_tokens = estimate_tokens(line)
+        if current and current_tokens + line_tokens > token_budget:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def map_summary_chunks(chunks: list, guild_id, merging: bool = False, user_id=None) -> list:
+    """Summarize every chunk concurrently and return the partial summaries in order.
+
+    At most SUMMARY_MAP_CONCURRENCY chunks are sent at once, so one large
+    summary cannot fill the whole Gemini queue by itself.
+    """
+    semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+
+    async def summarize_chunk(index, chunk):
+        if merging:
+            summary_prompt = f"""Đây là các bản tóm tắt liên tiếp (theo thứ tự thời gian) của một đoạn hội thoại dài trên Discord:
+
+{chr(10).join(chunk)}
+
+Hãy gộp chúng thành một bản ghi chú tóm tắt ngắn gọn bằng tiếng Việt, giữ thứ tự thời gian, ai nói về vấn đề gì và không khí trao đổi."""
+        else:
+            summary_prompt = f"""Đây là phần {index + 1}/{len(chunks)} của một đoạn hội thoại dài trên Discord:
+
+{chr(10).join(chunk)}
+
+Hãy ghi chú tóm tắt phần này bằng tiếng Việt thật ngắn gọn: nội dung chính, ai nói về vấn đề gì, không khí trao đổi và những điểm đặc biệt. Chỉ ghi chú ý chính, không cần hài hước."""
+        async with semaphore:
+            return await generate_summary_text(summary_prompt, guild_id, SUMMARY_CHUNK_OUTPUT_TOKENS, user_id)
+
+    tasks = [asyncio.ensure_future(summarize_chunk(index, chunk)) for index, chunk in enumerate(chunks)]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # Do not keep spending quota on a summary that already failed
+        for task in tasks:
+            task.cancel()
+        raise
+
+async def summarize_transcript(lines: list, guild_id, count: int, previous_summary: str = None, user_id=None) -> str:
+    """Summarize chronological transcript lines into the final digest.
+
+    A transcript that fits in one chunk is summarized with a single request.
+    Larger ones are split into chunks that are summarized concurrently (map),
+    and the partial summaries are then merged into the digest (reduce). With
+    previous_summary, the new lines are merged into that earlier summary.
+    """
+    chunks = chunk_transcript(lines, SUMMARY_CHUNK_TOKENS)
+    if len(chunks) <= 1:
+        if previous_summary is None:
+            summary_prompt = f"""Hãy tóm tắt cuộc trò chuyện sau đây bằng tiếng Việt một cách chi tiết và thú vị:
+
+{chr(10).join(lines)}
+
+{SUMMARY_REQUIREMENTS}"""
+        else:
+            summary_prompt = f"""Đây là bản tóm tắt trước đó của một cuộc trò chuyện:
+
+{previous_summary}
+
+Và đây là các tin nhắn mới từ sau bản tóm tắt đó:
+
+{chr(10).join(lines) if lines else "(không có tin nhắn mới)"}
+
+Hãy viết lại một bản tóm tắt duy nhất bằng tiếng Việt cho {count} tin nhắn gần đây nhất, gộp nội dung cũ với các tin nhắn mới và ưu tiên những gì mới diễn ra.
+
+{SUMMARY_REQUIREMENTS}"""
+        return await generate_summary_text(summary_prompt, guild_id, user_id=user_id)
+
+    summary_cache_stats['chunks'] += len(chunks)
+    partials = await map_summary_chunks(chunks, guild_id, user_id=user_id)
+
+    # Merge the partial summaries level by level until they fit in one request
+    partials = [f"Phần {index + 1}: {partial}" for index, partial in enumerate(partials)]
+    while len(partials) > 1:
+        groups = chunk_transcript(partials, SUMMARY_CHUNK_TOKENS)
+        if len(groups) == 1 or len(groups) > len(partials) // 2:
+            break  # Fits in one request, or another level would barely shrink it
+        partials = await map_summary_chunks(groups, guild_id, merging=True, user_id=user_id)
+        partials = [f"Phần {index + 1}: {partial}" for index, partial in enumerate(partials)]
+
+    earlier = f"""Bản tóm tắt trước đó (các tin nhắn cũ hơn):
+
+{previous_summary}
+
+""" if previous_summary is not None else ""
+    summary_prompt = f"""{earlier}Đây là các bản tóm tắt từng phần, theo thứ tự thời gian, của {count} tin nhắn gần đây nhất trong một kênh Discord:
+
+{chr(10).join(partials)}
+
+Hãy gộp tất cả thành một bản tóm tắt duy nhất bằng tiếng Việt một cách chi tiết và thú vị, ưu tiên những gì mới diễn ra.
+
+{SUMMARY_REQUIREMENTS}"""
+    return await generate_summary_text(summary_prompt, guild_id, user_id=user_id)
+
+# Helper function to fit a summary request to the daily token budgets
+def budgeted_summary_count(count: int, guild_id, user_id):
+    """Return (message_count, shortened) for a summary of count messages.
+
+    Raises BudgetExceededError when the server or user is over its daily
+    token budget, and shortens the window when it is close to it. Called
+    before the status message, so the user is told the real window size.
+    """
+    if check_token_budget(guild_id, user_id) and count > DOWNGRADED_SUMMARY_MESSAGE_LIMIT:
+        return DOWNGRADED_SUMMARY_MESSAGE_LIMIT, True
+    return count, False
+
+async def summarize_channel(channel, count: int, guild_id, skip_message_id=None, user_id=None):
+    """Summarize the last count messages of a channel.
+
+    When the channel was summarized before, only the messages after the
+    newest one already covered are collected, and Gemini merges them into the
+    cached summary. Returns (summary_text, message_count), or None when there
+    is nothing to summarize. count should already be fitted to the token
+    budgets with budgeted_summary_count.
+    """
+    cached = channel_summaries.get(channel.id)
+    messages = await collect_recent_messages(
+        channel, count, skip_message_id, after_id=cached['newest_id'] if cached else None
+    )
+    newest_id = max([cached['newest_id'] if cached else 0] + [msg.id for msg in messages])
+
+    # Reuse the cached summary if, with the new messages, it covers the requested window
+    if cached is not None and len(messages) < count and count - len(messages) <= cached['count'] <= count:
+        message_count = count
+        if not messages and cached['count'] == count:
+            summary_cache_stats['reused'] += 1
+            summary_text = cached['summary']
+        else:
+            messages.reverse()
+            new_content = [format_message_for_summary(msg) for msg in messages]
+            summary_cache_stats['incremental'] += 1
+            summary_text = await summarize_transcript(new_content, guild_id, count, cached['summary'], user_id)
+    else:
+        if cached is not None and len(messages) < count:
+            # The cache cannot be reused for this window, collect it in full
+            messages = await collect_recent_messages(channel, count, skip_message_id)
+            newest_id = max([newest_id] + [msg.id for msg in messages])
+        if not messages:
+            return None
+        message_count = len(messages)
+        
+        # Reverse to get chronological order (oldest first)
+        messages.reverse()
+        chat_content = [format_message_for_summary(msg) for msg in messages]
+        summary_cache_stats['full'] += 1
+        summary_text = await summarize_transcript(chat_content, guild_id, message_count, user_id=user_id)
+
+    channel_summaries[channel.id] = {'newest_id': newest_id, 'count': message_count, 'summary': summary_text}
+    channel_summaries.move_to_end(channel.id)
+    while len(channel_summaries) > SUMMARY_CACHE_MAX_CHANNELS:
+        channel_summaries.popitem(last=False)
+    return summary_text, message_count
+
+# Status message sent while a summary is being written
+def summary_status_message(count: int, user_name: str, shortened: bool) -> str:
+    if shortened:
+        return f"Ô sin đang đọc và tóm tắt {count} tin nhắn gần đây cho {user_name} (rút gọn vì sắp hết hạn mức Gemini hôm nay)... 📖"
+    return f"Ô sin đang đọc và tóm tắt {count} tin nhắn gần đây cho {user_name}... 📖"
+
 # Add slash command for chat summary
 @bot.tree.command(name="summary", description="Summarize recent chat messages in this channel")
 async def summary_command(interaction: discord.Interaction, count: int = 10):
@@ -825,91 +3873,51 @@ async def summary_command(interaction: discord.Interaction, count: int = 10):
     if count < 1:
         await interaction.followup.send("Thưa ngài, số tin nhắn phải lớn hơn 0 ạ! 🙏")
         return
-    elif count > 200:
-        await interaction.followup.send("Ố dồi ôi, em chỉ có thể tóm tắt tối đa 200 tin nhắn thôi ạ! 🙏")
+    elif count > SUMMARY_MESSAGE_LIMIT:
+        await interaction.followup.send(f"Ố dồi ôi, em chỉ có thể tóm tắt tối đa {SUMMARY_MESSAGE_LIMIT} tin nhắn thôi ạ! 🙏")
         return
     
     try:
         user_name = interaction.user.display_name
-        await interaction.followup.send(f"Ô sin đang đọc và tóm tắt {count} tin nhắn gần đây cho {user_name}... 📖")
-        
-        # Fetch recent messages from the channel
-        messages = []
-        async for message in interaction.channel.history(limit=count + 1):  # +1 to exclude the summary command itself
-            # Skip the bot's own messages and the summary command
-            if message.author != bot.user and message.id != interaction.id:
-                messages.append(message)
-                if len(messages) >= count:
-                    break
-        
-        if not messages:
-            await interaction.followup.send(f"Thưa {user_name}, không có tin nhắn nào để tóm tắt ạ! 🙏")
+        try:
+            count, shortened = budgeted_summary_count(count, interaction.guild_id, interaction.user.id)
+        except BudgetExceededError as e:
+            await interaction.followup.send(unavailable_message(e, user_name))
             return
+        await interaction.followup.send(summary_status_message(count, user_name, shortened))
         
-        # Reverse to get chronological order (oldest first)
-        messages.reverse()
-        
-        # Prepare message content for summarization
-        chat_content = []
-        for msg in messages:
-            timestamp = msg.created_at.strftime("%H:%M")
-            author_name = msg.author.display_name
-            content = msg.content
-            
-            # Handle attachments
-            if msg.attachments:
-                attachment_info = f" [Đính kèm: {', '.join([att.filename for att in msg.attachments])}]"
-                content += attachment_info
-            
-            # Handle embeds
-            if msg.embeds:
-                content += " [Có embed/link]"
-            
-            # Handle reactions
-            if msg.reactions:
-                reactions = ", ".join([f"{reaction.emoji}({reaction.count})" for reaction in msg.reactions])
-                content += f" [Reactions: {reactions}]"
-            
-            chat_content.append(f"[{timestamp}] {author_name}: {content}")
-        
-        # Create summary prompt
-        summary_prompt = f"""Hãy tóm tắt cuộc trò chuyện sau đây bằng tiếng Việt  thú vị:
-
-{chr(10).join(chat_content)}
-
-Yêu cầu tóm tắt:
-- Nội dung chính của cuộc trò chuyện
-- Ai nói về vấn đề gì (chỉ tóm tắt chứ không cần chi tiết nội dung)
-- Không khí trao đổi như nào, tâm trạng có ai không vui ko, có gì hay ho đặc biệt không
-Tổng quan về không khí cuộc trò chuyện
-
-Hãy viết một cách hài hước, dễ hiểu và đừng quá dài dòng văn tự quá nhé."""
-
         # Generate summary using Gemini
         try:
-            response = await model.generate_content_async(summary_prompt)
-            summary_text = response.text
-            
-            # Limit response length for Discord
-            if len(summary_text) > 1900:  # Leave room for formatting
-                summary_text = summary_text[:1890] + "..."
-            
-            # Format the response
-            formatted_response = f"📋 **Tóm tắt {len(messages)} tin nhắn gần đây:**\n\n{summary_text}\n\n*- Ô sin đã tóm tắt xong ạ! 🫡*"
-            
-            await interaction.followup.send(formatted_response)
-            
+            result = await summarize_channel(interaction.channel, count, interaction.guild_id, interaction.id, interaction.user.id)
+        except discord.HTTPException:
+            raise
+        except GeminiUnavailableError as e:
+            await interaction.followup.send(unavailable_message(e, user_name))
+            return
         except Exception as e:
-            print(f"Error generating summary: {e}")
+            log_event(logging.ERROR, 'summary_generation_failed', "Error generating summary", exc_info=e)
             if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback') and e.response.prompt_feedback.block_reason:
                 await interaction.followup.send(f"Úi giời ơi, em không thể tóm tắt được vì: {e.response.prompt_feedback.block_reason.name}. {user_name} thông cảm giúp em nhé! 🙏")
             else:
                 await interaction.followup.send(f"Ố dồi ôi, em gặp lỗi khi tóm tắt tin nhắn. {user_name} thông cảm giúp nô tỳ nhé! 😔")
+            return
+        
+        if result is None:
+            await interaction.followup.send(f"Thưa {user_name}, không có tin nhắn nào để tóm tắt ạ! 🙏")
+            return
+        summary_text, message_count = result
+        
+        # Format the response
+        formatted_response = f"📋 **Tóm tắt {message_count} tin nhắn gần đây:**\n\n{summary_text}\n\n*- Ô sin đã tóm tắt xong ạ! 🫡*"
+        
+        # Send long summaries as several Discord messages
+        for part in split_reply(formatted_response, 'summary', SUMMARY_MAX_MESSAGES, 1890 + SUMMARY_FORMAT_OVERHEAD):
+            await interaction.followup.send(part)
                 
     except discord.Forbidden:
         await interaction.followup.send(f"Úi giời ơi, em không có quyền đọc lịch sử tin nhắn trong kênh này. {user_name} thông cảm giúp nô tỳ nhé! 😔")
     except Exception as e:
-        print(f"Error in summary command: {e}")
+        log_event(logging.ERROR, 'summary_command_failed', "Error in summary command", exc_info=e)
         user_name = interaction.user.display_name
         await interaction.followup.send(f"Úi giời ơi, em gặp lỗi khi xử lý yêu cầu tóm tắt. {user_name} thông cảm giúp ô sin nhé! 😔")
 
@@ -921,97 +3929,104 @@ async def summary_prefix_command(ctx, count: int = 10):
         user_name = ctx.author.display_name
         await ctx.reply(f"Thưa {user_name}, số tin nhắn phải lớn hơn 0 ạ! 🙏")
         return
-    elif count > 200:
+    elif count > SUMMARY_MESSAGE_LIMIT:
         user_name = ctx.author.display_name
-        await ctx.reply(f"Ố dồi ôi, em chỉ có thể tóm tắt tối đa 200 tin nhắn thôi ạ! 🙏")
+        await ctx.reply(f"Ố dồi ôi, em chỉ có thể tóm tắt tối đa {SUMMARY_MESSAGE_LIMIT} tin nhắn thôi ạ! 🙏")
         return
     
     try:
         user_name = ctx.author.display_name
-        await ctx.reply(f"Ô sin đang đọc và tóm tắt {count} tin nhắn gần đây cho {user_name}... 📖")
+        try:
+            count, shortened = budgeted_summary_count(count, ctx.guild.id if ctx.guild else None, ctx.author.id)
+        except BudgetExceededError as e:
+            await ctx.reply(unavailable_message(e, user_name))
+            return
+        await ctx.reply(summary_status_message(count, user_name, shortened))
         
         async with ctx.typing():
-            # Fetch recent messages from the channel
-            messages = []
-            async for message in ctx.channel.history(limit=count + 2):  # +2 to exclude the summary command and bot's response
-                # Skip the bot's own messages and the summary command
-                if message.author != bot.user and message.id != ctx.message.id:
-                    messages.append(message)
-                    if len(messages) >= count:
-                        break
-            
-            if not messages:
-                await ctx.reply(f"Thưa {user_name}, không có tin nhắn nào để tóm tắt ạ! 🙏")
-                return
-            
-            # Reverse to get chronological order (oldest first)
-            messages.reverse()
-            
-            # Prepare message content for summarization
-            chat_content = []
-            for msg in messages:
-                timestamp = msg.created_at.strftime("%H:%M")
-                author_name = msg.author.display_name
-                content = msg.content
-                
-                # Handle attachments
-                if msg.attachments:
-                    attachment_info = f" [Đính kèm: {', '.join([att.filename for att in msg.attachments])}]"
-                    content += attachment_info
-                
-                # Handle embeds
-                if msg.embeds:
-                    content += " [Có embed/link]"
-                
-                # Handle reactions
-                if msg.reactions:
-                    reactions = ", ".join([f"{reaction.emoji}({reaction.count})" for reaction in msg.reactions])
-                    content += f" [Reactions: {reactions}]"
-                
-                chat_content.append(f"[{timestamp}] {author_name}: {content}")
-            
-            # Create summary prompt
-            summary_prompt = f"""Hãy tóm tắt cuộc trò chuyện sau đây bằng tiếng Việt một cách chi tiết và thú vị:
-
-{chr(10).join(chat_content)}
-
-Yêu cầu tóm tắt:
-- Nội dung chính của cuộc trò chuyện
-- Ai nói về vấn đề gì (chỉ tóm tắt chứ không cần chi tiết nội dung)
-- Không khí trao đổi như nào, tâm trạng có ai không vui ko, có gì hay ho đặc biệt không
-Tổng quan về không khí cuộc trò chuyện
-
-Hãy viết một cách hài hước, dễ hiểu và đừng quá dài dòng văn tự quá nhé."""
-
             # Generate summary using Gemini
             try:
-                response = await model.generate_content_async(summary_prompt)
-                summary_text = response.text
-                
-                # Limit response length for Discord
-                if len(summary_text) > 1900:  # Leave room for formatting
-                    summary_text = summary_text[:1890] + "..."
-                
-                # Format the response
-                formatted_response = f"📋 **Tóm tắt {len(messages)} tin nhắn gần đây:**\n\n{summary_text}\n\n*- Ô sin đã tóm tắt xong ạ! 🫡*"
-                
-                await ctx.reply(formatted_response)
-                
+                result = await summarize_channel(ctx.channel, count, ctx.guild.id if ctx.guild else None, ctx.message.id, ctx.author.id)
+            except discord.HTTPException:
+                raise
+            except GeminiUnavailableError as e:
+                await ctx.reply(unavailable_message(e, user_name))
+                return
             except Exception as e:
-                print(f"Error generating summary: {e}")
+                log_event(logging.ERROR, 'summary_generation_failed', "Error generating summary", exc_info=e)
                 if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback') and e.response.prompt_feedback.block_reason:
                     await ctx.reply(f"Úi giời ơi, em không thể tóm tắt được vì: {e.response.prompt_feedback.block_reason.name}. {user_name} thông cảm giúp em nhé! 🙏")
                 else:
                     await ctx.reply(f"Ố dồi ôi, em gặp lỗi khi tóm tắt tin nhắn. {user_name} thông cảm giúp nô tỳ nhé! 😔")
+                return
+            
+            if result is None:
+                await ctx.reply(f"Thưa {user_name}, không có tin nhắn nào để tóm tắt ạ! 🙏")
+                return
+            summary_text, message_count = result
+            
+            # Format the response
+            formatted_response = f"📋 **Tóm tắt {message_count} tin nhắn gần đây:**\n\n{summary_text}\n\n*- Ô sin đã tóm tắt xong ạ! 🫡*"
+            
+            # Send long summaries as several Discord messages
+            for part in split_reply(formatted_response, 'summary', SUMMARY_MAX_MESSAGES, 1890 + SUMMARY_FORMAT_OVERHEAD):
+                await ctx.reply(part)
                     
     except discord.Forbidden:
         user_name = ctx.author.display_name
         await ctx.reply(f"Úi giời ơi, em không có quyền đọc lịch sử tin nhắn trong kênh này. {user_name} thông cảm giúp nô tỳ nhé! 😔")
     except Exception as e:
-        print(f"Error in summary command: {e}")
+        log_event(logging.ERROR, 'summary_command_failed', "Error in summary command", exc_info=e)
         user_name = ctx.author.display_name
         await ctx.reply(f"Úi giời ơi, em gặp lỗi khi xử lý yêu cầu tóm tắt. {user_name} thông cảm giúp ô sin nhé! 😔")
 
+def format_token_budget(used: int, budget: int) -> str:
+    if budget <= 0:
+        return f"{used:,} token (không giới hạn)"
+    return f"{used:,} / {budget:,} token ({used * 100 // budget}%)"
+
+# Add slash command for token usage
+@bot.tree.command(name="usage", description="Show this server's Gemini token usage and top consumers (last 24 hours)")
+@app_commands.guild_only()
+async def usage_command(interaction: discord.Interaction):
+    """Slash command for server admins to see who uses the most tokens"""
+    # Check if user has manage server permissions
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message(
+            "❌ Bạn cần quyền **Manage Server** để xem hạn mức sử dụng của bot!",
+            ephemeral=True
+        )
+        return
+    
+    guild_id = interaction.guild.id
+    prompt_tokens, completion_tokens = token_usage.usage('guild', guild_id)
+    embed = discord.Embed(
+        title="📊 Mức sử dụng Gemini (24 giờ qua)",
+        description=f"Prompt: {prompt_tokens:,} token · Phản hồi: {completion_tokens:,} token",
+        color=0x3498db
+    )
+    embed.add_field(
+        name="🏠 Server",
+        value=format_token_budget(prompt_tokens + completion_tokens, GUILD_DAILY_TOKEN_BUDGET),
+        inline=False
+    )
+    
+    top_users = token_usage.top_users(guild_id)
+    if top_users:
+        lines = []
+        for rank, (user_id, user_prompt, user_completion) in enumerate(top_users, 1):
+            line = f"**{rank}.** <@{user_id}>: {user_prompt + user_completion:,} token"
+            if USER_DAILY_TOKEN_BUDGET > 0:
+                used_today = token_usage.total('user', user_id)  # Across all servers, like the budget
+                line += f" · {used_today * 100 // USER_DAILY_TOKEN_BUDGET}% hạn mức cá nhân"
+            lines.append(line)
+        embed.add_field(name="👥 Người dùng nhiều nhất", value="\n".join(lines), inline=False)
+    else:
+        embed.add_field(name="👥 Người dùng nhiều nhất", value="Chưa có ai sử dụng trong 24 giờ qua.", inline=False)
+    
+    embed.set_footer(text="Số liệu của tiến trình bot này, tính theo từng giờ")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # General error handler for the bot
 @bot.event
 async def on_command_error(ctx, error):
@@ -1021,15 +4036,22 @@ async def on_command_error(ctx, error):
         user_name = ctx.author.display_name
         await ctx.send(f"Thưa {user_name}, thiếu thông tin cần thiết: {error.param} 🙏")
     else:
-        print(f"Command error: {error}")
+        log_event(logging.ERROR, 'command_failed', "Command error", exc_info=getattr(error, 'original', error), command=ctx.command.name if ctx.command else None)
+        errors_total.inc(type(getattr(error, 'original', error)).__name__)
         user_name = ctx.author.display_name
         await ctx.send(f"Úi giời ơi, em gặp lỗi khi xử lý lệnh. {user_name} thông cảm giúp nô tỳ nhé! 😔")
 
 # Run the bot
 if __name__ == "__main__":
+    # Check required tokens here rather than at import, so the module can be loaded without them (e.g. by benchmark.py)
+    if not DISCORD_TOKEN or not GEMINI_API_KEY:
+        log_event(logging.CRITICAL, 'missing_credentials', "Please set DISCORD_TOKEN and GEMINI_API_KEY in .env file")
+        sys.exit(1)
+    
+    startup_timer.mark('module_load')
     try:
-        bot.run(DISCORD_TOKEN)
+        bot.run(DISCORD_TOKEN, log_handler=None)  # discord.py logs through the root JSON handler
     except discord.errors.LoginFailure:
-        print("ERROR: Invalid Discord Token. Please check your .env file.")
+        log_event(logging.CRITICAL, 'login_failed', "Invalid Discord Token. Please check your .env file.")
     except Exception as e:
-        print(f"Unexpected error: {e}")
+        log_event(logging.CRITICAL, 'unexpected_error', "Unexpected error", exc_info=e)
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# Keep the bot's state files out of the working tree
+_state_dir = tempfile.mkdtemp(prefix='bot-tests-')
+for name, value in {
+    'LOG_LEVEL': 'WARNING',
+    'METRICS_PORT': '0',
+    'GUILD_CONFIG_DB': os.path.join(_state_dir, 'guild_configs.db'),
+    'IMAGE_CACHE_DIR': os.path.join(_state_dir, 'image_cache'),
+    'SESSION_SPILL_DB': os.path.join(_state_dir, 'chat_sessions.db'),
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
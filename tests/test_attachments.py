@@ -0,0 +1,122 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+import main
+
+
+def attachment(size, content_type='image/png', url=''):
+    return SimpleNamespace(size=size, content_type=content_type, url=url)
+
+
+def test_only_supported_image_types_are_read():
+    assert main.is_image_attachment(attachment(1, 'image/PNG; charset=binary'))
+    assert not main.is_image_attachment(attachment(1, 'image/svg+xml'))
+    assert not main.is_image_attachment(attachment(1, None))
+
+
+@pytest.fixture
+def cdn(monkeypatch):
+    """Run a scenario against a local HTTP server standing in for Discord's CDN."""
+    monkeypatch.setattr(main, 'attachment_session', None)
+    monkeypatch.setattr(main, 'attachment_slots', None)
+
+    async def small(request):
+        return web.Response(body=b"x" * 100)
+
+    async def declared_large(request):
+        return web.Response(body=b"x" * 5000)
+
+    async def undeclared_large(request):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(10):
+            await response.write(b"x" * 1000)
+        await response.write_eof()
+        return response
+
+    def run(scenario):
+        async def serve():
+            app = web.Application()
+            app.add_routes([web.get('/small', small), web.get('/declared', declared_large), web.get('/chunked', undeclared_large)])
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            try:
+                return await scenario(f"http://127.0.0.1:{port}")
+            finally:
+                await main.attachment_session.close()
+                await runner.cleanup()
+        return asyncio.run(serve())
+
+    return run
+
+
+def test_download_within_the_cap(cdn):
+    async def scenario(base):
+        return await main.download_attachment(attachment(100, url=f"{base}/small"), 100)
+
+    assert cdn(scenario) == b"x" * 100
+
+
+def test_declared_size_over_the_cap_is_refused(cdn):
+    async def scenario(base):
+        with pytest.raises(main.AttachmentTooLargeError, match="5000 bytes"):
+            await main.download_attachment(attachment(100, url=f"{base}/declared"), 1000)
+
+    cdn(scenario)
+
+
+def test_stream_is_abandoned_once_it_passes_the_cap(cdn):
+    async def scenario(base):
+        with pytest.raises(main.AttachmentTooLargeError, match="more than 2500 bytes"):
+            await main.download_attachment(attachment(100, url=f"{base}/chunked"), 2500)
+
+    cdn(scenario)
+
+
+def test_message_images_are_selected_before_downloading(monkeypatch):
+    monkeypatch.setattr(main, 'metrics_registry', [])
+    monkeypatch.setattr(main, 'attachment_results', main.Counter('attachments_total', '', ('result',)))
+    monkeypatch.setattr(main, 'attachment_bytes', main.Counter('attachment_bytes_total', '', ('stage',)))
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, 'ATTACHMENT_MAX_IMAGES', 2)
+    monkeypatch.setattr(main, 'ATTACHMENT_MAX_BYTES', 1000)
+    monkeypatch.setattr(main, 'ATTACHMENT_MAX_MESSAGE_BYTES', 1500)
+    downloads = []
+
+    async def download(attachment, max_bytes):
+        downloads.append(attachment.url)
+        if attachment.url == 'broken':
+            raise main.AttachmentTooLargeError("grew")
+        return b"x" * attachment.size
+
+    async def prepare(function, data, max_dimension, max_pixels):
+        return data[:10], 'image/jpeg'
+
+    monkeypatch.setattr(main, 'download_attachment', download)
+    monkeypatch.setattr(main, 'run_in_image_pool', prepare)
+    message = SimpleNamespace(id=1, attachments=[
+        SimpleNamespace(size=10, content_type='text/plain', url='notes'),
+        SimpleNamespace(size=2000, content_type='image/png', url='huge'),
+        SimpleNamespace(size=800, content_type='image/png', url='first'),
+        SimpleNamespace(size=800, content_type='image/png', url='over_message_budget'),
+        SimpleNamespace(size=500, content_type='image/jpeg', url='broken'),
+        SimpleNamespace(size=100, content_type='image/webp', url='one_too_many'),
+    ])
+
+    images = asyncio.run(main.load_message_images(message))
+    assert images == [(b"x" * 10, 'image/jpeg')]
+    assert downloads == ['first', 'broken']
+    results = dict(sample.rsplit(' ', 1) for sample in main.attachment_results.samples())
+    assert results == {
+        'attachments_total{result="too_large"}': '2',
+        'attachments_total{result="too_many"}': '1',
+        'attachments_total{result="used"}': '1',
+        'attachments_total{result="failed"}': '1',
+    }
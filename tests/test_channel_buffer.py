@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import BufferedMessage, ChannelBufferStore, ChannelMessageBuffer
+
+
+def record(message_id, content=None):
+    return BufferedMessage(message_id, 1, "Nam", 0, content or f"tin {message_id}", (), False, ())
+
+
+def discord_message(message_id):
+    author = SimpleNamespace(id=2, display_name="Lan")
+    return SimpleNamespace(
+        id=message_id, author=author, guild=None, webhook_id=None, content=f"tin {message_id}",
+        created_at=datetime.fromtimestamp(0, timezone.utc), attachments=[], embeds=[], reactions=[]
+    )
+
+
+class FakeChannel:
+    def __init__(self, channel_id, history=()):
+        self.id = channel_id
+        self.guild = None
+        self._history = list(history)  # Newest first
+        self.history_calls = []
+
+    async def history(self, limit, before=None, **kwargs):
+        self.history_calls.append((limit, before.id if before else None))
+        for message in self._history:
+            if before is None or message.id < before.id:
+                yield message
+
+
+def test_ring_buffer_drops_the_oldest_message():
+    buffer = ChannelMessageBuffer(1, 3)
+    for message_id in range(1, 6):
+        buffer.append(record(message_id))
+    buffer.append(record(5))  # Delivered twice, kept once
+    assert [msg.id for msg in buffer.records] == [3, 4, 5]
+    assert sorted(buffer.by_id) == [3, 4, 5]
+    buffer.remove(4)
+    assert [msg.id for msg in buffer.records] == [3, 5]
+    assert buffer.get(4) is None
+
+
+def test_backfill_only_prepends_older_messages():
+    buffer = ChannelMessageBuffer(1, 4)
+    buffer.append(record(10))
+    buffer.append(record(11))
+    buffer.backfill([record(12), record(9), record(8), record(7)])  # Newest first, as fetched
+    assert [msg.id for msg in buffer.records] == [8, 9, 10, 11]
+
+
+def test_least_recently_used_channel_is_dropped():
+    store = ChannelBufferStore(10, 2)
+    store.get_or_create(1, 100)
+    store.get_or_create(2, 100)
+    store.get_or_create(1, 100)
+    store.get_or_create(3, 200)
+    assert store.get(2) is None
+    store.drop_guild(100)
+    assert store.get(1) is None and store.get(3) is not None
+
+
+@pytest.fixture
+def buffers(monkeypatch):
+    store = ChannelBufferStore(10, 10)
+    monkeypatch.setattr(main, 'channel_buffers', store)
+    return store
+
+
+def test_recent_messages_come_from_the_buffer(buffers):
+    buffer = buffers.get_or_create(5, None)
+    for message_id in range(1, 8):
+        buffer.append(record(message_id))
+    channel = FakeChannel(5)
+
+    messages = asyncio.run(main.collect_recent_messages(channel, 3, skip_message_id=7))
+    assert [msg.id for msg in messages] == [6, 5, 4]
+    newer = asyncio.run(main.collect_recent_messages(channel, 10, after_id=5))
+    assert [msg.id for msg in newer] == [7, 6]
+    assert channel.history_calls == []
+
+
+def test_gap_before_the_buffer_is_fetched_and_backfilled(buffers):
+    buffer = buffers.get_or_create(5, None)
+    buffer.append(record(4))
+    buffer.append(record(5))
+    channel = FakeChannel(5, [discord_message(message_id) for message_id in (3, 2, 1)])
+
+    messages = asyncio.run(main.collect_recent_messages(channel, 4))
+    assert [msg.id for msg in messages] == [5, 4, 3, 2]
+    assert channel.history_calls == [(4, 4)]
+    assert [msg.id for msg in buffer.records] == [2, 3, 4, 5]
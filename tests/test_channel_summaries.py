@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import BufferedMessage
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    """A channel whose history is a plain list, with summaries recorded instead of sent to Gemini."""
+    channel = SimpleNamespace(id=10, posted=[], transcripts=[])
+
+    def post(count):
+        for _ in range(count):
+            message_id = len(channel.posted) + 1
+            channel.posted.append(BufferedMessage(message_id, 1, "Nam", 0, f"tin {message_id}", (), False, ()))
+
+    async def collect(channel, count, skip_message_id=None, after_id=None):
+        messages = [msg for msg in reversed(channel.posted) if msg.id > (after_id or 0)]
+        return messages[:count]
+
+    async def summarize(lines, guild_id, count, previous_summary=None, user_id=None):
+        channel.transcripts.append((lines, previous_summary))
+        return f"tóm tắt {len(channel.transcripts)}"
+
+    channel.post = post
+    monkeypatch.setattr(main, 'channel_summaries', main.OrderedDict())
+    monkeypatch.setattr(main, 'summary_cache_stats', {'full': 0, 'incremental': 0, 'reused': 0, 'chunks': 0})
+    monkeypatch.setattr(main, 'collect_recent_messages', collect)
+    monkeypatch.setattr(main, 'summarize_transcript', summarize)
+    return channel
+
+
+def test_new_messages_are_merged_into_the_cached_summary(channel):
+    channel.post(5)
+    assert asyncio.run(main.summarize_channel(channel, 5, 1)) == ("tóm tắt 1", 5)
+    channel.post(2)
+    assert asyncio.run(main.summarize_channel(channel, 5, 1)) == ("tóm tắt 2", 5)
+
+    lines, previous_summary = channel.transcripts[1]
+    assert previous_summary == "tóm tắt 1"
+    assert [line.split(": ", 1)[1] for line in lines] == ["tin 6", "tin 7"]
+    assert main.channel_summaries[10]['newest_id'] == 7
+    assert main.summary_cache_stats['incremental'] == 1
+
+
+def test_unchanged_channel_reuses_the_summary(channel):
+    channel.post(3)
+    asyncio.run(main.summarize_channel(channel, 3, 1))
+    assert asyncio.run(main.summarize_channel(channel, 3, 1)) == ("tóm tắt 1", 3)
+    assert len(channel.transcripts) == 1
+    assert main.summary_cache_stats['reused'] == 1
+
+
+def test_wider_window_is_summarized_in_full(channel):
+    channel.post(10)
+    asyncio.run(main.summarize_channel(channel, 3, 1))
+    assert asyncio.run(main.summarize_channel(channel, 8, 1)) == ("tóm tắt 2", 8)
+
+    lines, previous_summary = channel.transcripts[1]
+    assert previous_summary is None
+    assert len(lines) == 8
+    assert main.summary_cache_stats['full'] == 2
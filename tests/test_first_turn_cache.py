@@ -0,0 +1,108 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import FirstTurnCache, ToneLevel
+
+
+def test_reply_is_reused_verbatim_for_other_users():
+    cache = FirstTurnCache('1', 60, 10)
+    cache.put(1, ToneLevel.NEUTER, "Xin chào!", "a", "Chào bạn, hôm nay trời đẹp quá.", 42)
+    assert cache.get(1, ToneLevel.NEUTER, "xin chào") == ("Chào bạn, hôm nay trời đẹp quá.", 42)
+    assert cache.get(1, ToneLevel.NOBLE, "xin chào") is None  # Each tone has its own replies
+    assert cache.get(2, ToneLevel.NEUTER, "xin chào") is None
+
+
+def test_reply_mentioning_the_asker_is_not_cached():
+    cache = FirstTurnCache('1', 60, 10)
+    cache.put(1, ToneLevel.NEUTER, "Xin chào", "Nam", "Chào nam, rất vui được gặp!", 42)
+    assert cache.get(1, ToneLevel.NEUTER, "Xin chào") is None
+
+
+def test_name_match_is_whole_word_only():
+    assert FirstTurnCache.mentions_name("Chào anh Nam!", "Nam")
+    assert not FirstTurnCache.mentions_name("Người Namibia", "Nam")
+    assert not FirstTurnCache.mentions_name("banana", "a")
+    assert FirstTurnCache.mentions_name("Chào [a.b]", "[a.b]")
+
+
+def test_entries_expire_and_are_evicted(monkeypatch):
+    cache = FirstTurnCache('1', 10, 2)
+    for text in ("một", "hai", "ba"):
+        cache.put(1, ToneLevel.NEUTER, text, "", f"trả lời {text}", 1)
+    assert cache.get(1, ToneLevel.NEUTER, "một") is None  # Least recently used, evicted past max_entries
+    now = time.monotonic()
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now + 11)
+    assert cache.get(1, ToneLevel.NEUTER, "ba") is None
+    assert cache.stats()['guilds'][1] == {'hits': 0, 'misses': 2, 'hit_rate': 0.0}
+
+
+def test_only_enabled_guilds_are_cached():
+    cache = FirstTurnCache('1, 3', 60, 10)
+    assert cache.enabled_for(1) and cache.enabled_for(3)
+    assert not cache.enabled_for(2)
+    assert not cache.enabled_for(None)
+    assert FirstTurnCache('*', 60, 10).enabled_for(2)
+
+
+class FakeChat:
+    def __init__(self, sent):
+        self.sent = sent
+        self._history = []
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        # Like ChatSession, turn {'role', 'parts'} dicts into contents
+        self._history = [
+            SimpleNamespace(role=turn['role'], parts=[SimpleNamespace(text=text, inline_data=None) for text in turn['parts']])
+            if isinstance(turn, dict) else turn
+            for turn in history
+        ]
+
+    async def send_message_async(self, parts, stream, generation_config):
+        self.sent.append(parts[0])
+        return SimpleNamespace(
+            text="Chào bạn!", usage_metadata=SimpleNamespace(prompt_token_count=30, candidates_token_count=5, total_token_count=35)
+        )
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    sent = []
+
+    async def ready():
+        return None
+
+    async def direct_call(priority, guild_id, call, estimated_tokens=0):
+        return await call()
+
+    monkeypatch.setattr(main, 'ensure_gemini', ready)
+    monkeypatch.setattr(main, 'call_gemini', direct_call)
+    monkeypatch.setattr(main, 'state_backend', None)
+    monkeypatch.setattr(main, 'token_usage', main.TokenUsageLedger())
+    monkeypatch.setattr(main, 'chat_sessions', main.SessionStore(max_entries=10, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60))
+    monkeypatch.setattr(main, 'first_turn_cache', FirstTurnCache('1', 60, 10))
+    monkeypatch.setattr(main, 'get_server_tone_level', lambda guild_id: ToneLevel.NEUTER)
+    monkeypatch.setattr(main.ToneStrategyFactory, 'get_model', lambda tone_level: SimpleNamespace(start_chat=lambda history: FakeChat(sent)))
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+    return sent
+
+
+def test_second_asker_is_answered_from_the_cache(gemini):
+    async def scenario():
+        first = await main.generate_chat_response("Xin chào", 10, 7, "Nam", guild_id=1)
+        second = await main.generate_chat_response("xin chào!", 10, 8, "Lan", guild_id=1)
+        return first, second
+
+    assert asyncio.run(scenario()) == ("Chào bạn!", "Chào bạn!")
+    assert gemini == ["[Tin nhắn từ Nam]: Xin chào"]
+    session = main.chat_sessions.get((1, 10, 8))
+    assert [turn.parts[0].text for turn in session['chat'].history] == ["[Tin nhắn từ Lan]: xin chào!", "Chào bạn!"]
+    assert session['history_tokens'] == 35
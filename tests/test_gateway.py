@@ -0,0 +1,77 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+
+import main
+from main import MemberNameCache
+
+
+def test_lean_gateway_drops_member_and_presence_traffic():
+    options = main.build_gateway_options(True)
+    intents = options['intents']
+    assert intents.message_content and intents.guild_messages and intents.dm_messages
+    assert not (intents.members or intents.presences or intents.typing)
+    assert options['chunk_guilds_at_startup'] is False
+    assert options['member_cache_flags'].value == 0
+
+
+def test_default_gateway_keeps_member_and_presence_intents():
+    assert main.LEAN_GATEWAY is False
+    intents = main.build_gateway_options(False)['intents']
+    assert intents.message_content and intents.members and intents.presences
+
+
+class FakeGuild:
+    def __init__(self, members):
+        self.id = 1
+        self.members = members
+        self.fetches = []
+
+    def get_member(self, user_id):
+        return None  # Nothing is cached in lean mode
+
+    async def fetch_member(self, user_id):
+        self.fetches.append(user_id)
+        if user_id not in self.members:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Member")
+        return SimpleNamespace(display_name=self.members[user_id])
+
+
+def message_from(guild, user_id, name):
+    return SimpleNamespace(author=SimpleNamespace(id=user_id, display_name=name), guild=guild, webhook_id=None)
+
+
+def test_server_nickname_is_fetched_once(monkeypatch):
+    monkeypatch.setattr(main, 'metrics_registry', [])
+    monkeypatch.setattr(main, 'member_fetches', main.Counter('member_fetches_total', ''))
+    guild = FakeGuild({7: "Nam (mod)"})
+    names = MemberNameCache(10)
+
+    async def scenario():
+        return [await names.display_name(message_from(guild, 7, "nam123")) for _ in range(2)]
+
+    assert asyncio.run(scenario()) == ["Nam (mod)", "Nam (mod)"]
+    assert guild.fetches == [7]
+    assert list(main.member_fetches.samples()) == ["member_fetches_total 1"]
+
+
+def test_departed_member_keeps_their_user_name():
+    guild = FakeGuild({})
+    names = MemberNameCache(10)
+    assert asyncio.run(names.display_name(message_from(guild, 7, "nam123"))) == "nam123"
+
+
+def test_direct_messages_need_no_lookup():
+    names = MemberNameCache(10)
+    assert asyncio.run(names.display_name(message_from(None, 7, "nam123"))) == "nam123"
+
+
+def test_name_cache_is_bounded_and_cleared_per_server():
+    names = MemberNameCache(2)
+    for user_id in range(3):
+        names.remember(1, user_id, f"user {user_id}")
+    names.remember(2, 0, "other server")
+    assert list(names._names) == [(1, 2), (2, 0)]
+    names.pop_guild(1)
+    assert list(names._names) == [(2, 0)]
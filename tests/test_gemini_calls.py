@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    async def ready():
+        return None
+
+    monkeypatch.setattr(main, 'ensure_gemini', ready)
+    monkeypatch.setattr(main, 'gemini_scheduler', main.GeminiScheduler(600, 10 ** 6, 1, 10))
+    monkeypatch.setattr(main, 'gemini_circuit', main.CircuitBreaker(1, 60))
+    monkeypatch.setattr(main, 'GEMINI_MAX_RETRIES', 0)
+
+
+def test_deadline_spent_in_queue_does_not_trip_circuit(gemini):
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_call():
+            await release.wait()
+            return "done"
+
+        busy = asyncio.create_task(main.call_gemini(main.RequestPriority.CHAT, 1, slow_call))
+        await asyncio.sleep(0.01)
+        with pytest.raises(main.SchedulerBusyError):
+            await main.call_gemini(main.RequestPriority.CHAT, 1, slow_call, deadline=0.05)
+        release.set()
+        return await busy
+
+    assert asyncio.run(scenario()) == "done"
+    assert main.gemini_circuit.state == 'closed'
+    assert main.gemini_circuit.failures == 0
+
+
+def test_api_timeout_counts_as_failure(gemini, monkeypatch):
+    monkeypatch.setattr(main, 'GEMINI_ATTEMPT_TIMEOUT', 0.01)
+
+    async def hung_call():
+        await asyncio.sleep(1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main.call_gemini(main.RequestPriority.CHAT, 1, hung_call))
+    assert main.gemini_circuit.state == 'open'
+
+
+def test_cancelled_probe_lets_the_next_caller_probe(gemini):
+    main.gemini_circuit.state = 'open'
+    main.gemini_circuit.opened_at = main.time.monotonic() - 61
+
+    async def scenario():
+        async def hung_call():
+            await asyncio.sleep(3600)
+
+        probe = asyncio.create_task(main.call_gemini(main.RequestPriority.CHAT, 1, hung_call))
+        await asyncio.sleep(0.01)
+        assert main.gemini_circuit.state == 'half_open'
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def quick_call():
+            return "ok"
+
+        return await main.call_gemini(main.RequestPriority.CHAT, 1, quick_call)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert main.gemini_circuit.state == 'closed'
@@ -0,0 +1,75 @@
+import asyncio
+import sqlite3
+
+import main
+from main import GuildConfigStore, ToneLevel
+
+
+def stored_tones(path):
+    connection = sqlite3.connect(path)
+    try:
+        return dict(connection.execute("SELECT guild_id, tone_level FROM guild_configs"))
+    finally:
+        connection.close()
+
+
+def test_changes_reach_disk_only_on_flush(tmp_path):
+    path = str(tmp_path / 'guild_configs.db')
+
+    async def scenario():
+        store = GuildConfigStore(path, 60)
+        await store.open()
+        store.set_tone_level(1, ToneLevel.NOBLE)
+        store.set_tone_level(1, ToneLevel.ELEGANT)
+        before = stored_tones(path)
+        cached = store.get_tone_level(1, ToneLevel.NEUTER)
+        await store.flush()
+        after = stored_tones(path)
+        await store.close()
+        return before, cached, after
+
+    before, cached, after = asyncio.run(scenario())
+    assert before == {}
+    assert cached == ToneLevel.ELEGANT
+    assert after == {1: ToneLevel.ELEGANT.value}
+
+
+def test_failed_flush_is_retried_without_overwriting_newer_changes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'guild_configs.db')
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+
+    async def scenario():
+        store = GuildConfigStore(path, 60)
+        await store.open()
+        write = store._write
+
+        def failing_write(batch):
+            store.set_tone_level(2, ToneLevel.FLATTERY)  # Set while the batch is being written
+            raise sqlite3.OperationalError("database is locked")
+
+        store.set_tone_level(1, ToneLevel.NOBLE)
+        store.set_tone_level(2, ToneLevel.FRIENDLY)
+        store._write = failing_write
+        await store.flush()
+        after_failure = stored_tones(path)
+        store._write = write
+        await store.close()
+        return after_failure
+
+    assert asyncio.run(scenario()) == {}
+    assert stored_tones(path) == {1: ToneLevel.NOBLE.value, 2: ToneLevel.FLATTERY.value}
+
+
+def test_invalid_stored_tone_is_ignored(tmp_path, monkeypatch):
+    path = str(tmp_path / 'guild_configs.db')
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+    store = GuildConfigStore(path, 60)
+    store.load()
+    store._connection.execute("INSERT INTO guild_configs VALUES (1, 99, 0)")
+    store._connection.commit()
+    store._connection.close()
+
+    reopened = GuildConfigStore(path, 60)
+    reopened.load()
+    assert reopened.get_tone_level(1, ToneLevel.NEUTER) == ToneLevel.NEUTER
+    reopened._connection.close()
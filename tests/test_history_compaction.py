@@ -0,0 +1,66 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def turn(role, text):
+    return SimpleNamespace(role=role, parts=[SimpleNamespace(text=text)])
+
+
+class CountingModel:
+    """Counts 100 tokens per history entry."""
+
+    async def count_tokens_async(self, history):
+        return SimpleNamespace(total_tokens=100 * len(history))
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    prompts = []
+
+    async def direct_call(priority, guild_id, call, estimated_tokens=0):
+        return await call()
+
+    async def summarize(prompt):
+        prompts.append(prompt)
+        return SimpleNamespace(text="tóm tắt cũ", usage_metadata=None)
+
+    monkeypatch.setattr(main, 'metrics_registry', [])
+    monkeypatch.setattr(main, 'history_compactions', main.Counter('compactions_total', ''))
+    monkeypatch.setattr(main, 'compaction_tokens_saved', main.Counter('tokens_saved_total', ''))
+    monkeypatch.setattr(main, 'call_gemini', direct_call)
+    monkeypatch.setattr(main, 'model', SimpleNamespace(generate_content_async=summarize))
+    monkeypatch.setattr(main, 'HISTORY_TOKEN_BUDGET', 500)
+    monkeypatch.setattr(main, 'HISTORY_KEEP_TURNS', 1)
+    return prompts
+
+
+def test_old_turns_are_folded_and_counted(gemini):
+    history = [turn('user' if i % 2 == 0 else 'model', f"lượt {i}") for i in range(8)]
+    session = {'chat': SimpleNamespace(history=history, model=CountingModel()), 'history_tokens': 800}
+
+    asyncio.run(main.compact_session_history(session))
+
+    chat_history = session['chat'].history
+    assert len(chat_history) == 4
+    assert chat_history[0]['parts'][0].startswith(main.SUMMARY_TURN_PREFIX)
+    assert chat_history[2:] == history[-2:]
+    assert "lượt 5" in gemini[0] and "lượt 6" not in gemini[0]
+    assert session['history_tokens'] == 400
+    assert list(main.history_compactions.samples()) == ["compactions_total 1"]
+    assert list(main.compaction_tokens_saved.samples()) == ["tokens_saved_total 400"]
+
+
+def test_history_under_budget_is_left_alone(gemini):
+    history = [turn('user', "a"), turn('model', "b")] * 2
+    session = {'chat': SimpleNamespace(history=history, model=CountingModel()), 'history_tokens': 800}
+
+    asyncio.run(main.compact_session_history(session))
+
+    assert session['chat'].history == history
+    assert session['history_tokens'] == 400
+    assert gemini == []
+    assert list(main.history_compactions.samples()) == []
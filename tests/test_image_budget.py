@@ -0,0 +1,76 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+import main
+
+OVER_BUDGET_USER = 1
+USER = 2
+
+
+@pytest.fixture
+def images(monkeypatch, tmp_path):
+    cache = main.ImageCache(str(tmp_path), 10 ** 7, 3600)
+    cache.load()
+    ledger = main.TokenUsageLedger()
+    ledger.record(None, OVER_BUDGET_USER, 500, 0)
+    monkeypatch.setattr(main, 'image_cache', cache)
+    monkeypatch.setattr(main, 'token_usage', ledger)
+    monkeypatch.setattr(main, 'USER_DAILY_TOKEN_BUDGET', 100)
+
+    output = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(output, format='PNG')
+    release = asyncio.Event()
+    calls = []
+
+    async def render_image(image_prompt, guild_id=None, user_id=None):
+        calls.append(user_id)
+        await release.wait()
+        return output.getvalue(), 'image/png'
+
+    monkeypatch.setattr(main, 'render_image', render_image)
+    return release, calls
+
+
+def test_budget_is_checked_for_each_caller_joining_a_request(images):
+    release, calls = images
+
+    async def scenario():
+        first = asyncio.create_task(main.generate_image_from_prompt("con mèo", "Lan", 5, USER))
+        await asyncio.sleep(0)
+        joined = await asyncio.wait_for(main.generate_image_from_prompt("con mèo", "Hùng", 5, OVER_BUDGET_USER), 1)
+        release.set()
+        return await first, joined
+
+    first, joined = asyncio.run(scenario())
+    assert calls == [USER]
+    assert isinstance(first, main.Path)
+    assert "hết hạn mức" in joined
+
+
+def test_over_budget_caller_does_not_fail_others(images):
+    release, calls = images
+    release.set()
+
+    async def scenario():
+        refused = await main.generate_image_from_prompt("con mèo", "Hùng", 5, OVER_BUDGET_USER)
+        return refused, await main.generate_image_from_prompt("con mèo", "Lan", 5, USER)
+
+    refused, generated = asyncio.run(scenario())
+    assert "hết hạn mức" in refused
+    assert isinstance(generated, main.Path)
+    assert calls == [USER]
+
+
+def test_cached_images_need_no_budget(images):
+    release, calls = images
+    release.set()
+
+    async def scenario():
+        await main.generate_image_from_prompt("con mèo", "Lan", 5, USER)
+        return await main.generate_image_from_prompt("Con mèo", "Hùng", 5, OVER_BUDGET_USER)
+
+    assert isinstance(asyncio.run(scenario()), main.Path)
+    assert calls == [USER]
@@ -0,0 +1,90 @@
+import asyncio
+
+import main
+from main import ImageCache
+
+
+def test_concurrent_requests_share_one_generation(tmp_path):
+    async def scenario():
+        cache = ImageCache(str(tmp_path), 10 ** 6, 3600)
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return b"png", 'image/png'
+
+        paths = await asyncio.gather(*(cache.get_or_generate("Một con mèo", generate) for _ in range(3)))
+        again = await cache.get_or_generate("  một con MÈO ", generate)  # Same prompt once normalized
+        return cache, calls, paths, again
+
+    cache, calls, paths, again = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert len(set(paths)) == 1 and paths[0].read_bytes() == b"png"
+    assert again == paths[0]
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 2, 1)
+
+
+def test_block_reasons_are_not_cached(tmp_path):
+    async def scenario():
+        cache = ImageCache(str(tmp_path), 10 ** 6, 3600)
+
+        async def blocked():
+            return "SAFETY"
+
+        return cache, await cache.get_or_generate("x", blocked)
+
+    cache, result = asyncio.run(scenario())
+    assert result == "SAFETY"
+    assert not cache.is_cached("x")
+
+
+def test_least_recently_used_image_is_evicted(tmp_path):
+    async def scenario():
+        cache = ImageCache(str(tmp_path), 10, 3600)
+
+        def image(size):
+            async def generate():
+                return b"x" * size, 'image/png'
+            return generate
+
+        first = await cache.get_or_generate("a", image(4))
+        await cache.get_or_generate("b", image(4))
+        await cache.get_or_generate("a", image(4))  # Hit: "a" is now the most recently used
+        await cache.get_or_generate("c", image(4))
+        return cache, first
+
+    cache, first = asyncio.run(scenario())
+    assert cache.is_cached("a") and cache.is_cached("c") and not cache.is_cached("b")
+    assert first.exists()
+    assert cache.stats()['bytes'] == 8 and cache.evictions == 1
+
+
+def test_expired_image_is_generated_again(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'time', lambda: now[0])
+
+    async def generate():
+        return b"png", 'image/png'
+
+    cache = ImageCache(str(tmp_path), 10 ** 6, 60)
+    path = asyncio.run(cache.get_or_generate("a", generate))
+    now[0] += 61
+    assert not cache.is_cached("a")
+    assert not path.exists()
+
+
+def test_images_on_disk_are_indexed_at_startup(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+
+    async def generate():
+        return b"png", 'image/png'
+
+    asyncio.run(ImageCache(str(tmp_path), 10 ** 6, 3600).get_or_generate("a", generate))
+    (tmp_path / "interrupted.tmp").write_bytes(b"partial")
+
+    cache = ImageCache(str(tmp_path), 10 ** 6, 3600)
+    cache.load()
+    assert cache.is_cached("a")
+    assert not (tmp_path / "interrupted.tmp").exists()
+    assert cache.stats()['bytes'] == 3
@@ -0,0 +1,27 @@
+import io
+
+import pytest
+from PIL import Image
+
+from image_processing import make_thumbnail, process_image
+
+
+def png_bytes(size=(64, 48)):
+    output = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(output, format='PNG')
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('image_format, mime_type', [('webp', 'image/webp'), ('jpeg', 'image/jpeg')])
+def test_process_image_encodes_supported_formats(image_format, mime_type):
+    data, result_mime_type = process_image(png_bytes(), image_format, 1024 * 1024, 1536)
+    assert result_mime_type == mime_type
+    assert Image.open(io.BytesIO(data)).format == image_format.upper()
+
+
+@pytest.mark.parametrize('image_format', ['png', 'jpg', ''])
+def test_unsupported_output_format_is_rejected(image_format):
+    with pytest.raises(ValueError):
+        process_image(png_bytes(), image_format, 1024 * 1024, 1536)
+    with pytest.raises(ValueError):
+        make_thumbnail(png_bytes(), 32, image_format)
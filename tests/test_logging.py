@@ -0,0 +1,61 @@
+import json
+import logging
+import sys
+
+import main
+
+
+class RecordingLogger:
+    def __init__(self, level=logging.INFO):
+        self.level = level
+        self.records = []
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def log(self, level, message, exc_info=None, extra=None):
+        self.records.append((level, message, extra))
+
+
+def test_records_are_formatted_as_json_lines():
+    record = logging.LogRecord('discord_chatbot', logging.ERROR, __file__, 1, "Lỗi %s", ("Gemini",), None)
+    record.event = 'gemini_chat_failed'
+    record.fields = {'guild_id': 1, 'user': "Nam"}
+    try:
+        raise ValueError("hỏng")
+    except ValueError:
+        record.exc_info = sys.exc_info()
+    main.StructuredQueueHandler(None).prepare(record)
+
+    line = main.JsonFormatter().format(record)
+    assert "\n" not in line and "Lỗi Gemini" in line  # Non-ASCII text is kept readable
+    entry = json.loads(line)
+    assert entry['level'] == 'ERROR' and entry['event'] == 'gemini_chat_failed'
+    assert entry['guild_id'] == 1 and entry['user'] == "Nam"
+    assert "ValueError: hỏng" in entry['exception']
+
+
+def test_message_content_is_redacted_by_default(monkeypatch):
+    assert main.redact_content("xin chào") == "<8 chars>"
+    monkeypatch.setattr(main, 'LOG_CONTENT', 'truncate')
+    monkeypatch.setattr(main, 'LOG_CONTENT_MAX_CHARS', 3)
+    assert main.redact_content("xin chào") == "xin…"
+    assert main.redact_content("xin") == "xin"
+    monkeypatch.setattr(main, 'LOG_CONTENT', 'full')
+    assert main.redact_content("xin chào") == "xin chào"
+
+
+def test_sampled_events_are_dropped_at_their_rate(monkeypatch):
+    logger = RecordingLogger()
+    monkeypatch.setattr(main, 'log', logger)
+    monkeypatch.setattr(main, 'log_sample_rates', {'message_received': 0.25})
+    draws = iter([0.1, 0.5, 0.9, 0.2])
+    monkeypatch.setattr(main.random, 'random', lambda: next(draws))
+
+    for _ in range(4):
+        main.log_event(logging.INFO, 'message_received', "Message received", channel_id=1)
+    main.log_event(logging.INFO, 'session_created', "Created new chat session")  # Not sampled
+    main.log_event(logging.DEBUG, 'message_received', "Below the log level")
+
+    assert [extra['event'] for _, _, extra in logger.records] == ['message_received', 'message_received', 'session_created']
+    assert logger.records[0][2]['fields'] == {'channel_id': 1}
@@ -0,0 +1,36 @@
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(main, 'metrics_registry', [])
+
+
+def test_gauge_value():
+    gauge = main.Gauge('test_gauge_value', 'Test gauge', ('kind',))
+    assert gauge.value('a') == 0
+    gauge.set(2.5, 'a')
+    assert gauge.value('a') == 2.5
+    assert gauge.value('b') == 0
+
+
+def test_function_gauge_value_is_read_live():
+    readings = iter([1, 2])
+    gauge = main.Gauge('test_function_gauge', 'Test gauge', function=lambda: next(readings))
+    assert gauge.value() == 1
+    assert gauge.value() == 2
+
+
+def test_metrics_render_in_prometheus_format():
+    counter = main.Counter('test_requests_total', 'Test counter', ('operation',))
+    counter.inc('chat')
+    counter.inc('chat', amount=2)
+    histogram = main.Histogram('test_latency_seconds', 'Test histogram', (), (0.1, 1))
+    histogram.observe(0.5)
+    rendered = main.render_metrics()
+    assert 'test_requests_total{operation="chat"} 3' in rendered
+    assert 'test_latency_seconds_bucket{le="0.1"} 0' in rendered
+    assert 'test_latency_seconds_bucket{le="1"} 1' in rendered
+    assert 'test_latency_seconds_count 1' in rendered
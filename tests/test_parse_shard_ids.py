@@ -0,0 +1,20 @@
+import pytest
+
+from main import parse_shard_ids
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('', None),
+    ('  ', None),
+    ('3', [3]),
+    ('0-3', [0, 1, 2, 3]),
+    ('0,2,5', [0, 2, 5]),
+    ('0-1, 4-5', [0, 1, 4, 5]),
+])
+def test_parse_shard_ids(value, expected):
+    assert parse_shard_ids(value) == expected
+
+
+def test_invalid_shard_ids_raise():
+    with pytest.raises(ValueError):
+        parse_shard_ids('a-b')
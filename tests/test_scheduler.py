@@ -0,0 +1,204 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import GeminiScheduler, RequestPriority, TokenBucket
+
+
+def test_token_bucket_refills_over_time(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60) == 0
+    bucket.consume(61)  # Overspending leaves a debt
+    assert bucket.wait_time(1) == pytest.approx(2)
+    now[0] += 2
+    assert bucket.wait_time(1) == pytest.approx(0)
+    assert bucket.wait_time(1000) == pytest.approx(59)  # Capped at the capacity
+
+
+def run_in_order(submissions):
+    """Submit (priority, guild_id, name) calls behind a blocking one and return the order they ran in."""
+    async def scenario():
+        scheduler = GeminiScheduler(10 ** 6, 10 ** 9, 1, 100)
+        started = []
+        release = asyncio.Event()
+
+        def call(name):
+            async def run():
+                started.append(name)
+                if name == 'blocker':
+                    await release.wait()
+                return name
+            return run
+
+        blocker = asyncio.create_task(scheduler.submit(RequestPriority.IMAGE, 0, call('blocker')))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(scheduler.submit(priority, guild_id, call(name))) for priority, guild_id, name in submissions]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+        return started[1:]
+
+    return asyncio.run(scenario())
+
+
+def test_requests_run_by_priority():
+    order = run_in_order([
+        (RequestPriority.IMAGE, 1, 'image'),
+        (RequestPriority.SUMMARY, 1, 'summary'),
+        (RequestPriority.CHAT, 1, 'chat'),
+    ])
+    assert order == ['chat', 'summary', 'image']
+
+
+def test_guilds_take_turns_within_a_priority():
+    order = run_in_order([
+        (RequestPriority.CHAT, 1, 'a1'),
+        (RequestPriority.CHAT, 1, 'a2'),
+        (RequestPriority.CHAT, 1, 'a3'),
+        (RequestPriority.CHAT, 2, 'b1'),
+    ])
+    assert order == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_full_queue_is_refused():
+    async def scenario():
+        scheduler = GeminiScheduler(10 ** 6, 10 ** 9, 1, 1)
+        release = asyncio.Event()
+
+        async def wait():
+            await release.wait()
+
+        running = asyncio.create_task(scheduler.submit(RequestPriority.CHAT, 1, wait))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(scheduler.submit(RequestPriority.CHAT, 1, wait))
+        await asyncio.sleep(0)
+        with pytest.raises(main.SchedulerBusyError):
+            await scheduler.submit(RequestPriority.CHAT, 1, wait)
+        release.set()
+        await asyncio.gather(running, queued)
+        return scheduler.rejected
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_dispatch_waits_for_request_quota():
+    async def scenario():
+        scheduler = GeminiScheduler(1200, 10 ** 9, 10, 100)  # 20 requests a second
+        scheduler.requests.tokens = 0
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        started = []
+
+        async def call():
+            started.append(loop.time() - started_at)
+
+        await asyncio.gather(*(scheduler.submit(RequestPriority.CHAT, 1, call) for _ in range(2)))
+        return started
+
+    first, second = asyncio.run(scenario())
+    assert first >= 0.04
+    assert second - first >= 0.04
+
+
+def test_token_quota_is_settled_with_real_usage():
+    async def scenario():
+        scheduler = GeminiScheduler(10 ** 6, 6000, 10, 100)  # 100 tokens a second
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+
+        async def call():
+            return SimpleNamespace(usage_metadata=SimpleNamespace(total_token_count=6000))
+
+        await scheduler.submit(RequestPriority.CHAT, 1, call, estimated_tokens=10)
+        first_done = loop.time() - started_at
+        await scheduler.submit(RequestPriority.CHAT, 1, call, estimated_tokens=10)  # Waits for the overspend to refill
+        return first_done, loop.time() - started_at
+
+    first_done, second_done = asyncio.run(scenario())
+    assert first_done < 0.05
+    assert second_done >= 0.09
+
+
+class FakeContext:
+    """A prefix command context in direct messages, where there is no guild."""
+
+    def __init__(self):
+        self.guild = None
+        self.author = SimpleNamespace(id=7, display_name="Nam")
+        self.replies = []
+
+    async def reply(self, content=None, **kwargs):
+        self.replies.append(content)
+
+    def typing(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+def test_imagine_in_direct_messages_is_scheduled_without_a_guild(monkeypatch):
+    calls = []
+
+    async def generate(prompt, user_name, guild_id, user_id):
+        calls.append((prompt, guild_id, user_id))
+        return "Hết lượt tạo ảnh hôm nay"
+
+    monkeypatch.setattr(main, 'generate_image_from_prompt', generate)
+    ctx = FakeContext()
+    asyncio.run(main.imagine_command.callback(ctx, prompt="một con mèo"))
+    assert calls == [("một con mèo", None, 7)]
+    assert ctx.replies[-1] == "Hết lượt tạo ảnh hôm nay"
+
+
+def test_abandoned_requests_are_dropped_without_using_quota():
+    async def scenario():
+        scheduler = GeminiScheduler(60, 6000, 1, 100)
+        release = asyncio.Event()
+
+        async def wait():
+            await release.wait()
+
+        async def call():
+            return "ok"
+
+        running = asyncio.create_task(scheduler.submit(RequestPriority.CHAT, 1, wait))
+        await asyncio.sleep(0)
+        abandoned = asyncio.create_task(scheduler.submit(RequestPriority.CHAT, 1, call, estimated_tokens=6000))
+        await asyncio.sleep(0)
+        abandoned.cancel()
+        release.set()
+        await running
+        result = await asyncio.wait_for(scheduler.submit(RequestPriority.CHAT, 1, call, estimated_tokens=10), 1)
+        return result, scheduler
+
+    result, scheduler = asyncio.run(scenario())
+    assert result == "ok"
+    assert scheduler.abandoned == 1
+    assert scheduler.requests.tokens == pytest.approx(58, abs=0.1)
+    assert scheduler.tokens.tokens == pytest.approx(5990, abs=1)
+
+
+def test_caller_giving_up_frees_the_running_slot():
+    async def scenario():
+        scheduler = GeminiScheduler(10 ** 6, 10 ** 9, 1, 100)
+
+        async def hung():
+            await asyncio.sleep(3600)
+
+        async def call():
+            return "ok"
+
+        stuck = asyncio.create_task(scheduler.submit(RequestPriority.CHAT, 1, hung))
+        await asyncio.sleep(0.01)
+        stuck.cancel()
+        return await asyncio.wait_for(scheduler.submit(RequestPriority.CHAT, 1, call), 1)
+
+    assert asyncio.run(scenario()) == "ok"
@@ -0,0 +1,113 @@
+import asyncio
+
+import main
+
+
+def test_single_message_runs_without_delay():
+    async def scenario():
+        queue = main.SessionMessageQueue()
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+
+        async def runner(prompt):
+            return f"reply to {prompt}"
+
+        reply = await queue.submit((1, 2, 3), "xin chào", runner)
+        return reply, loop.time() - started_at
+
+    reply, elapsed = asyncio.run(scenario())
+    assert reply == "reply to xin chào"
+    assert elapsed < 0.1
+
+
+def test_burst_while_busy_is_merged_into_one_call():
+    async def scenario():
+        queue = main.SessionMessageQueue()
+        prompts = []
+        release = asyncio.Event()
+
+        async def runner(prompt):
+            prompts.append(prompt)
+            if len(prompts) == 1:
+                await release.wait()
+            return prompt
+
+        first = asyncio.create_task(queue.submit((1, 2, 3), "một", runner))
+        await asyncio.sleep(0)
+        burst = [asyncio.create_task(queue.submit((1, 2, 3), text, runner)) for text in ("hai", "ba", "bốn")]
+        await asyncio.sleep(0)
+        release.set()
+        return prompts, await first, await asyncio.gather(*burst), queue.merged_messages
+
+    prompts, first, burst, merged = asyncio.run(scenario())
+    assert prompts == ["một", "hai\nba\nbốn"]
+    assert first == "một"
+    assert burst == [None, None, "hai\nba\nbốn"]  # Only the latest message gets the reply
+    assert merged == 2
+
+
+def test_uncoalesced_messages_are_sent_separately():
+    async def scenario():
+        queue = main.SessionMessageQueue()
+        prompts = []
+
+        async def runner(prompt):
+            prompts.append(prompt)
+            await asyncio.sleep(0)
+            return prompt
+
+        await asyncio.gather(*(queue.submit((1, 2, 3), text, runner, coalesce=False) for text in ("a", "b")))
+        return prompts
+
+    assert asyncio.run(scenario()) == ["a", "b"]
+
+
+def test_cancelled_worker_resolves_every_waiter():
+    async def scenario():
+        queue = main.SessionMessageQueue()
+
+        async def runner(prompt):
+            await asyncio.sleep(3600)
+
+        waiters = [asyncio.create_task(queue.submit((1, 2, 3), text, runner, coalesce=False)) for text in ("a", "b")]
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        queue._workers[(1, 2, 3)].cancel()
+        results = await asyncio.wait_for(asyncio.gather(*waiters, return_exceptions=True), 1)
+        return results, queue._workers, queue._batches
+
+    results, workers, batches = asyncio.run(scenario())
+    assert all(isinstance(result, asyncio.CancelledError) for result in results)
+    assert not workers and not batches
+
+
+def test_burst_within_debounce_window_gets_one_call_and_one_reply():
+    async def scenario():
+        queue = main.SessionMessageQueue(debounce_seconds=0.05)
+        prompts = []
+
+        async def runner(prompt):
+            prompts.append(prompt)
+            return f"reply to {prompt}"
+
+        waiters = []
+        for text in ("một", "hai", "ba"):
+            waiters.append(asyncio.create_task(queue.submit((1, 2, 3), text, runner)))
+            await asyncio.sleep(0.01)
+        return prompts, await asyncio.gather(*waiters)
+
+    prompts, replies = asyncio.run(scenario())
+    assert prompts == ["một\nhai\nba"]
+    assert replies == [None, None, "reply to một\nhai\nba"]
+
+
+def test_debounce_does_not_delay_uncoalesced_requests():
+    async def scenario():
+        queue = main.SessionMessageQueue(debounce_seconds=10)
+
+        async def runner(prompt):
+            return prompt
+
+        return await asyncio.wait_for(queue.submit((1, 2, 3), "a", runner, coalesce=False), 1)
+
+    assert asyncio.run(scenario()) == "a"
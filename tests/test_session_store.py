@@ -0,0 +1,204 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import SessionStore
+
+
+def fake_session(text="xin chào", tone_level=main.ToneLevel.NEUTER):
+    part = SimpleNamespace(text=text, inline_data=None)
+    return {'chat': SimpleNamespace(history=[SimpleNamespace(role='user', parts=[part])]), 'tone_level': tone_level}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_least_recently_used_session_is_evicted():
+    store = SessionStore(max_entries=3, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    for user_id in range(3):
+        store.put((1, 10, user_id), fake_session())
+    store.get((1, 10, 0))
+    store.put((1, 10, 3), fake_session())
+    assert sorted(store.keys()) == [(1, 10, 0), (1, 10, 2), (1, 10, 3)]
+    assert store.stats()['evictions'] == 1
+
+
+def test_byte_budget_evicts_but_keeps_the_newest_session():
+    store = SessionStore(max_entries=100, max_bytes=10, idle_ttl=60, sweep_interval=60)
+    store.put((1, 10, 0), fake_session("12345"))
+    store.put((1, 10, 1), fake_session("123456789"))
+    assert store.keys() == [(1, 10, 1)]
+    store.put((1, 10, 2), fake_session("x" * 50))  # Too large on its own, but never evicted
+    assert store.keys() == [(1, 10, 2)]
+    assert store.total_bytes == 50
+
+
+def test_touch_remeasures_grown_history():
+    store = SessionStore(max_entries=100, max_bytes=10, idle_ttl=60, sweep_interval=60)
+    session = fake_session("ab")
+    store.put((1, 10, 0), session)
+    store.put((1, 10, 1), fake_session("cd"))
+    session['chat'].history.append(SimpleNamespace(role='model', parts=[SimpleNamespace(text="x" * 8, inline_data=None)]))
+    store.touch((1, 10, 0))  # Now 10 + 2 bytes: the other, least recently used session goes
+    assert store.keys() == [(1, 10, 0)]
+    assert store.total_bytes == 10
+
+
+def test_replacing_a_session_does_not_leak_its_size():
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    store.put((1, 10, 0), fake_session("abc"))
+    store.put((1, 10, 0), fake_session("abcdef"))
+    assert len(store) == 1
+    assert store.total_bytes == 6
+
+
+def test_expired_session_is_a_miss(clock):
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    store.put((1, 10, 0), fake_session())
+    clock[0] += 59
+    assert store.get((1, 10, 0)) is not None  # Using a session restarts its TTL
+    clock[0] += 59
+    assert store.get((1, 10, 0)) is not None
+    clock[0] += 61
+    assert store.get((1, 10, 0)) is None
+    assert store.stats()['hits'] == 2 and store.stats()['expirations'] == 1
+
+
+def test_sweep_only_drops_idle_sessions(clock):
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    store.put((1, 10, 0), fake_session())
+    clock[0] += 30
+    store.put((1, 10, 1), fake_session())
+    clock[0] += 31
+    assert store.sweep() == 1
+    assert store.keys() == [(1, 10, 1)]
+
+
+def test_background_sweeper_expires_sessions():
+    async def scenario():
+        store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=0.01, sweep_interval=0.02)
+        store.put((1, 10, 0), fake_session())
+        store.start_sweeper()
+        await asyncio.sleep(0.1)
+        await store.close()
+        return len(store)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_guild_invalidation_only_clears_that_guild():
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    for key in [(1, 10, 0), (1, 11, 0), (2, 20, 0)]:
+        store.put(key, fake_session())
+    assert store.pop_guild(1) == 2
+    assert store.keys() == [(2, 20, 0)]
+    assert store.pop_guild(1) == 0
+
+
+def test_channel_invalidation_skips_sessions_already_evicted():
+    store = SessionStore(max_entries=2, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    for user_id in range(3):
+        store.put((1, 10, user_id), fake_session())  # The first one is evicted
+    store.put((1, 11, 0), fake_session())
+    assert store.pop_channel(10) == 1
+    assert store.keys() == [(1, 11, 0)]
+
+
+def test_removing_a_server_clears_its_sessions(monkeypatch):
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    store.put((1, 10, 0), fake_session())
+    store.put((2, 20, 0), fake_session())
+    monkeypatch.setattr(main, 'chat_sessions', store)
+    monkeypatch.setattr(main, 'state_backend', None)
+
+    asyncio.run(main.on_guild_remove(SimpleNamespace(id=1)))
+
+    assert store.keys() == [(2, 20, 0)]
+
+
+def test_spilled_sessions_are_restored_and_snapshotted(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+
+    async def first_run():
+        store = SessionStore(max_entries=2, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60,
+                             spill=main.SessionSpillStore(path, 60), spill_after=30)
+        assert await store.open() == 0
+        for user_id in range(3):
+            store.put((1, 10, user_id), fake_session(f"tin {user_id}"))
+        await store._spill_task
+        payload = await store.take_spilled((1, 10, 0))
+        assert payload['history'][0]['parts'][0]['text'] == "tin 0"
+        assert await store.take_spilled((1, 10, 0)) is None
+        await store.close()
+        return store.stats()
+
+    async def second_run():
+        store = SessionStore(max_entries=10, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60,
+                             spill=main.SessionSpillStore(path, 60))
+        stored = await store.open()
+        payload = await store.take_spilled((1, 10, 2))
+        assert await store.discard((1, 10, 1))
+        await store.close()
+        return stored, payload
+
+    stats = asyncio.run(first_run())
+    assert stats['spilled'] == 3 and stats['restored'] == 1 and stats['restore_misses'] == 1
+    stored, payload = asyncio.run(second_run())
+    assert stored == 2
+    assert payload['history'][0]['parts'][0]['text'] == "tin 2"
+
+
+def test_sessions_in_use_are_not_evicted():
+    store = SessionStore(max_entries=2, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    busy = {(1, 10, 0)}
+    store.in_use = busy.__contains__
+    for user_id in range(3):
+        store.put((1, 10, user_id), fake_session())
+    assert sorted(store.keys()) == [(1, 10, 0), (1, 10, 2)]
+    busy.clear()
+    store.put((1, 10, 3), fake_session())
+    assert sorted(store.keys()) == [(1, 10, 2), (1, 10, 3)]
+
+
+def test_sweep_skips_sessions_in_use(clock):
+    store = SessionStore(max_entries=100, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    store.in_use = lambda session_key: session_key == (1, 10, 0)
+    store.put((1, 10, 0), fake_session())
+    store.put((1, 10, 1), fake_session())
+    clock[0] += 61
+    assert store.sweep() == 1
+    assert store.keys() == [(1, 10, 0)]
+
+
+def test_session_stays_stored_while_its_reply_is_generated():
+    store = SessionStore(max_entries=1, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60)
+    queue = main.SessionMessageQueue()
+    store.in_use = queue.is_busy
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow_reply(prompt):
+            store.put((1, 10, 0), fake_session(prompt))
+            await release.wait()
+            store.touch((1, 10, 0))
+            return prompt
+
+        async def other_user(prompt):
+            store.put((1, 10, 1), fake_session(prompt))  # Over max_entries while the first reply is pending
+            return prompt
+
+        pending = asyncio.create_task(queue.submit((1, 10, 0), "một", slow_reply))
+        await asyncio.sleep(0)
+        await queue.submit((1, 10, 1), "hai", other_user)
+        release.set()
+        await pending
+        return store.keys()
+
+    assert asyncio.run(scenario()) == [(1, 10, 0)]
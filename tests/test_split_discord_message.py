@@ -0,0 +1,47 @@
+import main
+from main import split_discord_message
+
+
+def test_short_text_is_one_message():
+    assert split_discord_message("xin chào") == ["xin chào"]
+
+
+def test_paragraphs_are_split_within_the_limit():
+    paragraphs = [f"Đoạn {index}: " + "chữ " * 60 for index in range(30)]
+    text = "\n\n".join(paragraphs)
+    parts = split_discord_message(text, limit=500)
+    assert len(parts) > 1
+    assert all(len(part) <= 500 for part in parts)
+    assert "".join(parts).replace("\n", "") == text.replace("\n", "")
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    code = "\n".join(f"print({index})" for index in range(200))
+    parts = split_discord_message(f"Ví dụ:\n```python\n{code}\n```\nXong.", limit=400)
+    assert len(parts) > 2
+    for part in parts:
+        assert len(part) <= 400
+        assert part.count(main.FENCE_MARKER) % 2 == 0
+    assert all(part.lstrip().startswith("```python") for part in parts[1:-1])
+
+
+def test_a_single_long_line_is_wrapped():
+    parts = split_discord_message("a" * 5000)
+    assert all(len(part) <= main.DISCORD_MESSAGE_LIMIT for part in parts)
+    assert "".join(parts).replace("\n", "") == "a" * 5000
+
+
+def test_truncated_reply_keeps_its_code_block_closed(monkeypatch):
+    monkeypatch.setattr(main, 'output_waste_stats', {})
+    code = "\n".join(f"print({index})" for index in range(1000))
+    kept = main.split_reply(f"```python\n{code}\n```", 'chat', 2, 2000)
+    assert len(kept) == 2
+    assert all(len(part) <= main.DISCORD_MESSAGE_LIMIT for part in kept)
+    assert kept[-1].endswith("...")
+    assert not main._fence_is_open(kept[-1])
+    assert main.output_waste_stats['chat']['replies'] == 1
+
+
+def test_truncated_prose_just_gets_an_ellipsis():
+    assert main.mark_truncated("a" * 2000) == "a" * 1997 + "..."
+    assert main.mark_truncated("xin chào") == "xin chào..."
@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+from discord import app_commands
+
+import main
+
+
+def build_tree(*names):
+    tree = app_commands.CommandTree(discord.Client(intents=discord.Intents.none()))
+    for name in names:
+        async def callback(interaction: discord.Interaction):
+            pass
+        tree.add_command(app_commands.Command(name=name, description=f"Lệnh {name}", callback=callback))
+    return tree
+
+
+def test_command_hash_only_changes_with_the_definitions():
+    digest = main.command_tree_hash(build_tree('chat', 'summary'), 1)
+    assert main.command_tree_hash(build_tree('summary', 'chat'), 1) == digest  # Registration order does not matter
+    assert main.command_tree_hash(build_tree('chat', 'summary', 'imagine'), 1) != digest
+    assert main.command_tree_hash(build_tree('chat', 'summary'), 2) != digest
+
+
+def test_commands_are_synced_only_when_changed(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'COMMAND_HASH_FILE', str(tmp_path / 'data' / 'command_tree.sha256'))
+    monkeypatch.setattr(main, 'startup_timer', main.StartupTimer(0.0))
+    syncs = []
+
+    def bot_with(*names):
+        tree = build_tree(*names)
+
+        async def sync():
+            syncs.append(names)
+            return tree.get_commands()
+
+        tree.sync = sync
+        return SimpleNamespace(tree=tree, application_id=1)
+
+    async def scenario():
+        await main.GeminiBot.sync_commands_if_changed(bot_with('chat'))
+        await main.GeminiBot.sync_commands_if_changed(bot_with('chat'))  # e.g. after a restart
+        await main.GeminiBot.sync_commands_if_changed(bot_with('chat', 'imagine'))
+
+    asyncio.run(scenario())
+    assert syncs == [('chat',), ('chat', 'imagine')]
+    assert 'command_sync' in main.startup_timer.phases
+
+
+def test_startup_phases_are_timed_back_to_back(monkeypatch):
+    now = [10.0]
+    monkeypatch.setattr(main.time, 'perf_counter', lambda: now[0])
+    logged = []
+    monkeypatch.setattr(main, 'log_event', lambda level, event, message, **fields: logged.append((event, fields)))
+
+    timer = main.StartupTimer(10.0)
+    now[0] = 10.5
+    timer.mark('imports')
+    now[0] = 12.0
+    timer.mark('gateway_connect')
+    timer.report()
+    timer.report()
+    timer.record('gemini_init', 3.0)  # Finished in the background after the report
+
+    assert timer.phases == {'imports': 0.5, 'gateway_connect': 1.5, 'gemini_init': 3.0}
+    assert [event for event, _ in logged] == ['startup_complete', 'startup_phase']
+    assert logged[0][1]['total_seconds'] == 2.0
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from main import GuildConfigStore, RedisStateBackend, ToneLevel
+
+
+class FakeRedis:
+    """The redis.asyncio commands used by RedisStateBackend, in memory and with a settable clock."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.fail = False
+        self._data = {}
+        self._expires_at = {}
+
+    def _live(self, key):
+        if self.fail:
+            raise ConnectionError("Redis is down")
+        key = key.encode() if isinstance(key, str) else key
+        if self._expires_at.get(key, float('inf')) <= self.now:
+            self._data.pop(key, None)
+            self._expires_at.pop(key, None)
+        return key
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def get(self, key):
+        return self._data.get(self._live(key))
+
+    async def set(self, key, value, ex=None):
+        key = self._live(key)
+        self._data[key] = self._bytes(value)
+        self._expires_at.pop(key, None)
+        if ex is not None:
+            self._expires_at[key] = self.now + ex
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            key = self._live(key)
+            self._expires_at.pop(key, None)
+            deleted += self._data.pop(key, None) is not None
+        return deleted
+
+    async def expire(self, key, seconds):
+        key = self._live(key)
+        if key in self._data:
+            self._expires_at[key] = self.now + seconds
+
+    async def sadd(self, key, *members):
+        self._data.setdefault(self._live(key), set()).update(self._bytes(member) for member in members)
+
+    async def smembers(self, key):
+        return set(self._data.get(self._live(key), set()))
+
+    async def hset(self, key, mapping):
+        self._data.setdefault(self._live(key), {}).update(
+            {self._bytes(field): self._bytes(value) for field, value in mapping.items()}
+        )
+
+    async def hgetall(self, key):
+        return dict(self._data.get(self._live(key), {}))
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+@pytest.fixture
+def backend(redis):
+    return RedisStateBackend(redis, 'test:', 60)
+
+
+def test_sessions_round_trip(backend):
+    async def scenario():
+        await backend.save_session((1, 10, 7), b'history')
+        return await backend.load_session((1, 10, 7)), await backend.load_session((1, 10, 8))
+
+    assert asyncio.run(scenario()) == (b'history', None)
+
+
+def test_sessions_expire_after_the_idle_ttl(backend, redis):
+    async def scenario():
+        await backend.save_session((1, 10, 7), b'history')
+        redis.now += 59
+        still_there = await backend.load_session((1, 10, 7))
+        redis.now += 1
+        return still_there, await backend.load_session((1, 10, 7))
+
+    assert asyncio.run(scenario()) == (b'history', None)
+
+
+def test_sessions_are_invalidated_by_index(backend):
+    async def scenario():
+        for session_key in [(1, 10, 7), (1, 10, 8), (1, 11, 7), (2, 20, 7)]:
+            await backend.save_session(session_key, b'history')
+        deleted = [
+            await backend.delete_channel_sessions(10),
+            await backend.delete_guild_sessions(1),
+            await backend.delete_session((2, 20, 7)),
+            await backend.delete_session((2, 20, 7)),
+        ]
+        return deleted, await backend.load_session((1, 11, 7))
+
+    assert asyncio.run(scenario()) == ([2, 1, True, False], None)
+
+
+def test_real_session_payload_survives_the_backend(backend):
+    part = SimpleNamespace(text="xin chào", inline_data=None)
+    session = {
+        'chat': SimpleNamespace(history=[SimpleNamespace(role='user', parts=[part])]),
+        'tone_level': ToneLevel.FRIENDLY,
+        'history_tokens': 12,
+    }
+
+    async def scenario():
+        await backend.save_session((1, 10, 7), main.serialize_session(session))
+        return main.deserialize_session(await backend.load_session((1, 10, 7)))
+
+    payload = asyncio.run(scenario())
+    assert payload['tone_level'] == ToneLevel.FRIENDLY.value
+    assert payload['history'] == [{'role': 'user', 'parts': [{'text': "xin chào"}]}]
+
+
+def test_guild_configs_are_shared_between_processes(backend, redis):
+    async def scenario():
+        first = GuildConfigStore('unused.db', 60, backend)
+        second = GuildConfigStore('unused.db', 60, RedisStateBackend(redis, 'test:', 60))
+        await first.open()
+        await second.open()
+        first.set_tone_level(1, ToneLevel.NOBLE)
+        await first.flush()
+        await second.flush()
+        return second.get_tone_level(1, ToneLevel.NEUTER)
+
+    assert asyncio.run(scenario()) == ToneLevel.NOBLE
+
+
+def test_guild_config_changes_are_kept_while_redis_is_down(backend, redis):
+    async def scenario():
+        store = GuildConfigStore('unused.db', 60, backend)
+        await store.open()
+        store.set_tone_level(1, ToneLevel.ELEGANT)
+        redis.fail = True
+        await store.flush()
+        redis.fail = False
+        await store.flush()
+        return await backend.load_tone_levels()
+
+    assert asyncio.run(scenario()) == {1: ToneLevel.ELEGANT.value}
+
+
+def test_guild_configs_round_trip_through_sqlite(tmp_path):
+    path = str(tmp_path / 'guild_configs.db')
+
+    async def save():
+        store = GuildConfigStore(path, 60)
+        await store.open()
+        store.set_tone_level(1, ToneLevel.FLATTERY)
+        await store.close()
+
+    async def load():
+        store = GuildConfigStore(path, 60)
+        await store.open()
+        tone_level = store.get_tone_level(1, ToneLevel.NEUTER)
+        await store.close()
+        return tone_level
+
+    asyncio.run(save())
+    assert asyncio.run(load()) == ToneLevel.FLATTERY
+
+
+def test_backend_selection(monkeypatch):
+    monkeypatch.setattr(main, 'STATE_BACKEND', 'local')
+    assert main.create_state_backend() is None
+    monkeypatch.setattr(main, 'STATE_BACKEND', 'memcached')
+    with pytest.raises(ValueError):
+        main.create_state_backend()
+
+
+def test_redis_backend_without_the_redis_package_fails_at_startup():
+    # Import the bot with the redis package hidden, as if it was not installed
+    script = (
+        "import sys; sys.modules['redis'] = None; sys.modules['redis.asyncio'] = None; "
+        "import main; assert main.aioredis is None and main.state_backend is None; "
+        "main.STATE_BACKEND = 'redis'; main.create_state_backend()"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, '-c', script], cwd=root, capture_output=True, text=True,
+        env={**os.environ, 'STATE_BACKEND': 'local'}
+    )
+    assert result.returncode == 1
+    assert "STATE_BACKEND=redis needs the redis package" in result.stderr
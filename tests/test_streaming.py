@@ -0,0 +1,137 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def text_content(role, text):
+    return SimpleNamespace(role=role, parts=[SimpleNamespace(text=text, inline_data=None)])
+
+
+class FakeStream:
+    """A streamed response that yields its chunks one by one, like the Gemini SDK's."""
+
+    def __init__(self, chunks, hang=False):
+        self.chunks = chunks
+        self.hang = hang
+        self.done = False
+        self.text = "".join(chunks)
+        self.usage_metadata = SimpleNamespace(prompt_token_count=10, candidates_token_count=5, total_token_count=15)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield SimpleNamespace(candidates=[SimpleNamespace(content=text_content('model', chunk))])
+        if self.hang:
+            await asyncio.sleep(3600)
+        self.done = True
+
+
+class FakeChat:
+    """Mimics ChatSession: an unfinished stream breaks history and rewind until it is replaced."""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self._history = []
+        self._pending = None
+
+    @property
+    def history(self):
+        if self._pending is not None:
+            sent, response = self._pending
+            if not response.done:
+                raise RuntimeError("Please let the response complete iteration before accessing the final accumulated attributes")
+            self._history += [sent, text_content('model', response.text)]
+            self._pending = None
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = list(history)
+        self._pending = None
+
+    def rewind(self):
+        if self._pending is not None and not self._pending[1].done:
+            raise RuntimeError("Please let the response complete iteration before accessing the final accumulated attributes")
+        self._pending = None
+
+    async def send_message_async(self, parts, stream, generation_config):
+        _ = self.history  # Fails if the previous stream was left unfinished
+        response = self.replies.pop(0)
+        self._pending = (text_content('user', parts[0]), response)
+        return response
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    chat = FakeChat([])
+
+    async def ready():
+        return None
+
+    async def direct_call(priority, guild_id, call, estimated_tokens=0):
+        return await call()
+
+    monkeypatch.setattr(main, 'ensure_gemini', ready)
+    monkeypatch.setattr(main, 'call_gemini', direct_call)
+    monkeypatch.setattr(main, 'state_backend', None)
+    monkeypatch.setattr(main, 'token_usage', main.TokenUsageLedger())
+    monkeypatch.setattr(main, 'chat_sessions', main.SessionStore(max_entries=10, max_bytes=10 ** 6, idle_ttl=60, sweep_interval=60))
+    monkeypatch.setattr(main.ToneStrategyFactory, 'get_model', lambda tone_level: SimpleNamespace(start_chat=lambda history: chat))
+    monkeypatch.setattr(main, 'log_event', lambda *args, **kwargs: None)
+    return chat
+
+
+def test_failed_chunk_handler_leaves_the_session_usable(chat):
+    chat.replies = [FakeStream(["Xin ", "chào"]), FakeStream(["Chào ", "lại"])]
+
+    async def failing_on_chunk(text):
+        raise ConnectionError("Discord edit failed")
+
+    async def on_chunk(text):
+        pass
+
+    async def scenario():
+        failed = await main.generate_chat_response("một", 10, 7, "Nam", on_chunk=failing_on_chunk)
+        reply = await main.generate_chat_response("hai", 10, 7, "Nam", on_chunk=on_chunk)
+        return failed, reply
+
+    failed, reply = asyncio.run(scenario())
+    assert "lỗi" in failed
+    assert reply == "Chào lại"
+    assert [content.parts[0].text for content in chat.history] == ["[Tin nhắn từ Nam]: hai", "Chào lại"]
+
+
+def test_stalled_stream_times_out_and_the_session_recovers(chat, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_TIMEOUT', 0.05)
+    chat.replies = [FakeStream(["Xin "], hang=True), FakeStream(["Ổn rồi"])]
+
+    async def on_chunk(text):
+        pass
+
+    async def scenario():
+        stalled = await asyncio.wait_for(main.generate_chat_response("một", 10, 7, "Nam", on_chunk=on_chunk), 1)
+        reply = await main.generate_chat_response("hai", 10, 7, "Nam", on_chunk=on_chunk)
+        return stalled, reply
+
+    stalled, reply = asyncio.run(scenario())
+    assert "lỗi" in stalled
+    assert reply == "Ổn rồi"
+
+
+def test_cancelled_stream_leaves_the_session_usable(chat):
+    chat.replies = [FakeStream(["Xin "], hang=True), FakeStream(["Ổn rồi"])]
+
+    async def on_chunk(text):
+        pass
+
+    async def scenario():
+        streaming = asyncio.create_task(main.generate_chat_response("một", 10, 7, "Nam", on_chunk=on_chunk))
+        await asyncio.sleep(0.01)
+        streaming.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await streaming
+        return await main.generate_chat_response("hai", 10, 7, "Nam", on_chunk=on_chunk)
+
+    assert asyncio.run(scenario()) == "Ổn rồi"
@@ -0,0 +1,60 @@
+import pytest
+
+import main
+
+
+def make_ledger(hour, retention_hours=48):
+    ledger = main.TokenUsageLedger(retention_hours)
+    ledger.current_hour = lambda: hour[0]
+    ledger._swept_hour = hour[0]
+    return ledger
+
+
+def test_usage_is_summed_over_the_last_day():
+    hour = [1000]
+    ledger = make_ledger(hour)
+    ledger.record(1, 7, 100, 20)
+    hour[0] += 12
+    ledger.record(1, 7, 50, 5)
+    ledger.record(None, 7, 1, 1)  # A DM counts towards the user only
+    assert ledger.usage('guild', 1) == (150, 25)
+    assert ledger.usage('user', 7) == (151, 26)
+    assert ledger.usage('member', (1, 7)) == (150, 25)
+
+    hour[0] += 12  # The first bucket has left the 24-hour window
+    assert ledger.usage('guild', 1) == (50, 5)
+    assert ledger.total('guild', 1, hours=48) == 175
+
+
+def test_old_buckets_and_keys_are_swept():
+    hour = [1000]
+    ledger = make_ledger(hour, retention_hours=2)
+    ledger.record(1, 7, 10, 0)
+    ledger.record(1, 8, 5, 0)
+    assert ledger.top_users(1) == [(7, 10, 0), (8, 5, 0)]
+    hour[0] += 1
+    ledger.record(1, 8, 5, 0)
+    hour[0] += 1
+    ledger.record(2, 9, 1, 0)  # Sweeps hour 1000, which is now past retention
+    assert ledger.top_users(1) == [(8, 5, 0)]
+    assert ('member', (1, 7)) not in ledger._buckets
+    assert ledger._guild_users == {1: {8}, 2: {9}}
+    assert ledger.stats() == {'keys': 6, 'buckets': 6}
+
+
+def test_summary_window_follows_the_budget(monkeypatch):
+    hour = [1000]
+    ledger = make_ledger(hour)
+    monkeypatch.setattr(main, 'token_usage', ledger)
+    monkeypatch.setattr(main, 'USER_DAILY_TOKEN_BUDGET', 1000)
+    monkeypatch.setattr(main, 'DOWNGRADED_SUMMARY_MESSAGE_LIMIT', 50)
+    assert main.budgeted_summary_count(200, 1, 7) == (200, False)
+
+    ledger.record(1, 7, 850, 0)  # Past TOKEN_BUDGET_DOWNGRADE_AT
+    assert main.budgeted_summary_count(200, 1, 7) == (50, True)
+    assert main.budgeted_summary_count(20, 1, 7) == (20, False)
+    assert "rút gọn" in main.summary_status_message(50, "Lan", True)
+
+    ledger.record(1, 7, 200, 0)
+    with pytest.raises(main.BudgetExceededError):
+        main.budgeted_summary_count(200, 1, 7)
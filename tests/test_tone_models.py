@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+import main
+from main import ToneLevel, ToneStrategyFactory
+
+
+class RecordingModel:
+    def __init__(self, model_name, system_instruction=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+
+def test_one_model_per_tone_with_its_system_instruction(monkeypatch):
+    monkeypatch.setattr(ToneStrategyFactory, '_models', {})
+    monkeypatch.setattr(main, 'genai', SimpleNamespace(GenerativeModel=RecordingModel))
+
+    friendly = ToneStrategyFactory.get_model(ToneLevel.FRIENDLY)
+    noble = ToneStrategyFactory.get_model(ToneLevel.NOBLE)
+
+    assert ToneStrategyFactory.get_model(ToneLevel.FRIENDLY) is friendly
+    assert friendly is not noble
+    assert friendly.model_name == main.MODEL_NAME
+    assert friendly.system_instruction == ToneStrategyFactory.get_strategy(ToneLevel.FRIENDLY).get_system_prompt()
+    assert noble.system_instruction == ToneStrategyFactory.get_strategy(ToneLevel.NOBLE).get_system_prompt()
+
+
+def test_unknown_tone_uses_the_neutral_model(monkeypatch):
+    monkeypatch.setattr(ToneStrategyFactory, '_models', {})
+    monkeypatch.setattr(main, 'genai', SimpleNamespace(GenerativeModel=RecordingModel))
+
+    assert ToneStrategyFactory.get_model(None) is ToneStrategyFactory.get_model(ToneLevel.NEUTER)